@@ -12,13 +12,20 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import concurrent.futures
+import contextlib
+import errno
 import fcntl
+import hashlib
 import logging
+import math
 import os
+import queue
 import re
 import select
 import shutil
 import socket
+import struct
 import subprocess
 import threading
 import time
@@ -27,10 +34,20 @@ import uuid
 
 from pathlib import Path
 
+from paste import httpserver
+import requests
+import webob
+from webob import dec
+from webob import static
+
+from nodepool import buildlog
 from nodepool import config as nodepool_config
 from nodepool import exceptions
 from nodepool import provider_manager
 from nodepool import stats
+from nodepool.driver.utils import BlockManifest
+from nodepool.driver.utils import ParentImage
+from nodepool.driver.utils import UploadCheckpoint
 from nodepool.zk import zookeeper as zk
 from nodepool.zk import ZooKeeperClient
 from nodepool.zk.components import BuilderComponent
@@ -49,6 +66,50 @@ DEFAULT_QEMU_IMAGE_COMPAT_OPTIONS = "--qemu-img-options 'compat=0.10'"
 # DIB process polling timeout, in milliseconds
 BUILD_PROCESS_POLL_TIMEOUT = 30 * 1000
 
+# The checksums recorded for each image file, and the size of the
+# reads used to compute them
+CHECKSUM_ALGORITHMS = ('md5', 'sha256')
+CHECKSUM_CHUNK_SIZE = 4 * 1024 * 1024
+
+# The FIDEDUPERANGE ioctl from linux/fs.h, the status it reports for
+# identical ranges and the most it will deduplicate per request
+FIDEDUPERANGE = 0xc0189436
+FILE_DEDUPE_RANGE_SAME = 0
+DEDUPE_MAX_LENGTH = 16 * 1024 * 1024
+# Image files are compared in blocks of this size; it matches the EBS
+# snapshot block size so that the same block manifest serves both.
+DEDUPE_BLOCK_SIZE = 512 * 1024
+
+# How long to keep a failed upload which may be resumed
+RESUMABLE_UPLOAD_AGE = 1 * HOURS
+
+# How often to count outstanding node requests when ordering builds
+# and uploads
+UPLOAD_DEMAND_INTERVAL = 1 * MINS
+
+# How long to wait after starting a build before admitting another,
+# so that its load shows in the one minute load average
+BUILD_ADMISSION_SETTLE = 1 * MINS
+GIB = 1024 * 1024 * 1024
+
+# How long a build must have been ready before the builders which
+# did not build it fetch it from the builder which did and upload it
+# themselves; until then it is left to its own builder.
+PEER_UPLOAD_DELAY = 5 * MINS
+# The size of the ranges in which a build is fetched from another
+# builder, and the timeout for each request
+ARTIFACT_CHUNK_SIZE = 64 * 1024 * 1024
+ARTIFACT_TIMEOUT = 60
+# Suffix of a file which is being fetched from another builder
+ARTIFACT_PART_SUFFIX = '.part'
+# The files served to other builders: image files of a build and
+# their checksum files
+ARTIFACT_NAME_RE = re.compile(r'^\w[\w.-]*-[0-9a-f]+\.\w+(\.md5|\.sha256)?$')
+
+DEFAULT_BUILD_LOG_DIR = '/var/log/nodepool/builds'
+# The build logs served to other builders and clients
+BUILD_LOG_NAME_RE = re.compile(r'^\w[\w.-]*-[0-9a-f]+\.log$')
+
 # Constants for image processing status
 STATUS_IDLE = 0
 STATUS_BUILDING = 1
@@ -67,6 +128,202 @@ def removeDibItem(filename, log):
             raise e
 
 
+def fetchArtifact(url, path, sha256, chunk_size=ARTIFACT_CHUNK_SIZE):
+    '''
+    Fetch an image file from the artifact server of another builder.
+
+    The file is requested in ranges of chunk_size bytes and written
+    to a temporary file next to its destination, which is renamed into
+    place only once its checksum has been verified.  A temporary file
+    left behind by an interrupted fetch is resumed.
+
+    :param str url: The URL of the file.
+    :param str path: The path to store the file at.
+    :param str sha256: The expected sha256 hex digest of the file.
+    :param int chunk_size: The number of bytes to request at a time.
+
+    :raises BuilderError: If the fetched file does not match the checksum.
+    '''
+    part_path = path + ARTIFACT_PART_SUFFIX
+    hasher = hashlib.sha256()
+    offset = 0
+    if os.path.exists(part_path):
+        with open(part_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHECKSUM_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+                offset += len(chunk)
+
+    with requests.Session() as session, open(part_path, 'ab') as f:
+        while True:
+            headers = {'Range': f'bytes={offset}-{offset + chunk_size - 1}'}
+            with session.get(url, headers=headers, stream=True,
+                             timeout=ARTIFACT_TIMEOUT) as r:
+                # The whole file has already been fetched
+                if r.status_code == 416:
+                    break
+                r.raise_for_status()
+                if r.status_code != 206:
+                    raise exceptions.BuilderError(
+                        f"Range request for {url} returned "
+                        f"status {r.status_code}")
+                size = int(r.headers['Content-Range'].rsplit('/', 1)[1])
+                for chunk in r.iter_content(CHECKSUM_CHUNK_SIZE):
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    offset += len(chunk)
+            if offset >= size:
+                break
+
+    if hasher.hexdigest() != sha256:
+        os.unlink(part_path)
+        raise exceptions.BuilderError(
+            f"Checksum of {url} does not match the build")
+    os.replace(part_path, path)
+
+
+def checksumImageFile(path):
+    '''
+    Compute the checksums of an image file in a single pass.
+
+    The file is read once and each hash is updated in its own thread
+    (hashlib releases the GIL for large buffers), so the time taken is
+    that of the slowest hash rather than the sum of them.
+
+    :param str path: The path to the image file.
+
+    :returns: A dictionary of hex digests keyed by algorithm name.
+    '''
+    hashers = {name: hashlib.new(name) for name in CHECKSUM_ALGORITHMS}
+    queues = {name: queue.Queue(maxsize=4) for name in hashers}
+
+    def hash_chunks(hasher, chunks):
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            hasher.update(chunk)
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(hashers)) as executor:
+        futures = [executor.submit(hash_chunks, hashers[name], queues[name])
+                   for name in hashers]
+        try:
+            with open(path, 'rb') as f:
+                while True:
+                    chunk = f.read(CHECKSUM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    for q in queues.values():
+                        q.put(chunk)
+        finally:
+            for q in queues.values():
+                q.put(None)
+        for future in futures:
+            future.result()
+    return {name: hasher.hexdigest() for name, hasher in hashers.items()}
+
+
+def dedupeFileRange(src_fd, src_offset, dest_fd, dest_offset, length):
+    '''
+    Ask the filesystem to share the storage of a range of one file
+    with another.  The kernel compares the contents and only shares
+    them if they are identical.
+
+    :returns: The number of bytes deduplicated.
+    :raises OSError: If the filesystem does not support it.
+    '''
+    deduped = 0
+    while deduped < length:
+        count = min(length - deduped, DEDUPE_MAX_LENGTH)
+        # struct file_dedupe_range with a single file_dedupe_range_info
+        buf = bytearray(
+            struct.pack('=QQHHI', src_offset + deduped, count, 1, 0, 0) +
+            struct.pack('=qQQiI', dest_fd, dest_offset + deduped, 0, 0, 0))
+        fcntl.ioctl(src_fd, FIDEDUPERANGE, buf)
+        (_, _, bytes_deduped, status, _) = struct.unpack_from(
+            '=qQQiI', buf, 24)
+        if status < 0:
+            raise OSError(-status, os.strerror(-status))
+        if status != FILE_DEDUPE_RANGE_SAME or not bytes_deduped:
+            break
+        deduped += bytes_deduped
+    return deduped
+
+
+def dedupeImageFile(src_path, dest_path):
+    '''
+    Share the storage of blocks of an image file with identical blocks
+    of an earlier build.
+
+    Candidate blocks are found by comparing the block manifests of the
+    two files; blocks of zeros are left alone since they are usually
+    holes.
+
+    :returns: The number of bytes deduplicated.
+    :raises OSError: If the filesystem does not support it.
+    '''
+    # Only whole blocks may be deduplicated
+    count = min(os.path.getsize(src_path),
+                os.path.getsize(dest_path)) // DEDUPE_BLOCK_SIZE
+    if not count:
+        return 0
+    deduped = 0
+    src_fd = os.open(src_path, os.O_RDONLY)
+    try:
+        dest_fd = os.open(dest_path, os.O_RDWR)
+        try:
+            # Find out whether the filesystem supports this before
+            # reading the files.
+            deduped += dedupeFileRange(src_fd, 0, dest_fd, 0,
+                                       DEDUPE_BLOCK_SIZE)
+            runs = _identicalBlockRuns(src_path, dest_path, count)
+            for (start, end) in runs:
+                if start == 0:
+                    start = 1
+                    if start == end:
+                        continue
+                offset = start * DEDUPE_BLOCK_SIZE
+                deduped += dedupeFileRange(
+                    src_fd, offset, dest_fd, offset,
+                    (end - start) * DEDUPE_BLOCK_SIZE)
+        finally:
+            os.close(dest_fd)
+    finally:
+        os.close(src_fd)
+    return deduped
+
+
+def _identicalBlockRuns(src_path, dest_path, count):
+    src_digests = BlockManifest(src_path).getDigests(DEDUPE_BLOCK_SIZE)
+    dest_digests = BlockManifest(dest_path).getDigests(DEDUPE_BLOCK_SIZE)
+    if src_digests is None or dest_digests is None:
+        return []
+    zero_digest = hashlib.sha256(bytes(DEDUPE_BLOCK_SIZE)).digest()
+    runs = []
+    start = None
+    for index in range(count + 1):
+        same = (index < count and
+                src_digests[index] == dest_digests[index] and
+                dest_digests[index] != zero_digest)
+        if same and start is None:
+            start = index
+        elif not same and start is not None:
+            runs.append((start, index))
+            start = None
+    return runs
+
+
+def linkIdenticalImageFile(src_path, dest_path):
+    '''
+    Replace an image file with a hard link to an identical file.
+
+    Either name may later be removed without affecting the other.
+    '''
+    tmp_path = dest_path + '.link'
+    os.link(src_path, tmp_path)
+    os.replace(tmp_path, dest_path)
+
+
 class DibImageFile(object):
     '''
     Class used as an API to finding locally built DIB image files, and
@@ -77,10 +334,10 @@ class DibImageFile(object):
     def __init__(self, image_id, extension):
         self.image_id = image_id
         self.extension = extension
-        self.md5 = None
         self.md5_file = None
-        self.sha256 = None
         self.sha256_file = None
+        self._md5 = None
+        self._sha256 = None
 
         # File extension is compared to image type (sans '.') so we
         # store it the same way.
@@ -101,24 +358,37 @@ class DibImageFile(object):
         my_path = Path(images_dir) / f'{self.image_id}.{self.extension}'
 
         # Path.with_suffix() will replace an existing suffix, so we create
-        # new Path objects from strings for the checksum files.
+        # new Path objects from strings for the checksum files.  They
+        # are only read if the checksums are needed.
         md5_path = Path(str(my_path) + '.md5')
-        md5 = self._checksum(md5_path)
-        if md5:
+        if md5_path.is_file():
             self.md5_file = str(md5_path)
-            self.md5 = md5[0:32]
 
         sha256_path = Path(str(my_path) + '.sha256')
-        sha256 = self._checksum(sha256_path)
-        if sha256:
+        if sha256_path.is_file():
             self.sha256_file = str(sha256_path)
-            self.sha256 = sha256[0:64]
 
         return str(my_path)
 
+    @property
+    def md5(self):
+        if self._md5 is None:
+            md5 = self._checksum(self.md5_file)
+            if md5:
+                self._md5 = md5[0:32]
+        return self._md5
+
+    @property
+    def sha256(self):
+        if self._sha256 is None:
+            sha256 = self._checksum(self.sha256_file)
+            if sha256:
+                self._sha256 = sha256[0:64]
+        return self._sha256
+
     def _checksum(self, filename):
-        if filename.is_file():
-            return filename.read_text()
+        if filename and Path(filename).is_file():
+            return Path(filename).read_text()
         return None
 
 
@@ -156,10 +426,9 @@ class BaseWorker(threading.Thread):
             self._config, self._config_path, self._secure_path)
 
     def _readConfig(self):
-        new_config = nodepool_config.loadConfig(self._config_path)
-        if self._secure_path:
-            nodepool_config.loadSecureConfig(new_config, self._secure_path)
-        return new_config
+        return nodepool_config.loadConfig(
+            self._config_path, previous=self._config,
+            secure_config_path=self._secure_path)
 
     @property
     def running(self):
@@ -261,7 +530,15 @@ class CleanupWorker(BaseWorker):
         '''
         base = "-".join([image_name, build_id])
         files = DibImageFile.from_image_id(images_dir, base)
-        if not files:
+        # Block manifests outlive images deleted after upload, and
+        # fetches from other builders may have been interrupted.
+        block_manifests = [
+            str(p) for p in
+            Path(images_dir).glob(f'{base}.*{BlockManifest.suffix}')]
+        block_manifests.extend(
+            str(p) for p in
+            Path(images_dir).glob(f'{base}.*{ARTIFACT_PART_SUFFIX}'))
+        if not (files or block_manifests):
             return
 
         log.info("Doing cleanup for %s:%s" % (image_name, build_id))
@@ -276,6 +553,10 @@ class CleanupWorker(BaseWorker):
             items = [filename, f.md5_file, f.sha256_file]
             for item in items:
                 removeDibItem(item, log)
+        for item in block_manifests:
+            removeDibItem(item, log)
+        if not manifest_dir:
+            return
         try:
             shutil.rmtree(manifest_dir)
             log.info("Removed DIB manifest %s" % manifest_dir)
@@ -336,6 +617,14 @@ class CleanupWorker(BaseWorker):
                                   (base, upload.provider_name))
                     manager.deleteImage(upload.external_name,
                                         upload.external_id)
+                elif upload.resume_data:
+                    # A failed upload which was kept to be resumed
+                    # still has a partial image in the cloud.
+                    self.log.info("Deleting partial upload %s from %s" %
+                                  (upload.external_name,
+                                   upload.provider_name))
+                    manager.abortImageUpload(upload.external_name,
+                                             upload.resume_data)
             except Exception:
                 self.log.exception(
                     "Unable to delete image %s from %s:",
@@ -533,6 +822,12 @@ class CleanupWorker(BaseWorker):
                     continue
                 if upload.state != u.state:
                     continue
+                if u.resume_data:
+                    # The upload saved its progress before it was
+                    # interrupted; mark it failed so that it may be
+                    # resumed.
+                    self._markUploadResumable(u)
+                    continue
                 self.log.debug("Removing failed upload record: %s" % upload)
                 self._zk.deleteUpload(image, build_id, provider, upload.id)
             elif upload.state == zk.DELETING:
@@ -540,10 +835,34 @@ class CleanupWorker(BaseWorker):
                     "Removing deleted upload and record: %s" % upload)
                 self._deleteUpload(upload)
             elif upload.state == zk.FAILED:
+                if self._isResumableUpload(upload):
+                    continue
                 self.log.debug(
                     "Removing failed upload and record: %s" % upload)
                 self._deleteUpload(upload)
 
+    def _isResumableUpload(self, upload):
+        '''
+        Determine if a failed upload may still be resumed.
+        '''
+        return bool(upload.resume_data and
+                    time.time() - upload.state_time < RESUMABLE_UPLOAD_AGE)
+
+    def _markUploadResumable(self, upload):
+        try:
+            with self._zk.imageUploadNumberLock(upload, blocking=False):
+                self.log.debug("Marking interrupted upload as failed "
+                               "for resumption: %s", upload)
+                upload.state = zk.FAILED
+                self._zk.storeImageUpload(upload.image_name,
+                                          upload.build_id,
+                                          upload.provider_name,
+                                          upload, upload.id)
+        except exceptions.ZKLockException:
+            # If we can't get a lock, we'll try again later.
+            self.log.debug("Unable to get lock on image upload: %s",
+                           upload)
+
     def _cleanupImage(self, known_providers, image):
         '''
         Clean up one image.
@@ -684,11 +1003,14 @@ class CleanupWorker(BaseWorker):
 
 class BuildWorker(BaseWorker):
     def __init__(self, name, builder_id, config_path, secure_path,
-                 interval, zk):
+                 interval, zk, build_queue=None):
         super(BuildWorker, self).__init__(builder_id, config_path, secure_path,
                                           interval, zk)
         self.log = logging.getLogger("nodepool.builder.BuildWorker.%s" % name)
         self.name = 'BuildWorker.%s' % name
+        if build_queue is None:
+            build_queue = BuildQueue(zk)
+        self._build_queue = build_queue
         self._lost_zk_connection = False
         zk.client.on_connection_lost_listeners.append(self._onConnectionLost)
 
@@ -696,9 +1018,7 @@ class BuildWorker(BaseWorker):
         self._lost_zk_connection = True
 
     def _getBuildLogRoot(self, name):
-        log_dir = self._config.build_log_dir
-        if not log_dir:
-            log_dir = '/var/log/nodepool/builds'
+        log_dir = self._config.build_log_dir or DEFAULT_BUILD_LOG_DIR
         if not os.path.exists(log_dir):
             os.makedirs(log_dir)
         return log_dir
@@ -709,39 +1029,111 @@ class BuildWorker(BaseWorker):
         log_dir = self._getBuildLogRoot(name)
         keep = max(self._config.build_log_retention, 1)
         existing = os.listdir(log_dir)
-        existing = [f for f in existing if f.startswith(name)]
+        # Indexes of compressed logs are removed with them
+        existing = [f for f in existing if f.startswith(name) and
+                    not f.endswith(buildlog.INDEX_SUFFIX)]
         existing = [os.path.join(log_dir, f) for f in existing]
         existing = sorted(existing, key=os.path.getmtime)
         delete = existing[:0 - keep]
         for f in delete:
             self.log.info("Deleting old build log %s", f)
             os.unlink(f)
+            if os.path.exists(f + buildlog.INDEX_SUFFIX):
+                os.unlink(f + buildlog.INDEX_SUFFIX)
 
     def _getBuildLog(self, name, build_id):
         log_dir = self._getBuildLogRoot(name)
         return os.path.join(log_dir, '%s-%s.log' % (name, build_id))
 
-    def _checkForScheduledImageUpdates(self):
+    def _checkForImageBuilds(self):
         '''
-        Check every DIB image to see if it has aged out and needs rebuilt.
+        Check for images which need to be built, either because they
+        have aged out or because a build was requested, and build them.
+
+        The build queue shared by the build workers of this builder
+        decides which image is built first and whether the host has
+        the capacity to start it now.
         '''
-        self.log.debug('Checking for scheduled image updates')
-        for diskimage in self._config.diskimages.values():
+        self.log.debug('Checking for image builds')
+        attempted = set()
+        while True:
             # Check if we've been told to shutdown
             # or if ZK connection is suspended
             if not self._running or self._zk.suspended or self._zk.lost:
                 return
+            if not self._checkConfigRecent():
+                # If our config isn't up to date then return and start
+                # over with a new config load.
+                self.log.debug('Config changed')
+                return
+            pending = self._getPendingBuilds()
+            claimed = self._build_queue.claim(pending, attempted)
+            if not claimed:
+                return
+            attempted.add(claimed.key)
             try:
-                if not self._checkConfigRecent():
-                    # If our config isn't up to date then return and start
-                    # over with a new config load.
-                    self.log.debug('Config changed')
+                if not self._build_queue.admit(
+                        claimed, self._config.images_dir,
+                        self._config.build_admission):
+                    # Try again after the interval
                     return
-                self._checkImageForScheduledImageUpdates(diskimage)
+                if self._statsd:
+                    key = ('nodepool.dib_image_build.%s.queue_wait' %
+                           claimed.image_name)
+                    self._statsd.timing(key, int(
+                        (time.monotonic() - claimed.queued_time) * 1000))
+                if claimed.manual:
+                    self._checkImageForManualBuildRequest(claimed.diskimage)
+                else:
+                    self._checkImageForScheduledImageUpdates(
+                        claimed.diskimage)
+            except Exception:
+                self.log.exception("Exception building diskimage %s",
+                                   claimed.image_name)
+            finally:
+                self._build_queue.release(claimed)
+
+    def _getPendingBuilds(self):
+        '''
+        Find the images which have aged out or have a build request.
+
+        :returns: A list of PendingBuild objects.
+        '''
+        pending = []
+        for diskimage in self._config.diskimages.values():
+            try:
+                p = self._getPendingBuild(diskimage)
             except Exception:
-                self.log.exception("Exception checking for scheduled "
-                                   "update of diskimage %s",
-                                   diskimage.name)
+                self.log.exception("Exception checking for builds "
+                                   "of diskimage %s", diskimage.name)
+                continue
+            if p:
+                pending.append(p)
+        return pending
+
+    def _getPendingBuild(self, diskimage):
+        # Check if diskimage builds are paused.
+        if diskimage.pause or self._zk.getImagePaused(diskimage.name):
+            self._image_status[diskimage.name] = STATUS_PAUSED
+            return None
+        self._image_status[diskimage.name] = STATUS_IDLE
+        if not diskimage.image_types:
+            # We don't know what formats to build.
+            return None
+
+        manual = self._zk.hasBuildRequest(diskimage.name)
+        builds = self._zk.getMostRecentBuilds(1, diskimage.name, zk.READY)
+        if (not builds or
+            not set(builds[0].formats).issuperset(diskimage.image_types)):
+            overdue = math.inf
+        else:
+            overdue = (time.time() - builds[0].state_time -
+                       diskimage.rebuild_age)
+        if not manual and overdue < 0:
+            return None
+        labels = getImageLabels(self._config.providers.values(),
+                                diskimage.name)
+        return PendingBuild(diskimage, manual, overdue, labels)
 
     def _checkImageForScheduledImageUpdates(self, diskimage):
         '''
@@ -841,28 +1233,6 @@ class BuildWorker(BaseWorker):
 
         return self._zk.getBuild(diskimage.name, bnum)
 
-    def _checkForManualBuildRequest(self):
-        '''
-        Query ZooKeeper for any manual image build requests.
-        '''
-        self.log.debug('Checking for manual image build requests')
-        for diskimage in self._config.diskimages.values():
-            # Check if we've been told to shutdown
-            # or if ZK connection is suspended
-            if not self._running or self._zk.suspended or self._zk.lost:
-                return
-            try:
-                if not self._checkConfigRecent():
-                    # If our config isn't up to date then return and start
-                    # over with a new config load.
-                    self.log.debug('Config changed')
-                    return
-                self._checkImageForManualBuildRequest(diskimage)
-            except Exception:
-                self.log.exception("Exception checking for manual "
-                                   "update of diskimage %s",
-                                   diskimage)
-
     def _checkImageForManualBuildRequest(self, diskimage):
         '''
         Query ZooKeeper for a manual image build request for one image.
@@ -906,6 +1276,94 @@ class BuildWorker(BaseWorker):
         finally:
             self._image_status[diskimage.name] = STATUS_IDLE
 
+    def _checksumImages(self, build_data, image_filename, image_types):
+        '''
+        Checksum each format of a new build.
+
+        All of the formats are read concurrently, each in a single
+        pass.  The checksums are recorded in the build data, so that
+        uploads do not need to read them, and in files alongside the
+        images.
+
+        :param ImageBuild build_data: The build data to update.
+        :param str image_filename: The path to the images without the
+            format extension.
+        :param list image_types: The formats of the build.
+
+        :returns: True if the images were checksummed, False otherwise.
+        '''
+        start_time = time.monotonic()
+        paths = {ext: '%s.%s' % (image_filename, ext) for ext in image_types}
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=max(1, len(paths))) as executor:
+                futures = {ext: executor.submit(checksumImageFile, path)
+                           for ext, path in paths.items()}
+                checksums = {ext: future.result()
+                             for ext, future in futures.items()}
+            for ext, path in paths.items():
+                for name, digest in checksums[ext].items():
+                    # The same format as md5sum and sha256sum
+                    Path('%s.%s' % (path, name)).write_text(
+                        '%s  %s\n' % (digest, os.path.basename(path)))
+        except Exception:
+            self.log.exception("Unable to checksum image %s:",
+                               image_filename)
+            return False
+        build_data.checksums = checksums
+        self.log.debug("Checksummed %s in %.1f seconds", image_filename,
+                       time.monotonic() - start_time)
+        return True
+
+    def _dedupeImages(self, diskimage, build_id, build_data):
+        '''
+        Share storage between a new build and the previous local build
+        of the image.
+
+        Files which are identical to the previous build are replaced
+        with hard links.  Otherwise, if the filesystem supports it
+        (e.g., btrfs or XFS), identical blocks are shared.  Either way
+        the files remain ordinary files which may be deleted
+        independently.
+        '''
+        images_dir = self._config.images_dir
+        previous = [b for b in self._zk.getMostRecentBuilds(
+            None, diskimage.name, zk.READY) if b.id != build_id]
+        for ext in diskimage.image_types:
+            path = os.path.join(images_dir, '%s-%s.%s' % (
+                diskimage.name, build_id, ext))
+            for build in previous:
+                prev_path = os.path.join(images_dir, '%s-%s.%s' % (
+                    diskimage.name, build.id, ext))
+                if os.path.exists(prev_path):
+                    break
+            else:
+                continue
+            sha256 = build_data.checksums.get(ext, {}).get('sha256')
+            try:
+                if (sha256 and sha256 ==
+                    build.checksums.get(ext, {}).get('sha256')):
+                    linkIdenticalImageFile(prev_path, path)
+                    self.log.info("Linked %s to identical %s",
+                                  path, prev_path)
+                    continue
+                deduped = dedupeImageFile(prev_path, path)
+                self.log.info("Shared %s bytes of %s with %s",
+                              deduped, path, prev_path)
+                if self._statsd:
+                    key = 'nodepool.dib_image_build.%s.%s.deduped' % (
+                        diskimage.name, ext)
+                    self._statsd.gauge(key, deduped)
+            except OSError as e:
+                if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY,
+                               errno.EINVAL, errno.EXDEV):
+                    self.log.debug("Unable to share blocks of %s: %s",
+                                   path, e)
+                    continue
+                self.log.exception("Error deduplicating %s:", path)
+            except Exception:
+                self.log.exception("Error deduplicating %s:", path)
+
     def _buildImage(self, build_id, diskimage):
         '''
         Run the external command to build the diskimage.
@@ -949,12 +1407,16 @@ class BuildWorker(BaseWorker):
         # fake-image-create relative to this file easily
         dib_cmd = diskimage.dib_cmd.replace("%p", os.path.dirname(__file__))
 
-        cmd = ('%s -x -t %s --checksum --no-tmpfs %s -o %s %s' %
+        # Checksums are computed by _checksumImages rather than DIB
+        cmd = ('%s -x -t %s --no-tmpfs %s -o %s %s' %
                (dib_cmd, img_types, qemu_img_options,
                 image_filename, img_elements))
 
         self._pruneBuildLogs(diskimage.name)
-        log_fn = self._getBuildLog(diskimage.name, build_id)
+        log_path = self._getBuildLog(diskimage.name, build_id)
+        log_fn = log_path
+        if self._config.build_log_compress:
+            log_fn += buildlog.COMPRESSED_SUFFIX
 
         self.log.info('Running %s' % (cmd,))
         self.log.info('Logging to %s' % (log_fn,))
@@ -993,7 +1455,8 @@ class BuildWorker(BaseWorker):
                 return True
             return False
 
-        with open(log_fn, 'wb') as log:
+        with buildlog.BuildLog(log_path,
+                               self._config.build_log_compress) as log:
 
             # While the subprocess is running, we will loop through stdout
             # events. If we can read data, write that out to the log file.
@@ -1015,7 +1478,6 @@ class BuildWorker(BaseWorker):
                         data = p.stdout.read(1024)
                         while data:
                             log.write(data)
-                            log.flush()
                             data = p.stdout.read(1024)
                         if buildDidTimeout():
                             break
@@ -1072,8 +1534,13 @@ class BuildWorker(BaseWorker):
                 "DIB failed creating %s (%s) (timeout=%s)" % (
                     diskimage.name, p.returncode, did_timeout))
             build_data.state = zk.FAILED
+        elif not self._checksumImages(build_data, image_filename,
+                                      diskimage.image_types):
+            build_data.state = zk.FAILED
         else:
             self.log.info("DIB image %s is built" % diskimage.name)
+            if self._config.images_dedup:
+                self._dedupeImages(diskimage, build_id, build_data)
             build_data.state = zk.READY
             build_data.formats = list(diskimage.image_types)
 
@@ -1140,17 +1607,311 @@ class BuildWorker(BaseWorker):
             self._checkForZooKeeperChanges(new_config)
             self._config = new_config
 
-        self._checkForScheduledImageUpdates()
-        self._checkForManualBuildRequest()
+        self._checkForImageBuilds()
+
+
+def getImageLabels(providers, image_name):
+    '''
+    Return the names of the labels of the providers which use an image.
+    '''
+    labels = set()
+    for provider in providers:
+        for pool in provider.pools.values():
+            for label in pool.labels.values():
+                diskimage = getattr(label, 'diskimage', None)
+                if diskimage and diskimage.name == image_name:
+                    labels.add(label.name)
+    return labels
+
+
+def getHostLoad():
+    '''
+    Return the one minute load average divided by the number of CPUs.
+    '''
+    return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+
+def getIOPressure():
+    '''
+    Return the percentage of the last ten seconds in which some tasks
+    were stalled waiting for IO, or None if the kernel does not report
+    pressure stall information.
+    '''
+    try:
+        with open('/proc/pressure/io') as f:
+            for line in f:
+                fields = line.split()
+                if fields and fields[0] == 'some':
+                    values = dict(x.split('=', 1) for x in fields[1:])
+                    return float(values['avg10'])
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
+
+
+class PendingBuild(object):
+    '''
+    An image which needs to be built.
+    '''
+    def __init__(self, diskimage, manual, overdue, labels):
+        self.diskimage = diskimage
+        self.image_name = diskimage.name
+        # Whether the build was requested by an operator
+        self.manual = manual
+        # How long the image has been due for a rebuild
+        self.overdue = overdue
+        self.labels = labels
+        # Set by the build queue
+        self.queued_time = None
+        self.admitted = False
+
+    @property
+    def key(self):
+        return self.image_name
+
+    def getLabels(self):
+        return self.labels
+
+
+class PendingUpload(object):
+    '''
+    A build of an image which needs to be uploaded to a provider.
+    '''
+    def __init__(self, provider, image, build, local_images,
+                 last_upload_time, artifact_url=None):
+        self.provider = provider
+        self.image = image
+        self.image_name = image.name
+        self.build = build
+        self.local_images = local_images
+        # When the provider last received any build of the image
+        self.last_upload_time = last_upload_time
+        # Where to fetch the build from if it is not local
+        self.artifact_url = artifact_url
+
+    @property
+    def key(self):
+        return (self.image_name, self.provider.name)
+
+    def getLabels(self):
+        '''
+        Return the names of the provider's labels which use the image.
+        '''
+        return getImageLabels([self.provider], self.image_name)
+
+
+class WorkQueue(object):
+    '''
+    Base class for the queues which order the work of a builder's
+    workers by the number of outstanding node requests it serves.
+    '''
+    log = logging.getLogger("nodepool.builder.WorkQueue")
+
+    def __init__(self, zk):
+        self._zk = zk
+        self._lock = threading.Lock()
+        self._claimed = set()
+        self._demand = {}
+        self._demand_time = None
+
+    def _getDemand(self):
+        # The builder does not cache node requests, so only count them
+        # periodically.
+        if (self._demand_time is not None and
+            time.monotonic() - self._demand_time < UPLOAD_DEMAND_INTERVAL):
+            return self._demand
+        demand = {}
+        try:
+            for req in self._zk.nodeRequestIterator(cached=False):
+                if req.state not in (zk.REQUESTED, zk.PENDING):
+                    continue
+                for label in req.node_types:
+                    demand[label] = demand.get(label, 0) + 1
+        except Exception:
+            self.log.exception("Unable to count node requests:")
+        self._demand = demand
+        self._demand_time = time.monotonic()
+        return demand
+
+    def _getRequests(self, pending, demand):
+        return sum(demand.get(label, 0) for label in pending.getLabels())
+
+
+class BuildQueue(WorkQueue):
+    '''
+    Decide which image the build workers of a builder build next, and
+    when the host has the capacity to start another build.
+
+    Manual build requests come first, then images are ordered by the
+    number of outstanding node requests for labels using them, then
+    by how long they have been due for a rebuild.  The first build is
+    always admitted if there is enough free space in the images
+    directory; further concurrent builds are admitted only while the
+    load and IO pressure of the host stay below the configured limits.
+    '''
+    log = logging.getLogger("nodepool.builder.BuildQueue")
+
+    def __init__(self, zk):
+        super().__init__(zk)
+        # When each pending image was first seen
+        self._queued = {}
+        self._building = 0
+        self._admit_time = None
+
+    def claim(self, pending, skip=()):
+        '''
+        Claim the most important of the pending builds.
+
+        :param list pending: All of the PendingBuild objects.
+        :param set skip: Keys of pending builds not to claim.
+
+        :returns: The claimed PendingBuild or None.
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self._queued = {p.key: self._queued.get(p.key, now)
+                            for p in pending}
+            for p in pending:
+                p.queued_time = self._queued[p.key]
+            pending = [p for p in pending
+                       if p.key not in self._claimed and p.key not in skip]
+            if not pending:
+                return None
+            if len(pending) > 1:
+                demand = self._getDemand()
+                pending.sort(key=lambda p: self._sortKey(p, demand))
+            best = pending[0]
+            self._claimed.add(best.key)
+            return best
+
+    def admit(self, pending, images_dir, limits):
+        '''
+        Check whether the host has the capacity to start a claimed build.
+
+        :param PendingBuild pending: The claimed build.
+        :param str images_dir: Where the build will be stored.
+        :param dict limits: The build admission limits from the config.
+
+        :returns: True if the build may start, False if it should wait.
+        '''
+        with self._lock:
+            reason = self._checkCapacity(images_dir, limits)
+            if reason:
+                self.log.info("Deferring build of image %s: %s",
+                              pending.image_name, reason)
+                return False
+            self._building += 1
+            self._admit_time = time.monotonic()
+            self._queued.pop(pending.key, None)
+            pending.admitted = True
+            return True
+
+    def release(self, pending):
+        with self._lock:
+            self._claimed.discard(pending.key)
+            if pending.admitted:
+                self._building -= 1
+                pending.admitted = False
+
+    def _checkCapacity(self, images_dir, limits):
+        free = shutil.disk_usage(images_dir).free
+        min_free = limits['min_free_space'] * GIB
+        if free < min_free:
+            return f"{free // GIB} GiB free in {images_dir}"
+        if not self._building:
+            return None
+        if time.monotonic() - self._admit_time < BUILD_ADMISSION_SETTLE:
+            # Let the load of the last build show in the load average
+            return "a build has just started"
+        load = getHostLoad()
+        if load > limits['max_load']:
+            return f"load per CPU is {load:.2f}"
+        pressure = getIOPressure()
+        if pressure is not None and pressure > limits['max_io_pressure']:
+            return f"IO pressure is {pressure:.1f}%"
+        return None
+
+    def _sortKey(self, pending, demand):
+        return (not pending.manual,
+                -self._getRequests(pending, demand),
+                -pending.overdue)
+
+
+class UploadQueue(WorkQueue):
+    '''
+    Decide which uploads the upload workers of a builder perform next.
+
+    Pending uploads are ordered by the number of outstanding node
+    requests for labels using the image in the provider, then by
+    provider priority, then by how long the provider has gone without
+    a new build of the image.  A worker claims the most important
+    upload together with the uploads of the same build to other
+    providers so that they may be performed at once, and other
+    workers pass over claimed uploads rather than contending for
+    their locks.
+    '''
+    log = logging.getLogger("nodepool.builder.UploadQueue")
+
+    def __init__(self, zk):
+        super().__init__(zk)
+        self._fetch_locks = {}
+
+    def claim(self, pending):
+        '''
+        Claim the most important of the pending uploads.
+
+        :param list pending: A list of PendingUpload objects.
+
+        :returns: A list of the PendingUpload objects for one build
+            which are now claimed by the caller, or an empty list.
+        '''
+        with self._lock:
+            pending = [p for p in pending if p.key not in self._claimed]
+            if not pending:
+                return []
+            # Only consider the demand if there is a choice to make
+            if len(set(p.image_name for p in pending)) > 1:
+                demand = self._getDemand()
+                pending.sort(key=lambda p: self._sortKey(p, demand))
+            best = pending[0]
+            claimed = [p for p in pending
+                       if p.image_name == best.image_name and
+                       p.build.id == best.build.id]
+            self._claimed.update(p.key for p in claimed)
+            return claimed
+
+    def release(self, claimed):
+        with self._lock:
+            self._claimed.difference_update(p.key for p in claimed)
+
+    def fetchLock(self, image_name, build_id):
+        '''
+        Return the lock held while fetching a build from another
+        builder, so that workers uploading it to different providers
+        fetch it once.
+        '''
+        with self._lock:
+            return self._fetch_locks.setdefault(
+                (image_name, build_id), threading.Lock())
+
+    def _sortKey(self, pending, demand):
+        priority = pending.provider.priority
+        if priority is None:
+            priority = 100
+        return (-self._getRequests(pending, demand), priority,
+                pending.last_upload_time)
 
 
 class UploadWorker(BaseWorker):
     def __init__(self, name, builder_id, config_path, secure_path,
-                 interval, zk):
+                 interval, zk, upload_queue=None):
         super(UploadWorker, self).__init__(builder_id, config_path,
                                            secure_path, interval, zk)
         self.log = logging.getLogger("nodepool.builder.UploadWorker.%s" % name)
         self.name = 'UploadWorker.%s' % name
+        if upload_queue is None:
+            upload_queue = UploadQueue(zk)
+        self._upload_queue = upload_queue
 
     def _reloadConfig(self):
         '''
@@ -1166,7 +1927,8 @@ class UploadWorker(BaseWorker):
             self._config = new_config
 
     def _uploadImage(self, build_id, upload_id, image_name, images, provider,
-                     username, python_path, shell_type):
+                     username, python_path, shell_type, resume_upload=None,
+                     checksums=None):
         '''
         Upload a local DIB image build to a provider.
 
@@ -1179,6 +1941,10 @@ class UploadWorker(BaseWorker):
         :param username:
         :param python_path:
         :param shell_type:
+        :param ImageUpload resume_upload: A previously failed attempt
+            at this upload whose progress should be resumed.
+        :param dict checksums: The checksums of each format of the
+            build, as recorded in the build data.
         '''
         start_time = time.time()
         timestamp = int(start_time)
@@ -1199,12 +1965,23 @@ class UploadWorker(BaseWorker):
                        (image.extension, image.image_id))
 
         filename = image.to_path(self._config.images_dir)
-
-        ext_image_name = provider.image_name_format.format(
-            image_name=image_name,
-            upload_id=upload_id,
-            timestamp=str(timestamp)
-        )
+        # Builds made before the checksums were recorded only have
+        # them in files.
+        image_checksums = (checksums or {}).get(image.extension, {})
+        md5 = image_checksums.get('md5') or image.md5
+        sha256 = image_checksums.get('sha256') or image.sha256
+
+        if resume_upload and resume_upload.external_name:
+            # The cloud may know the partial upload by name
+            ext_image_name = resume_upload.external_name
+            resume_data = resume_upload.resume_data
+        else:
+            ext_image_name = provider.image_name_format.format(
+                image_name=image_name,
+                upload_id=upload_id,
+                timestamp=str(timestamp)
+            )
+            resume_data = None
 
         self.log.info("Uploading DIB image build %s from %s to %s" %
                       (build_id, filename, provider.name))
@@ -1221,14 +1998,37 @@ class UploadWorker(BaseWorker):
         meta['nodepool_build_id'] = build_id
         meta['nodepool_upload_id'] = upload_id
 
+        def save_checkpoint(resume_data):
+            # Record the progress with the in-progress upload so that
+            # it survives a restart of this builder.
+            data = zk.ImageUpload()
+            data.state = zk.UPLOADING
+            data.username = username
+            data.python_path = python_path
+            data.shell_type = shell_type
+            data.external_name = ext_image_name
+            data.resume_data = resume_data
+            self._zk.storeImageUpload(image_name, build_id, provider.name,
+                                      data, upload_id)
+
+        checkpoint = UploadCheckpoint(resume_data, save_checkpoint)
+        # Adapters which support incremental uploads compare the
+        # manifests to send only the blocks which changed since the
+        # parent was uploaded.  Both are computed only if used.
+        manifest = BlockManifest(filename)
+        parent = self._getParentImage(image_name, build_id, provider,
+                                      image.extension)
         try:
             external_id = manager.uploadImage(
                 provider_image,
                 ext_image_name, filename,
                 image_type=image.extension,
                 meta=meta,
-                md5=image.md5,
-                sha256=image.sha256,
+                md5=md5,
+                sha256=sha256,
+                checkpoint=checkpoint,
+                manifest=manifest,
+                parent=parent,
             )
         except Exception:
             self.log.exception(
@@ -1236,6 +2036,10 @@ class UploadWorker(BaseWorker):
                 (build_id, image_name, provider.name))
             data = zk.ImageUpload()
             data.state = zk.FAILED
+            if checkpoint.data:
+                # Keep the progress so a later attempt may resume
+                data.external_name = ext_image_name
+                data.resume_data = checkpoint.data
             return data
 
         if provider.post_upload_hook:
@@ -1296,72 +2100,251 @@ class UploadWorker(BaseWorker):
 
         return data
 
+    def _getParentImage(self, image_name, build_id, provider, extension):
+        '''
+        Find the most recent upload of an earlier build of this image
+        to the provider whose block manifest is still available.
+
+        :returns: A ParentImage or None.
+        '''
+        for build in self._zk.getMostRecentBuilds(None, image_name,
+                                                  zk.READY):
+            if build.id == build_id:
+                continue
+            uploads = self._zk.getMostRecentBuildImageUploads(
+                1, image_name, build.id, provider.name, zk.READY)
+            if not uploads or not uploads[0].external_id:
+                continue
+            path = str(Path(self._config.images_dir) /
+                       f'{image_name}-{build.id}.{extension}')
+            manifest = BlockManifest(path)
+            if not (os.path.exists(path) or
+                    os.path.exists(manifest.manifest_path)):
+                continue
+            sha256 = (build.checksums or {}).get(extension, {}).get('sha256')
+            return ParentImage(uploads[0].external_id, manifest, sha256)
+        return None
+
     def _checkForProviderUploads(self):
         '''
         Check for any image builds that need to be uploaded to providers.
 
         If we find any builds in the 'ready' state that haven't been uploaded
         to providers, do the upload if they are available on the local disk.
+        The upload queue shared by the upload workers of this builder
+        decides which image is uploaded first; its uploads to every
+        provider that needs it are performed at the same time so that
+        the file is read from disk once and shared through the page
+        cache.
         '''
-        for provider in self._config.providers.values():
-            if not provider.manage_images:
-                continue
-            for image in provider.diskimages.values():
-                uploaded = False
-
-                # Check if we've been told to shutdown
-                # or if ZK connection is suspended
-                if not self._running or self._zk.suspended or self._zk.lost:
-                    return
-                try:
-                    uploaded = self._checkProviderImageUpload(provider, image)
-                except Exception:
-                    self.log.exception("Error uploading image %s "
-                                       "to provider %s:",
-                                       image.name, provider.name)
+        attempted = set()
+        while True:
+            # Check if we've been told to shutdown
+            # or if ZK connection is suspended
+            if not self._running or self._zk.suspended or self._zk.lost:
+                return
+            pending = [p for p in self._getPendingUploads()
+                       if p.key not in attempted]
+            claimed = self._upload_queue.claim(pending)
+            if not claimed:
+                return
+            attempted.update(p.key for p in claimed)
+            uploaded = False
+            try:
+                uploaded = self._performUploads(claimed)
+            except Exception:
+                self.log.exception("Error uploading image %s:",
+                                   claimed[0].image_name)
+            finally:
+                self._upload_queue.release(claimed)
 
-                # NOTE: Due to the configuration file disagreement issue
-                # (the copy we have may not be current), if we took the time
-                # to attempt to upload an image, let's short-circuit this loop
-                # to give us a chance to reload the configuration file.
-                if uploaded:
-                    return
+            # NOTE: Due to the configuration file disagreement issue
+            # (the copy we have may not be current), if we took the time
+            # to attempt to upload an image, let's short-circuit this loop
+            # to give us a chance to reload the configuration file.
+            if uploaded:
+                return
 
-    def _checkProviderImageUpload(self, provider, image):
+    def _getPendingUploads(self):
         '''
-        The main body of _checkForProviderUploads.  This encapsulates
-        checking whether an image for a provider should be uploaded
-        and performing the upload.  It is a separate function so that
-        exception handling can treat all provider-image uploads
-        indepedently.
+        Find the most recent ready build of each image which has not
+        been uploaded to a provider which uses it.
 
-        :returns: True if an upload was attempted and succeeded,
-                  False otherwise.
+        :returns: A list of PendingUpload objects.
         '''
+        targets = {}
+        for provider in self._config.providers.values():
+            if not provider.manage_images:
+                continue
+            for image in provider.diskimages.values():
+                targets.setdefault(image.name, []).append((provider, image))
 
-        self._image_status.setdefault(image.name, {})
-
-        # Check if image uploads are paused.
-        if provider.diskimages.get(image.name).pause:
-            self._image_status[image.name][provider.name] = STATUS_PAUSED
-            return False
+        pending = []
+        for image_name, image_targets in targets.items():
+            try:
+                pending.extend(
+                    self._getPendingImageUploads(image_name, image_targets))
+            except Exception:
+                self.log.exception("Error checking uploads of image %s:",
+                                   image_name)
+        return pending
+
+    def _getPendingImageUploads(self, image_name, targets):
+        self._image_status.setdefault(image_name, {})
+        active = []
+        for (provider, image) in targets:
+            # Check if image uploads are paused.
+            if provider.diskimages.get(image.name).pause:
+                self._image_status[image.name][provider.name] = \
+                    STATUS_PAUSED
+                continue
+            self._image_status[image.name][provider.name] = STATUS_IDLE
+            active.append((provider, image))
+        if not active:
+            return []
 
-        self._image_status[image.name][provider.name] = STATUS_IDLE
         # Search for the most recent 'ready' image build
-        builds = self._zk.getMostRecentBuilds(1, image.name,
-                                              zk.READY)
+        builds = self._zk.getMostRecentBuilds(1, image_name, zk.READY)
         if not builds:
-            return False
-
+            return []
         build = builds[0]
 
         # Search for locally built images. The image name and build
         # sequence ID is used to name the image.
         local_images = DibImageFile.from_image_id(
-            self._config.images_dir, "-".join([image.name, build.id]))
+            self._config.images_dir, "-".join([image_name, build.id]))
+        artifact_url = None
         if not local_images:
-            return False
+            # Builds made elsewhere may be fetched from their builder
+            artifact_url = self._getArtifactUrl(build)
+            if not artifact_url:
+                return []
+
+        pending = []
+        for (provider, image) in active:
+            if not self._needsProviderImageUpload(provider, image, build):
+                continue
+            last_upload = self._zk.getMostRecentImageUpload(
+                image_name, provider.name)
+            pending.append(PendingUpload(
+                provider, image, build, local_images,
+                last_upload.state_time if last_upload else 0,
+                artifact_url=artifact_url))
+        return pending
+
+    def _getArtifactUrl(self, build):
+        '''
+        Find where the builder which made a build serves it.
+
+        Other builders only take over the uploads of a build once it
+        has been ready for a while, and only if its checksums are
+        recorded so that the fetched files can be verified.
+
+        :returns: The URL of the builder's artifact server, or None.
+        '''
+        if build.builder_id == self._builder_id or not build.checksums:
+            return None
+        if time.time() - build.state_time < PEER_UPLOAD_DELAY:
+            return None
+        for component in self._zk.getRegisteredBuilders():
+            if component.id == build.builder_id:
+                return component.artifact_url
+        return None
+
+    def _fetchBuild(self, image_name, build, extensions, artifact_url):
+        '''
+        Fetch formats of a build from the builder which made it.
+
+        :param str image_name: Name of the diskimage.
+        :param ImageBuild build: The build to fetch.
+        :param set extensions: The formats to fetch.
+        :param str artifact_url: The URL of the builder's artifact server.
+
+        :returns: A list of DibImageFile objects for the local build.
+        '''
+        base = "-".join([image_name, build.id])
+        with self._upload_queue.fetchLock(image_name, build.id):
+            for ext in sorted(extensions):
+                filename = f'{base}.{ext}'
+                path = os.path.join(self._config.images_dir, filename)
+                if os.path.exists(path):
+                    continue
+                sha256 = build.checksums.get(ext, {}).get('sha256')
+                if not sha256:
+                    raise exceptions.BuilderError(
+                        f"No checksum recorded for {filename}")
+                self.log.info("Fetching %s from %s", filename, artifact_url)
+                start_time = time.monotonic()
+                fetchArtifact(artifact_url + filename, path, sha256)
+                self.log.info("Fetched %s in %.1f seconds", filename,
+                              time.monotonic() - start_time)
+        return DibImageFile.from_image_id(self._config.images_dir, base)
+
+    def _performUploads(self, pending):
+        '''
+        Upload a build to the providers which need it.
+
+        :param list pending: PendingUpload objects for one build.
+
+        :returns: True if any upload was attempted and succeeded,
+                  False otherwise.
+        '''
+        with contextlib.ExitStack() as stack:
+            claimed = []
+            for p in pending:
+                try:
+                    stack.enter_context(self._zk.imageUploadLock(
+                        p.image_name, p.build.id, p.provider.name,
+                        blocking=False))
+                except exceptions.ZKLockException:
+                    # Lock is already held. Skip it.
+                    continue
+                claimed.append(p)
+            if not claimed:
+                return False
 
+            fetch = [p for p in claimed if not p.local_images]
+            if fetch:
+                try:
+                    local_images = self._fetchBuild(
+                        fetch[0].image_name, fetch[0].build,
+                        set(p.provider.image_type for p in fetch),
+                        fetch[0].artifact_url)
+                except Exception:
+                    self.log.exception("Unable to fetch build %s of "
+                                       "image %s from %s:",
+                                       fetch[0].build.id,
+                                       fetch[0].image_name,
+                                       fetch[0].artifact_url)
+                    return False
+                for p in fetch:
+                    p.local_images = local_images
+
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=len(claimed)) as executor:
+                futures = [
+                    executor.submit(self._checkProviderImageUpload,
+                                    p.provider, p.image, p.build,
+                                    p.local_images)
+                    for p in claimed
+                ]
+            uploaded = False
+            for future, p in zip(futures, claimed):
+                try:
+                    uploaded = future.result() or uploaded
+                except Exception:
+                    self.log.exception("Error uploading image %s "
+                                       "to provider %s:",
+                                       p.image_name, p.provider.name)
+            return uploaded
+
+    def _needsProviderImageUpload(self, provider, image, build):
+        '''
+        Check whether a build should be uploaded to a provider.
+
+        :returns: True if the provider uses one of the formats of the
+                  build and has not yet received it.
+        '''
         # See if this image has already been uploaded
         upload = self._zk.getMostRecentBuildImageUploads(
             1, image.name, build.id, provider.name, zk.READY)
@@ -1371,27 +2354,44 @@ class UploadWorker(BaseWorker):
         # See if this provider supports the available image formats
         if provider.image_type not in build.formats:
             return False
+        return True
+
+    def _checkProviderImageUpload(self, provider, image, build,
+                                  local_images):
+        '''
+        Upload a build to a provider.  This is run concurrently for
+        each provider which needs the build so that exception handling
+        can treat all provider-image uploads indepedently.
 
+        The caller must hold the image upload lock.
+
+        :returns: True if an upload was attempted and succeeded,
+                  False otherwise.
+        '''
         try:
-            with self._zk.imageUploadLock(
-                image.name, build.id, provider.name,
-                blocking=False
-            ):
-                # Verify once more that it hasn't been uploaded since the
-                # last check.
-                upload = self._zk.getMostRecentBuildImageUploads(
-                    1, image.name, build.id, provider.name, zk.READY)
-                if upload:
-                    return False
+            # Verify once more that it hasn't been uploaded since the
+            # last check.
+            upload = self._zk.getMostRecentBuildImageUploads(
+                1, image.name, build.id, provider.name, zk.READY)
+            if upload:
+                return False
 
-                # NOTE: Due to the configuration file disagreement issue
-                # (the copy we have may not be current), we try to verify
-                # that another thread isn't trying to delete this build just
-                # before we upload.
-                b = self._zk.getBuild(image.name, build.id)
-                if not b or b.state == zk.DELETING:
-                    return False
+            # NOTE: Due to the configuration file disagreement issue
+            # (the copy we have may not be current), we try to verify
+            # that another thread isn't trying to delete this build just
+            # before we upload.
+            b = self._zk.getBuild(image.name, build.id)
+            if not b or b.state == zk.DELETING:
+                return False
 
+            resume_upload = self._claimResumableUpload(
+                image.name, build.id, provider.name)
+            if resume_upload:
+                upnum = resume_upload.id
+                self.log.info("Resuming upload %s of build %s of "
+                              "image %s to provider %s",
+                              upnum, build.id, image.name, provider.name)
+            else:
                 # New upload number with initial state 'uploading'
                 data = zk.ImageUpload()
                 data.state = zk.UPLOADING
@@ -1402,29 +2402,59 @@ class UploadWorker(BaseWorker):
                 upnum = self._zk.storeImageUpload(
                     image.name, build.id, provider.name, data)
 
-                self._image_status[image.name][provider.name] =\
-                    STATUS_UPLOADING
-                data = self._uploadImage(build.id, upnum, image.name,
-                                         local_images, provider,
-                                         build.username, build.python_path,
-                                         build.shell_type)
-
-                # Set final state
-                self._zk.storeImageUpload(image.name, build.id,
-                                          provider.name, data, upnum)
-                if data.state == zk.READY:
-                    return True
-                # If we return true after an error, we will get stuck
-                # in a loop where we retry this image repeatedly at
-                # the expense of other providers, so even if we tried,
-                # if we failed, return False.
-                return False
-        except exceptions.ZKLockException:
-            # Lock is already held. Skip it.
+            self._image_status[image.name][provider.name] =\
+                STATUS_UPLOADING
+            data = self._uploadImage(build.id, upnum, image.name,
+                                     local_images, provider,
+                                     build.username, build.python_path,
+                                     build.shell_type,
+                                     resume_upload=resume_upload,
+                                     checksums=build.checksums)
+
+            # Set final state
+            self._zk.storeImageUpload(image.name, build.id,
+                                      provider.name, data, upnum)
+            if data.state == zk.READY:
+                return True
+            # If we return true after an error, we will get stuck
+            # in a loop where we retry this image repeatedly at
+            # the expense of other providers, so even if we tried,
+            # if we failed, return False.
             return False
         finally:
             self._image_status[image.name][provider.name] = STATUS_IDLE
 
+    def _claimResumableUpload(self, image_name, build_id, provider_name):
+        '''
+        Find a failed upload of this build which saved its progress and
+        set it back to uploading so that it may be resumed.
+
+        The caller must hold the image upload lock.
+
+        :returns: The ImageUpload to resume, or None.
+        '''
+        uploads = self._zk.getMostRecentBuildImageUploads(
+            1, image_name, build_id, provider_name, zk.FAILED)
+        if not uploads or not uploads[0].resume_data:
+            return None
+        upload = uploads[0]
+        if time.time() - upload.state_time >= RESUMABLE_UPLOAD_AGE:
+            return None
+        try:
+            with self._zk.imageUploadNumberLock(upload, blocking=False):
+                # Make sure the cleanup worker hasn't started to
+                # delete it.
+                upload = self._zk.getImageUpload(
+                    image_name, build_id, provider_name, upload.id)
+                if not upload or upload.state != zk.FAILED:
+                    return None
+                upload.state = zk.UPLOADING
+                self._zk.storeImageUpload(image_name, build_id,
+                                          provider_name, upload, upload.id)
+                return upload
+        except exceptions.ZKLockException:
+            return None
+
     def run(self):
 
         '''
@@ -1453,6 +2483,70 @@ class UploadWorker(BaseWorker):
         provider_manager.ProviderManager.stopProviders(self._config)
 
 
+class ArtifactServer(threading.Thread):
+    '''
+    Serve the local image builds to other builders over HTTP.
+
+    Only the image files of builds and their checksum files are
+    served.  Range requests are supported so that other builders may
+    fetch a build in chunks and resume an interrupted fetch.
+
+    Build logs are served under ``/logs/<image>-<build-id>.log``,
+    decompressed if necessary.  The log of a running build is
+    streamed as it is written until the build ends.
+    '''
+    log = logging.getLogger("nodepool.builder.ArtifactServer")
+
+    def __init__(self, images_dir, port=0, listen_address='127.0.0.1',
+                 log_dir=None):
+        threading.Thread.__init__(self)
+        self.images_dir = images_dir
+        self.log_dir = log_dir
+        self.daemon = True
+        self.server = httpserver.serve(dec.wsgify(self.app),
+                                       host=listen_address,
+                                       port=port, start_loop=False)
+        # The port may have been chosen by the system
+        self.port = self.server.server_port
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.server_close()
+
+    def app(self, request):
+        if request.method not in ('GET', 'HEAD'):
+            raise webob.exc.HTTPMethodNotAllowed()
+        name = request.path_info.lstrip('/')
+        if name.startswith('logs/'):
+            return self._serveBuildLog(name[len('logs/'):])
+        if not ARTIFACT_NAME_RE.match(name):
+            raise webob.exc.HTTPNotFound()
+        path = os.path.join(self.images_dir, name)
+        if not os.path.isfile(path):
+            raise webob.exc.HTTPNotFound()
+        self.log.debug("Serving %s to %s", name, request.remote_addr)
+        return request.get_response(static.FileApp(path))
+
+    def _serveBuildLog(self, name):
+        if not (self.log_dir and BUILD_LOG_NAME_RE.match(name)):
+            raise webob.exc.HTTPNotFound()
+        with buildlog.BuildLog.active_lock:
+            active = buildlog.BuildLog.active.get(name[:-len('.log')])
+        if active:
+            app_iter = active.follow()
+        else:
+            path = os.path.join(self.log_dir, name)
+            if not os.path.isfile(path):
+                path += buildlog.COMPRESSED_SUFFIX
+            if not os.path.isfile(path):
+                raise webob.exc.HTTPNotFound()
+            app_iter = buildlog.readBuildLog(path)
+        return webob.Response(app_iter=app_iter,
+                              content_type='text/plain', charset='utf-8')
+
+
 class NodePoolBuilder(object):
     '''
     Main class for the Nodepool Builder.
@@ -1464,7 +2558,8 @@ class NodePoolBuilder(object):
     log = logging.getLogger("nodepool.builder.NodePoolBuilder")
 
     def __init__(self, config_path, secure_path=None,
-                 num_builders=1, num_uploaders=4):
+                 num_builders=1, num_uploaders=4, artifact_port=None,
+                 artifact_listen_address='127.0.0.1', artifact_host=None):
         '''
         Initialize the NodePoolBuilder object.
 
@@ -1472,6 +2567,15 @@ class NodePoolBuilder(object):
         :param str secure_path: Path to secure configuration file.
         :param int num_builders: Number of build workers to start.
         :param int num_uploaders: Number of upload workers to start.
+        :param int artifact_port: Port on which to serve image builds
+            to other builders (0 to choose any free port), or None to
+            not serve them.
+        :param str artifact_listen_address: Address on which to serve
+            image builds to other builders.  The server is not
+            authenticated, so it listens only on the loopback address
+            unless this is set.
+        :param str artifact_host: Host name under which other builders
+            reach this one; defaults to the fully qualified host name.
         '''
         self._config_path = config_path
         self._secure_path = secure_path
@@ -1481,6 +2585,10 @@ class NodePoolBuilder(object):
         self._num_uploaders = num_uploaders
         self._upload_workers = []
         self._janitor = None
+        self._artifact_port = artifact_port
+        self._artifact_listen_address = artifact_listen_address
+        self._artifact_host = artifact_host
+        self._artifact_server = None
         self._running = False
         self.cleanup_interval = 60
         self.build_interval = 10
@@ -1556,22 +2664,36 @@ class NodePoolBuilder(object):
             self.component_info = BuilderComponent(
                 self.zk_client, hostname,
                 version=get_version_string())
+            self.component_info.content['id'] = builder_id
+            if self._artifact_port is not None:
+                self._artifact_server = ArtifactServer(
+                    self._config.images_dir, self._artifact_port,
+                    self._artifact_listen_address,
+                    self._config.build_log_dir or DEFAULT_BUILD_LOG_DIR)
+                self._artifact_server.start()
+                artifact_host = self._artifact_host or socket.getfqdn()
+                self.component_info.content['artifact_url'] = (
+                    f'http://{artifact_host}:{self._artifact_server.port}/')
             self.component_info.register()
 
             self.log.debug('Starting listener for build jobs')
 
             # Create build and upload worker objects
+            build_queue = BuildQueue(self.zk)
             for i in range(self._num_builders):
                 w = BuildWorker(i, builder_id,
                                 self._config_path, self._secure_path,
-                                self.build_interval, self.zk)
+                                self.build_interval, self.zk,
+                                build_queue)
                 w.start()
                 self._build_workers.append(w)
 
+            upload_queue = UploadQueue(self.zk)
             for i in range(self._num_uploaders):
                 w = UploadWorker(i, builder_id,
                                  self._config_path, self._secure_path,
-                                 self.upload_interval, self.zk)
+                                 self.upload_interval, self.zk,
+                                 upload_queue)
                 w.start()
                 self._upload_workers.append(w)
 
@@ -1623,6 +2745,9 @@ class NodePoolBuilder(object):
         for worker in (workers):
             worker.join()
 
+        if self._artifact_server:
+            self._artifact_server.stop()
+
         self.log.debug('Stopping providers')
         provider_manager.ProviderManager.stopProviders(self._config)
 
@@ -0,0 +1,235 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Image build logs.
+
+Build logs may be compressed as they are written.  A compressed log
+is a series of gzip members, each ended after a certain amount of
+output or time, so that the file can be read with ``zcat`` at any
+point and only a short tail of the build output is ever unreadable.
+An index file alongside it records where each member starts so that
+a reader can start at any offset without decompressing the whole log.
+
+Clients may follow the log of a running build; they are sent what was
+already written and then each new chunk as the build produces it.
+"""
+
+import bisect
+import os
+import queue
+import threading
+import time
+import zlib
+
+COMPRESSED_SUFFIX = '.gz'
+INDEX_SUFFIX = '.idx'
+# How often a compressed log is made readable
+FLUSH_SIZE = 1024 * 1024
+FLUSH_INTERVAL = 10
+# How many chunks a slow follower may fall behind before it is dropped
+FOLLOW_QUEUE_SIZE = 4096
+READ_SIZE = 64 * 1024
+
+
+class BuildLog(object):
+    '''
+    The log of a running build.
+
+    :param str path: The path of the log file; if compress is set,
+        the compressed suffix is added.
+    :param bool compress: Whether to compress the log.
+    '''
+    # Logs of running builds, by file name without suffixes
+    active = {}
+    active_lock = threading.Lock()
+
+    def __init__(self, path, compress=False):
+        self.name = os.path.basename(path)
+        if self.name.endswith('.log'):
+            self.name = self.name[:-len('.log')]
+        if compress:
+            path += COMPRESSED_SUFFIX
+        self.path = path
+        self.compress = compress
+        self._lock = threading.Lock()
+        self._followers = []
+        self._closed = False
+        # The uncompressed size of the log, and how much of it can be
+        # read from the file.
+        self._size = 0
+        self._readable = 0
+        # What was written since the last flush of a compressed log
+        self._pending = bytearray()
+        self._flush_time = time.monotonic()
+        self._compressor = None
+        self._file = open(path, 'wb')
+        self._index = None
+        if compress:
+            self._index = open(path + INDEX_SUFFIX, 'w')
+            self._startMember()
+        with self.active_lock:
+            self.active[self.name] = self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, tb):
+        self.close()
+
+    def _startMember(self):
+        self._compressor = zlib.compressobj(wbits=31)
+        self._index.write('%d %d\n' % (self._size, self._file.tell()))
+        self._index.flush()
+
+    def write(self, data):
+        with self._lock:
+            if self.compress:
+                self._file.write(self._compressor.compress(data))
+                self._pending += data
+                self._size += len(data)
+                if (len(self._pending) >= FLUSH_SIZE or
+                    time.monotonic() - self._flush_time >= FLUSH_INTERVAL):
+                    self._flush()
+            else:
+                self._file.write(data)
+                self._file.flush()
+                self._size += len(data)
+                self._readable = self._size
+            for follower in self._followers[:]:
+                try:
+                    follower.put_nowait(data)
+                except queue.Full:
+                    self._followers.remove(follower)
+                    follower.dropped = True
+
+    def _flush(self):
+        # End the gzip member so that everything written so far is
+        # readable, and start a new one.
+        self._file.write(self._compressor.flush())
+        self._file.flush()
+        self._readable = self._size
+        self._pending = bytearray()
+        self._flush_time = time.monotonic()
+        self._startMember()
+
+    def close(self):
+        with self.active_lock:
+            self.active.pop(self.name, None)
+        with self._lock:
+            if self._closed:
+                return
+            if self.compress:
+                self._file.write(self._compressor.flush())
+                self._readable = self._size
+                self._pending = bytearray()
+                self._index.close()
+            self._file.close()
+            self._closed = True
+            for follower in self._followers:
+                follower.put(None)
+            self._followers = []
+
+    def follow(self):
+        '''
+        Iterate over the log as it is written, until the build ends.
+        '''
+        follower = queue.Queue(FOLLOW_QUEUE_SIZE)
+        follower.dropped = False
+        with self._lock:
+            readable = self._readable
+            pending = bytes(self._pending)
+            if self._closed:
+                follower.put(None)
+            else:
+                self._followers.append(follower)
+        try:
+            yield from readBuildLog(self.path, end=readable)
+            if pending:
+                yield pending
+            while not follower.dropped:
+                chunk = follower.get()
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            with self._lock:
+                if follower in self._followers:
+                    self._followers.remove(follower)
+
+
+def readBuildLogIndex(path):
+    '''
+    Read the index of a compressed build log.
+
+    :returns: A list of (uncompressed offset, compressed offset)
+        tuples, one for the start of each gzip member.
+    '''
+    index = []
+    try:
+        with open(path + INDEX_SUFFIX) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2:
+                    index.append((int(fields[0]), int(fields[1])))
+    except FileNotFoundError:
+        pass
+    return index or [(0, 0)]
+
+
+def readBuildLog(path, offset=0, end=None):
+    '''
+    Iterate over the uncompressed contents of a build log.
+
+    :param str path: The path of the log, compressed or not.
+    :param int offset: The uncompressed offset to start at.
+    :param int end: The uncompressed offset to stop at, or None to
+        read everything which can be read.
+    '''
+    with open(path, 'rb') as f:
+        if path.endswith(COMPRESSED_SUFFIX):
+            # Start at the gzip member containing the offset
+            index = readBuildLogIndex(path)
+            i = bisect.bisect_right([u for (u, c) in index], offset) - 1
+            position, start = index[max(i, 0)]
+            f.seek(start)
+            chunks = _readMembers(f)
+        else:
+            position = offset
+            f.seek(offset)
+            chunks = iter(lambda: f.read(READ_SIZE), b'')
+        for data in chunks:
+            if position < offset:
+                skip = min(offset - position, len(data))
+                position += skip
+                data = data[skip:]
+            if end is not None:
+                data = data[:max(end - position, 0)]
+            position += len(data)
+            if data:
+                yield data
+            if end is not None and position >= end:
+                return
+
+
+def _readMembers(f):
+    # Decompress consecutive gzip members; the last may be incomplete
+    # if the log is still being written.
+    decompressor = zlib.decompressobj(wbits=31)
+    for data in iter(lambda: f.read(READ_SIZE), b''):
+        while data:
+            out = decompressor.decompress(data)
+            if out:
+                yield out
+            if not decompressor.eof:
+                break
+            data = decompressor.unused_data
+            decompressor = zlib.decompressobj(wbits=31)
@@ -41,6 +41,18 @@ class NodePoolBuilderApp(nodepool.cmd.NodepoolDaemonApp):
         parser.add_argument('--upload-workers', dest='upload_workers',
                             default=4, help='number of upload workers',
                             type=int)
+        parser.add_argument('--artifact-port', dest='artifact_port',
+                            default=None, type=int,
+                            help='port on which to serve image builds '
+                            'to other builders')
+        parser.add_argument('--artifact-listen-address',
+                            dest='artifact_listen_address',
+                            default='127.0.0.1',
+                            help='address on which to serve image builds '
+                            'to other builders (default: 127.0.0.1)')
+        parser.add_argument('--artifact-host', dest='artifact_host',
+                            help='host name under which other builders '
+                            'reach this one')
         parser.add_argument('--repl', action='store_true',
                             help="Start a REPL on port 3000")
         return parser
@@ -55,7 +67,10 @@ class NodePoolBuilderApp(nodepool.cmd.NodepoolDaemonApp):
             self.config_file,
             secure_path=self.secure_file,
             num_builders=self.args.build_workers,
-            num_uploaders=self.args.upload_workers)
+            num_uploaders=self.args.upload_workers,
+            artifact_port=self.args.artifact_port,
+            artifact_listen_address=self.args.artifact_listen_address,
+            artifact_host=self.args.artifact_host)
 
         signal.signal(signal.SIGINT, self.sigint_handler)
 
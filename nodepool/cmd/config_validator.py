@@ -32,6 +32,8 @@ class ConfigValidator:
         label = {
             'name': str,
             'min-ready': int,
+            'min-ready-ceiling': int,
+            'min-ready-lead-time': int,
             'max-ready-age': int,
         }
 
@@ -57,6 +59,13 @@ class ConfigValidator:
         webapp = {
             'port': int,
             'listen_address': str,
+            'profiler': bool,
+        }
+
+        tracing = {
+            'endpoint': str,
+            'file': str,
+            'service-name': str,
         }
 
         zk_tls = dict(
@@ -75,10 +84,18 @@ class ConfigValidator:
 
         top_level = {
             'webapp': webapp,
+            'tracing': tracing,
             'elements-dir': str,
             'images-dir': str,
+            'images-dedup': bool,
             'build-log-dir': str,
             'build-log-retention': int,
+            'build-log-compress': bool,
+            'build-admission': {
+                'max-load': v.Any(int, float),
+                'max-io-pressure': v.Any(int, float),
+                'min-free-space': int,
+            },
             'zookeeper-servers': [{
                 'host': str,
                 'port': int,
@@ -51,6 +51,8 @@ class NodePoolCmd(NodepoolApp):
         cmd_list.set_defaults(func=self.list)
         cmd_list.add_argument('--detail', action='store_true',
                               help='Output detailed node info')
+        self._add_list_arguments(cmd_list, filters=('provider', 'label',
+                                                    'state'))
 
         cmd_image_list = subparsers.add_parser(
             'image-list', help='list images from providers')
@@ -60,6 +62,7 @@ class NodePoolCmd(NodepoolApp):
             'dib-image-list',
             help='list images built with diskimage-builder')
         cmd_dib_image_list.set_defaults(func=self.dib_image_list)
+        self._add_list_arguments(cmd_dib_image_list, filters=('state',))
 
         cmd_image_status = subparsers.add_parser(
             'image-status',
@@ -124,6 +127,9 @@ class NodePoolCmd(NodepoolApp):
             'request-list',
             help='list the current node requests')
         cmd_request_list.set_defaults(func=self.request_list)
+        self._add_list_arguments(cmd_request_list, filters=('provider',
+                                                            'label',
+                                                            'state'))
 
         cmd_info = subparsers.add_parser(
             'info',
@@ -179,6 +185,21 @@ class NodePoolCmd(NodepoolApp):
 
         return parser
 
+    def _add_list_arguments(self, parser, filters):
+        for name in filters:
+            parser.add_argument('--%s' % name,
+                                help='Only list entries with this %s' % name)
+        parser.add_argument('--json', action='store_true',
+                            help='Output one JSON object per line as '
+                                 'entries are read')
+
+    def _print_list(self, results, fields=None):
+        fmt = 'pretty'
+        if getattr(self.args, 'json', False):
+            fmt = 'json-lines'
+        for chunk in status.stream_output(results, fmt, fields):
+            print(chunk)
+
     def setup_logging(self):
         # NOTE(jamielennox): This should just be the same as other apps
         if self.args.debug:
@@ -208,12 +229,18 @@ class NodePoolCmd(NodepoolApp):
                            'username', 'connection_port', 'launcher',
                            'allocated_to', 'hold_job',
                            'comment', 'user_data', 'driver_data'])
-        results = status.node_list(self.zk, node_id)
-        print(status.output(results, 'pretty', fields))
+        results = status.node_list(self.zk, node_id,
+                                   provider=getattr(self.args, 'provider',
+                                                    None),
+                                   label=getattr(self.args, 'label', None),
+                                   state=getattr(self.args, 'state', None),
+                                   stream=True)
+        self._print_list(results, fields)
 
     def dib_image_list(self):
-        results = status.dib_image_list(self.zk)
-        print(status.output(results, 'pretty'))
+        results = status.dib_image_list(self.zk, state=self.args.state,
+                                        stream=True)
+        self._print_list(results)
 
     def image_status(self):
         results = status.image_status(self.zk)
@@ -410,8 +437,10 @@ class NodePoolCmd(NodepoolApp):
         # TODO(asselin,yolanda): add validation of secure.conf
 
     def request_list(self):
-        results = status.request_list(self.zk)
-        print(status.output(results, 'pretty'))
+        results = status.request_list(self.zk, provider=self.args.provider,
+                                      label=self.args.label,
+                                      state=self.args.state, stream=True)
+        self._print_list(results)
 
     def image_pause(self):
         image_name = self.args.image
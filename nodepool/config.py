@@ -14,8 +14,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
 import functools
+import hashlib
 import ipaddress
+import json
 import math
 import os
 import time
@@ -29,6 +32,15 @@ try:
 except ImportError:
     from yaml import SafeLoader
 
+# The parsed contents of each configuration file, by path, as
+# (content hash, data)
+_parsed_configs = {}
+
+
+def _digest(data):
+    return hashlib.sha256(json.dumps(
+        data, sort_keys=True, default=str).encode('utf8')).hexdigest()
+
 
 class ZooKeeperConnectionConfig(object):
     '''
@@ -109,13 +121,23 @@ class Config(ConfigValue):
         self.zookeeper_tls_ca = None
         self.elements_dir = None
         self.images_dir = None
+        self.images_dedup = False
         self.build_log_dir = None
         self.build_log_retention = None
+        self.build_log_compress = False
+        self.build_admission = None
         self.max_hold_age = None
         self.webapp = None
+        self.tracing = None
         self.tenant_resource_limits = {}
         # Last modified timestamps of loaded config files
         self.config_mtimes = {}
+        # The hash of the diskimages section
+        self.diskimages_source = None
+        # For each provider, the hash of its section and the
+        # diskimages section, its ProviderConfig and the (label, pool)
+        # pairs it added to the labels
+        self.provider_sources = {}
 
     def __eq__(self, other):
         if isinstance(other, Config):
@@ -127,10 +149,14 @@ class Config(ConfigValue):
                     self.zookeeper_timeout == other.zookeeper_timeout and
                     self.elements_dir == other.elements_dir and
                     self.images_dir == other.images_dir and
+                    self.images_dedup == other.images_dedup and
                     self.build_log_dir == other.build_log_dir and
                     self.build_log_retention == other.build_log_retention and
+                    self.build_log_compress == other.build_log_compress and
+                    self.build_admission == other.build_admission and
                     self.max_hold_age == other.max_hold_age and
                     self.webapp == other.webapp and
+                    self.tracing == other.tracing and
                     self.tenant_resource_limits == other.tenant_resource_limits
                     )
         return False
@@ -144,11 +170,24 @@ class Config(ConfigValue):
     def setImagesDir(self, value):
         self.images_dir = value
 
-    def setBuildLog(self, directory, retention):
+    def setImagesDedup(self, value):
+        self.images_dedup = bool(value)
+
+    def setBuildLog(self, directory, retention, compress=False):
         if retention is None:
             retention = 7
         self.build_log_dir = directory
         self.build_log_retention = retention
+        self.build_log_compress = bool(compress)
+
+    def setBuildAdmission(self, admission_cfg):
+        if admission_cfg is None:
+            admission_cfg = {}
+        self.build_admission = {
+            'max_load': admission_cfg.get('max-load', 1.0),
+            'max_io_pressure': admission_cfg.get('max-io-pressure', 50.0),
+            'min_free_space': admission_cfg.get('min-free-space', 0),
+        }
 
     def setMaxHoldAge(self, value):
         if value is None or value <= 0:
@@ -160,7 +199,18 @@ class Config(ConfigValue):
             webapp_cfg = {}
         self.webapp = {
             'port': webapp_cfg.get('port', 8005),
-            'listen_address': webapp_cfg.get('listen_address', '0.0.0.0')
+            'listen_address': webapp_cfg.get('listen_address', '0.0.0.0'),
+            'profiler': webapp_cfg.get('profiler', False),
+        }
+
+    def setTracing(self, tracing_cfg):
+        if not tracing_cfg:
+            return
+        self.tracing = {
+            'endpoint': tracing_cfg.get('endpoint'),
+            'file': tracing_cfg.get('file'),
+            'service-name': tracing_cfg.get('service-name',
+                                            'nodepool-launcher'),
         }
 
     def setZooKeeperTLS(self, zk_tls):
@@ -186,6 +236,7 @@ class Config(ConfigValue):
         self.zookeeper_timeout = float(timeout)
 
     def setDiskImages(self, diskimages_cfg):
+        self.diskimages_source = _digest(diskimages_cfg)
         if not diskimages_cfg:
             return
 
@@ -234,6 +285,10 @@ class Config(ConfigValue):
                                 (secure_config_path, diskimage['name']))
             self.diskimages[diskimage['name']].env_vars.update(
                 diskimage['env-vars'])
+        # Providers refer to the diskimages, so they are reloaded if
+        # the secure part changes too.
+        self.diskimages_source = _digest(
+            [self.diskimages_source, diskimages])
 
     def setLabels(self, labels_cfg):
         if not labels_cfg:
@@ -244,17 +299,53 @@ class Config(ConfigValue):
             l.name = label['name']
             l.max_ready_age = label.get('max-ready-age', 0)
             l.min_ready = label.get('min-ready', 0)
+            l.min_ready_ceiling = label.get('min-ready-ceiling', 0)
+            l.min_ready_lead_time = label.get('min-ready-lead-time', 300)
             l.pools = []
             self.labels[l.name] = l
 
-    def setProviders(self, providers_cfg):
+    def setProviders(self, providers_cfg, previous=None):
+        '''
+        Load the provider configurations.
+
+        A provider whose section, and the diskimages section it may
+        refer to, are the same as in the previous configuration keeps
+        its previous ProviderConfig rather than being loaded again.
+        Labels and diskimages must be set first.
+
+        :param list providers_cfg: The providers section.
+        :param Config previous: The previous configuration.
+        '''
         if not providers_cfg:
             return
 
         for provider in providers_cfg:
-            p = get_provider_config(provider)
-            p.load(self)
+            digest = _digest([provider, self.diskimages_source])
+            source = None
+            if previous:
+                source = previous.provider_sources.get(provider.get('name'))
+            if (source and source[0] == digest and
+                    previous.providers.get(source[1].name) is source[1]):
+                digest, p, links = source
+                for label, pool in links:
+                    self.labels[label].pools.append(pool)
+            else:
+                p, links = self._loadProvider(provider)
             self.providers[p.name] = p
+            self.provider_sources[p.name] = (digest, p, links)
+
+    def _loadProvider(self, provider):
+        # Load a provider, and find the pools it added to the labels
+        # so that they can be added again if the provider is reused.
+        counts = {name: len(label.pools)
+                  for name, label in self.labels.items()}
+        p = get_provider_config(provider)
+        p.load(self)
+        links = []
+        for name, label in self.labels.items():
+            for pool in label.pools[counts.get(name, 0):]:
+                links.append((name, pool))
+        return p, links
 
     def setTenantResourceLimits(self, tenant_resource_limits_cfg):
         if not tenant_resource_limits_cfg:
@@ -281,6 +372,8 @@ class Label(ConfigValue):
         self.name = None
         self.max_ready_age = None
         self.min_ready = None
+        self.min_ready_ceiling = None
+        self.min_ready_lead_time = None
         self.pools = None
 
     def __eq__(self, other):
@@ -288,6 +381,9 @@ class Label(ConfigValue):
             return (self.name == other.name and
                     self.max_ready_age == other.max_ready_age and
                     self.min_ready == other.min_ready and
+                    self.min_ready_ceiling == other.min_ready_ceiling and
+                    self.min_ready_lead_time ==
+                    other.min_ready_lead_time and
                     self.pools == other.pools)
         return False
 
@@ -418,6 +514,18 @@ def substitute_env_vars(config_str, env):
         config_str)
 
 
+def _parseConfig(path, content):
+    # The parsed content is cached by its hash, so that a file which
+    # was rewritten without changes is not parsed again.  Callers get
+    # a copy since loading the configuration may modify it.
+    digest = hashlib.sha256(content.encode('utf8')).hexdigest()
+    cached = _parsed_configs.get(path)
+    if cached is None or cached[0] != digest:
+        cached = (digest, yaml.load(content, SafeLoader))
+        _parsed_configs[path] = cached
+    return copy.deepcopy(cached[1])
+
+
 def openConfig(path, env):
     retry = 3
 
@@ -428,8 +536,8 @@ def openConfig(path, env):
     while True:
         try:
             with open(path) as f:
-                return yaml.load(
-                    substitute_env_vars(f.read(), env), SafeLoader)
+                return _parseConfig(
+                    path, substitute_env_vars(f.read(), env))
         except IOError as e:
             if e.errno == 2:
                 retry = retry - 1
@@ -440,30 +548,49 @@ def openConfig(path, env):
                 raise e
 
 
-def loadConfig(config_path, env=os.environ):
+def loadConfig(config_path, env=os.environ, previous=None,
+               secure_config_path=None):
+    '''
+    Load the configuration file.
+
+    :param str config_path: The path of the configuration file.
+    :param dict env: The environment variables to substitute.
+    :param Config previous: The current configuration, if any; the
+        providers which have not changed since it was loaded are
+        reused rather than loaded again.
+    :param str secure_config_path: The path of the secure
+        configuration file, if any.  It is loaded before the providers
+        so that they are reloaded if it changes the diskimages.
+    '''
     config_mtime = os.stat(config_path).st_mtime_ns
     config = openConfig(config_path, env)
 
     # Call driver config reset now to clean global hooks like openstacksdk
-    for driver in Drivers.drivers.values():
+    for driver in list(Drivers.drivers.values()):
         driver.reset()
 
     newconfig = Config()
 
     newconfig.setElementsDir(config.get('elements-dir'))
     newconfig.setImagesDir(config.get('images-dir'))
+    newconfig.setImagesDedup(config.get('images-dedup', False))
     newconfig.setBuildLog(config.get('build-log-dir'),
-                          config.get('build-log-retention'))
+                          config.get('build-log-retention'),
+                          config.get('build-log-compress', False))
+    newconfig.setBuildAdmission(config.get('build-admission'))
     newconfig.setMaxHoldAge(config.get('max-hold-age'))
     newconfig.setWebApp(config.get('webapp'))
+    newconfig.setTracing(config.get('tracing'))
     newconfig.setZooKeeperServers(config.get('zookeeper-servers'))
     newconfig.setZooKeeperTimeout(config.get('zookeeper-timeout', 10.0))
     newconfig.setDiskImages(config.get('diskimages'))
     newconfig.setLabels(config.get('labels'))
-    newconfig.setProviders(config.get('providers'))
     newconfig.setZooKeeperTLS(config.get('zookeeper-tls'))
     newconfig.setTenantResourceLimits(config.get('tenant-resource-limits'))
     newconfig.setConfigPathMtime(config_path, config_mtime)
+    if secure_config_path:
+        loadSecureConfig(newconfig, secure_config_path, env)
+    newconfig.setProviders(config.get('providers'), previous)
 
     return newconfig
 
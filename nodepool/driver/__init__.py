@@ -22,6 +22,7 @@ import importlib
 import logging
 import math
 import os
+import threading
 import voluptuous as v
 
 from nodepool.zk import zookeeper as zk
@@ -30,11 +31,20 @@ from nodepool.logconfig import get_annotated_logger
 
 
 class Drivers:
-    """The Drivers plugin interface"""
+    """The Drivers plugin interface
+
+    Loading the drivers only finds the driver directories and records
+    them in a manifest of driver names and paths.  A driver module,
+    and with it the libraries it uses, is imported the first time the
+    driver is requested, so that only the drivers of configured
+    providers are ever imported.
+    """
 
     log = logging.getLogger("nodepool.driver.Drivers")
     drivers = {}
+    manifest = {}
     drivers_paths = None
+    _lock = threading.Lock()
 
     @staticmethod
     def _load_class(driver_name, path, parent_class):
@@ -58,41 +68,47 @@ class Drivers:
 
     @staticmethod
     def load(drivers_paths=[]):
-        """Load drivers"""
-        if drivers_paths == Drivers.drivers_paths:
-            # Already loaded
-            return
-        Drivers.drivers.clear()
-        for drivers_path in drivers_paths + [os.path.dirname(__file__)]:
-            drivers = os.listdir(drivers_path)
-            for driver in drivers:
-                driver_path = os.path.join(drivers_path, driver)
-                if driver in Drivers.drivers:
-                    Drivers.log.warning("%s: duplicate driver", driver_path)
-                    continue
-                if not os.path.isdir(driver_path) or \
-                   "__init__.py" not in os.listdir(driver_path):
-                    continue
-                driver_obj = Drivers._load_class(
-                    driver, os.path.join(driver_path, "__init__.py"),
-                    Driver)
-                if not driver_obj:
-                    Drivers.log.error(
-                        "%s: skipping incorrect driver from __init__.py",
-                        driver_path)
-                    continue
-                Drivers.drivers[driver] = driver_obj()
+        """Find drivers"""
+        with Drivers._lock:
+            if drivers_paths == Drivers.drivers_paths:
+                # Already loaded
+                return
+            Drivers.drivers.clear()
+            Drivers.manifest.clear()
+            for drivers_path in drivers_paths + [os.path.dirname(__file__)]:
+                drivers = os.listdir(drivers_path)
+                for driver in drivers:
+                    driver_path = os.path.join(drivers_path, driver)
+                    init_path = os.path.join(driver_path, "__init__.py")
+                    if not os.path.isfile(init_path):
+                        continue
+                    if driver in Drivers.manifest:
+                        Drivers.log.warning("%s: duplicate driver",
+                                            driver_path)
+                        continue
+                    Drivers.manifest[driver] = init_path
 
-        Drivers.drivers_paths = drivers_paths
+            Drivers.drivers_paths = drivers_paths
 
     @staticmethod
     def get(name):
-        if not Drivers.drivers:
+        if Drivers.drivers_paths is None:
             Drivers.load()
-        try:
-            return Drivers.drivers[name]
-        except KeyError:
-            raise RuntimeError("%s: unknown driver" % name)
+        with Drivers._lock:
+            driver = Drivers.drivers.get(name)
+            if driver is not None:
+                return driver
+            path = Drivers.manifest.get(name)
+            if path is None:
+                raise RuntimeError("%s: unknown driver" % name)
+            driver_obj = Drivers._load_class(name, path, Driver)
+            if not driver_obj:
+                raise RuntimeError("%s: incorrect driver from %s" %
+                                   (name, path))
+            driver = driver_obj()
+            driver.reset()
+            Drivers.drivers[name] = driver
+            return driver
 
 
 class Driver(object, metaclass=abc.ABCMeta):
@@ -108,7 +124,8 @@ class Driver(object, metaclass=abc.ABCMeta):
 
     def reset(self):
         '''
-        Called before loading configuration to reset any global state
+        Called when the driver is loaded and before loading
+        configuration to reset any global state
         '''
         pass
 
@@ -387,6 +404,8 @@ class NodeRequestHandler(NodeRequestHandlerNotifications,
         self.done = False
         self.paused = False
         self.launcher_id = self.pw.launcher_id
+        self.tracer = self.pw.nodepool.tracer
+        self.timeline = self.tracer.request(request)
 
         self._satisfied_types = LabelRecorder()
         self._failed_nodes = []
@@ -408,6 +427,11 @@ class NodeRequestHandler(NodeRequestHandlerNotifications,
             "nodepool.driver.NodeRequestHandler[%s]" % self.launcher_id),
             event_id=self.request.event_id, node_request_id=self.request.id)
 
+    def _setPaused(self, paused):
+        if paused != self.paused:
+            self.timeline.mark('paused' if paused else 'unpaused')
+        self.paused = paused
+
     @property
     def failed_nodes(self):
         return self._failed_nodes
@@ -496,7 +520,7 @@ class NodeRequestHandler(NodeRequestHandlerNotifications,
                             continue
                         if self.paused:
                             self.log.debug("Unpaused request %s", self.request)
-                            self.paused = False
+                            self._setPaused(False)
 
                         self.log.debug(
                             "Locked existing node %s for request",
@@ -506,6 +530,7 @@ class NodeRequestHandler(NodeRequestHandlerNotifications,
                         node.tenant_name = self.request.tenant_name
                         node.requestor = self.request.requestor
                         self.zk.storeNode(node)
+                        self.timeline.node(node.id).mark('reused')
                         self.nodeset.append(node)
                         self._satisfied_types.add(ntype, node.id)
                         # Notify driver handler about node re-use
@@ -538,7 +563,7 @@ class NodeRequestHandler(NodeRequestHandlerNotifications,
                         if not self.paused:
                             self.log.debug(
                                 "Pausing request handling to satisfy request")
-                        self.paused = True
+                        self._setPaused(True)
                     else:
                         # Release the request so that we or another
                         # provider can try again when the label quota
@@ -548,7 +573,7 @@ class NodeRequestHandler(NodeRequestHandlerNotifications,
 
                 if self.paused:
                     self.log.debug("Unpaused request %s", self.request)
-                    self.paused = False
+                    self._setPaused(False)
 
                 node = zk.Node()
                 node.state = zk.INIT
@@ -570,6 +595,8 @@ class NodeRequestHandler(NodeRequestHandlerNotifications,
                 # *after* it is stored since nodes in INIT state are not
                 # locked anywhere.
                 self.zk.storeNode(node)
+                node_timeline = self.timeline.node(node.id)
+                node_timeline.mark('init')
                 self.zk.lockNode(node, blocking=False)
                 self.log.debug("Locked building node %s for request", node.id)
 
@@ -577,6 +604,7 @@ class NodeRequestHandler(NodeRequestHandlerNotifications,
                 # up (unlocked BUILDING nodes will be deleted).
                 node.state = zk.BUILDING
                 self.zk.storeNode(node)
+                node_timeline.mark('building')
 
                 self.nodeset.append(node)
                 self._satisfied_types.add(ntype, node.id)
@@ -641,8 +669,7 @@ class NodeRequestHandler(NodeRequestHandlerNotifications,
 
         # If conditions have changed for a paused request to now cause us
         # to decline it, we need to unpause so we don't keep trying it
-        if self.paused:
-            self.paused = False
+        self._setPaused(False)
 
         try:
             self.zk.storeNodeRequest(self.request)
@@ -651,6 +678,7 @@ class NodeRequestHandler(NodeRequestHandlerNotifications,
             # If the request is gone for some reason, we need to make
             # sure that self.done still gets set.
             self.log.exception("Unable to modify missing request")
+        self.tracer.finish(self.request.id, 'declined')
         self.done = True
 
     # ---------------------------------------------------------------
@@ -744,7 +772,7 @@ class NodeRequestHandler(NodeRequestHandlerNotifications,
 
         # If the request has been pulled, unallocate the node set so other
         # requests can use them.
-        if not self.zk.getNodeRequest(self.request.id):
+        if not self.zk.nodeRequestExists(self.request.id):
             self.log.info("Node request disappeared")
             self.unlockNodeSet(clear_allocation=True)
             try:
@@ -755,6 +783,7 @@ class NodeRequestHandler(NodeRequestHandlerNotifications,
                 # move on.
                 self.log.debug("Request lock invalid for node request "
                                "when attempting to clean up the lock")
+            self.tracer.finish(self.request.id, 'disappeared')
             return True
 
         if self.failed_nodes:
@@ -769,7 +798,7 @@ class NodeRequestHandler(NodeRequestHandlerNotifications,
                 self._satisfied_types.removeNode(node.id)
             self.log.debug(
                 "Pausing request handling after node abort to satisfy request")
-            self.paused = True
+            self._setPaused(True)
             return False
         else:
             # The assigned nodes must be added to the request in the order
@@ -784,6 +813,10 @@ class NodeRequestHandler(NodeRequestHandlerNotifications,
         self.unlockNodeSet()
         self.zk.storeNodeRequest(self.request)
         self.zk.unlockNodeRequest(self.request)
+        if self.request.state == zk.REQUESTED:
+            self.tracer.finish(self.request.id, 'declined')
+        else:
+            self.tracer.finish(self.request.id, self.request.state)
         return True
 
     # ---------------------------------------------------------------
@@ -19,7 +19,6 @@ from nodepool.driver.statemachine import StateMachineDriver
 # Import the modules rather than the class so that the unit tests can
 # override the classes to add some test-specific methods/data.
 import nodepool.driver.aws.config as driver_config
-import nodepool.driver.aws.adapter as driver_adapter
 
 
 class AwsDriver(StateMachineDriver):
@@ -27,4 +26,5 @@ class AwsDriver(StateMachineDriver):
         return driver_config.AwsProviderConfig(self, provider)
 
     def getAdapter(self, provider_config):
+        import nodepool.driver.aws.adapter as driver_adapter
         return driver_adapter.AwsAdapter(provider_config)
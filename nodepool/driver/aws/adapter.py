@@ -22,6 +22,7 @@ import hashlib
 import json
 import logging
 import math
+import os
 import queue
 import re
 import threading
@@ -33,7 +34,9 @@ from nodepool.driver.utils import (
     QuotaInformation,
     LazyExecutorTTLCache,
     RateLimiter,
+    BandwidthLimiter,
     ImageUploader,
+    SegmentReader,
 )
 from nodepool.driver import statemachine
 from nodepool import exceptions
@@ -219,6 +222,7 @@ SERVICE_QUOTA_CACHE_TTL = 300
 ON_DEMAND = 0
 SPOT = 1
 KIB = 1024
+MIB = 1024 ** 2
 GIB = 1024 ** 3
 
 
@@ -427,10 +431,26 @@ class AwsCreateStateMachine(statemachine.StateMachine):
 class EBSSnapshotUploader(ImageUploader):
     segment_size = 512 * KIB
 
-    def __init__(self, *args, **kw):
+    def __init__(self, *args, manifest=None, parent_snapshot_id=None,
+                 parent_manifest=None, **kw):
         super().__init__(*args, **kw)
         self.segment_count = 0
         self.size_in_gib = math.ceil(self.size / GIB)
+        # Block digests of this image and of the image in the parent
+        # snapshot; blocks which match the parent (or, without a
+        # parent, are zero) are not sent.
+        self.digests = None
+        self.parent_snapshot_id = None
+        self.parent_digests = None
+        if manifest:
+            self.digests = manifest.getDigests(self.segment_size)
+        if self.digests is not None and parent_snapshot_id:
+            self.parent_digests = parent_manifest.getDigests(
+                self.segment_size)
+            if self.parent_digests is not None:
+                self.parent_snapshot_id = parent_snapshot_id
+        self.zero_digest = hashlib.sha256(
+            bytes(self.segment_size)).digest()
 
     def shouldRetryException(self, exception):
         # Strictly speaking, ValidationException is only retryable
@@ -462,12 +482,15 @@ class EBSSnapshotUploader(ImageUploader):
         if len(data) < self.segment_size:
             # Add zeros if the last block is smaller since the
             # block size in AWS is constant.
-            data = data.ljust(self.segment_size, b'\0')
-        checksum = hashlib.sha256(data)
-        checksum_base64 = base64.b64encode(checksum.digest()).decode('utf-8')
+            data = bytes(data).ljust(self.segment_size, b'\0')
+        if self.digests is not None:
+            checksum = self.digests[segment.index]
+        else:
+            checksum = hashlib.sha256(data).digest()
+        checksum_base64 = base64.b64encode(checksum).decode('utf-8')
 
         response = self.retry(
-            self.adapter.ebs_client.put_snapshot_block,
+            self._putSnapshotBlock,
             SnapshotId=self.snapshot_id,
             BlockIndex=segment.index,
             BlockData=data,
@@ -480,17 +503,79 @@ class EBSSnapshotUploader(ImageUploader):
                             f"{response['Checksum']} expected {checksum}")
         self.segment_count += 1
 
+    def skipSegment(self, segment):
+        return self._isUnchanged(segment.index)
+
+    def _isUnchanged(self, index):
+        if self.digests is None:
+            return False
+        digest = self.digests[index]
+        if self.parent_snapshot_id is None:
+            # Blocks which are never written read as zeros
+            return digest == self.zero_digest
+        if index < len(self.parent_digests):
+            return digest == self.parent_digests[index]
+        # Past the end of the parent image, the parent volume (or the
+        # space by which this one is larger) is zero.
+        return digest == self.zero_digest
+
+    def _putSnapshotBlock(self, BlockData, **kw):
+        # Boto only accepts bytes or file-like objects; wrap the
+        # segment view so that it is streamed without a copy.  A new
+        # reader is used for every attempt.
+        return self.adapter.ebs_client.put_snapshot_block(
+            BlockData=SegmentReader(BlockData), **kw)
+
     def startUpload(self):
         # This is used by AWS to ensure idempotency across retries
         token = uuid4().hex
+        kw = {}
+        if self.parent_snapshot_id:
+            self.log.debug("Uploading changes from parent snapshot %s",
+                           self.parent_snapshot_id)
+            kw['ParentSnapshotId'] = self.parent_snapshot_id
         response = self.retry(
             self._rateLimited(self.adapter.ebs_client.start_snapshot),
             VolumeSize=self.size_in_gib,
             ClientToken=token,
             Tags=tag_dict_to_list(self.metadata),
+            **kw,
         )
         self.snapshot_id = response['SnapshotId']
 
+    def getResumeData(self):
+        snapshot_id = getattr(self, 'snapshot_id', None)
+        if snapshot_id is None:
+            return None
+        return {'snapshot_id': snapshot_id,
+                'parent_snapshot_id': self.parent_snapshot_id}
+
+    def resumeUpload(self, data):
+        # Blocks may be added to a snapshot until it is completed
+        # (or AWS times it out and it enters the error state).
+        snapshot_id = data['snapshot_id']
+        with self.adapter.rate_limiter:
+            response = self.adapter.ec2_client.describe_snapshots(
+                SnapshotIds=[snapshot_id])
+        snapshots = response.get('Snapshots', [])
+        if not snapshots:
+            return False
+        # The blocks which were skipped depend on the parent, so it
+        # must be the same one.
+        if (snapshots[0]['State'] != 'pending' or
+            data.get('parent_snapshot_id') != self.parent_snapshot_id):
+            self.log.info("Unable to resume upload to snapshot %s in "
+                          "state %s", snapshot_id, snapshots[0]['State'])
+            with self.adapter.rate_limiter:
+                self.adapter.ec2_client.delete_snapshot(
+                    SnapshotId=snapshot_id)
+            return False
+        self.snapshot_id = snapshot_id
+        self.segment_count = sum(
+            1 for index in range(self._segmentCount())
+            if index in self.completed and not self._isUnchanged(index))
+        return True
+
     def finishUpload(self):
         while True:
             response = self.retry(
@@ -519,6 +604,9 @@ class EBSSnapshotUploader(ImageUploader):
 
 class AwsAdapter(statemachine.Adapter):
     IMAGE_UPLOAD_SLEEP = 30
+    # Only the ebs-direct import method uses this
+    RESUMABLE_UPLOADS = True
+    INCREMENTAL_UPLOADS = True
     LAUNCH_TEMPLATE_PREFIX = 'nodepool-launch-template'
 
     def __init__(self, provider_config):
@@ -582,6 +670,10 @@ class AwsAdapter(statemachine.Adapter):
         # minutes.
         self.quota_service_rate_limiter = RateLimiter(self.provider.name,
                                                       self.provider.rate)
+        # Shared by all image uploads to this provider
+        self.upload_bandwidth_limiter = BandwidthLimiter(
+            self.provider.name,
+            (self.provider.image_upload_bandwidth or 0) * MIB)
         self.image_id_by_filter_cache = cachetools.TTLCache(
             maxsize=8192, ttl=(5 * 60))
         self.aws = boto3.Session(
@@ -868,7 +960,8 @@ class AwsAdapter(statemachine.Adapter):
         return quota
 
     def uploadImage(self, provider_image, image_name, filename,
-                    image_format, metadata, md5, sha256):
+                    image_format, metadata, md5, sha256, checkpoint=None,
+                    manifest=None, parent=None):
         self.log.debug(f"Uploading image {image_name}")
 
         # There is no IMDS support option for the import_image call
@@ -899,9 +992,16 @@ class AwsAdapter(statemachine.Adapter):
                 image_format, metadata, md5, sha256,
                 bucket_name, object_filename)
         elif provider_image.import_method == 'ebs-direct':
+            # Record how the image was made so that a later upload
+            # may check whether its snapshot can be used as a parent.
+            metadata = metadata.copy()
+            metadata['nodepool_import_method'] = 'ebs-direct'
+            metadata['nodepool_image_format'] = image_format
+            if sha256:
+                metadata['nodepool_image_sha256'] = sha256
             image_id = self._uploadImageSnapshotEBS(
                 provider_image, image_name, filename,
-                image_format, metadata)
+                image_format, metadata, checkpoint, manifest, parent)
         else:
             raise Exception("Unknown image import method")
         return image_id
@@ -943,10 +1043,21 @@ class AwsAdapter(statemachine.Adapter):
             return self.ec2_client.register_image(**args)
 
     def _uploadImageSnapshotEBS(self, provider_image, image_name, filename,
-                                image_format, metadata):
+                                image_format, metadata, checkpoint=None,
+                                manifest=None, parent=None):
+        parent_snapshot_id = None
+        if manifest and parent and image_format == 'raw':
+            parent_snapshot_id = self._getParentSnapshot(
+                parent, math.ceil(os.path.getsize(filename) / GIB))
         # Import snapshot
-        uploader = EBSSnapshotUploader(self, self.log, filename, image_name,
-                                       metadata)
+        uploader = EBSSnapshotUploader(
+            self, self.log, filename, image_name, metadata,
+            concurrency=self.provider.image_upload_concurrency,
+            checkpoint=checkpoint,
+            bandwidth_limiter=self.upload_bandwidth_limiter,
+            manifest=manifest,
+            parent_snapshot_id=parent_snapshot_id,
+            parent_manifest=parent and parent.manifest)
         self.log.debug(f"Importing {image_name} as EBS snapshot")
         volume_size, snapshot_id = uploader.upload(
             self.provider.image_import_timeout)
@@ -959,6 +1070,38 @@ class AwsAdapter(statemachine.Adapter):
                        f"{register_response['ImageId']}")
         return register_response['ImageId']
 
+    def _getParentSnapshot(self, parent, volume_size):
+        # Find the snapshot backing the parent image.  A snapshot can
+        # only be based on one no larger than itself.
+        try:
+            with self.non_mutating_rate_limiter:
+                response = self.ec2_client.describe_images(
+                    ImageIds=[parent.external_id])
+            for image in response.get('Images', []):
+                # Blocks are compared with the parent's local image
+                # file, so its snapshot must hold exactly that file.
+                # Other import methods convert the image.
+                tags = tag_list_to_dict(image.get('Tags'))
+                if (tags.get('nodepool_import_method') != 'ebs-direct' or
+                    tags.get('nodepool_image_format') != 'raw' or
+                    not parent.sha256 or
+                    tags.get('nodepool_image_sha256') != parent.sha256):
+                    self.log.info("Not using parent image %s which was "
+                                  "not uploaded directly from its raw "
+                                  "image file", parent.external_id)
+                    return None
+                for bdm in image.get('BlockDeviceMappings', []):
+                    ebs = bdm.get('Ebs', {})
+                    if not ebs.get('SnapshotId'):
+                        continue
+                    if ebs.get('VolumeSize', 0) > volume_size:
+                        return None
+                    return ebs['SnapshotId']
+        except Exception:
+            self.log.exception("Unable to find snapshot of parent image %s:",
+                               parent.external_id)
+        return None
+
     def _uploadImageSnapshot(self, provider_image, image_name, filename,
                              image_format, metadata, md5, sha256,
                              bucket_name, object_filename):
@@ -1133,6 +1276,15 @@ class AwsAdapter(statemachine.Adapter):
         for snapshot_id in snaps:
             self._deleteSnapshot(snapshot_id)
 
+    def abortImageUpload(self, image_name, checkpoint):
+        session = checkpoint.session
+        if not session:
+            return
+        # If the snapshot is still pending and can not be deleted
+        # yet, the cleanup worker will try again later.
+        self.log.debug(f"Deleting snapshot of partial upload {image_name}")
+        self._deleteSnapshot(session['snapshot_id'])
+
     # Local implementation below
 
     def _tagAmis(self):
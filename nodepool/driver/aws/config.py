@@ -326,6 +326,10 @@ class AwsProviderConfig(ProviderConfig):
         self.image_name_format = '{image_name}-{timestamp}'
         self.image_import_timeout = self.provider.get(
             'image-import-timeout', None)
+        self.image_upload_concurrency = self.provider.get(
+            'image-upload-concurrency', 10)
+        self.image_upload_bandwidth = self.provider.get(
+            'image-upload-bandwidth')
         self.post_upload_hook = self.provider.get('post-upload-hook')
         self.max_servers = self.provider.get('max-servers', math.inf)
         self.max_cores = self.provider.get('max-cores', math.inf)
@@ -376,6 +380,8 @@ class AwsProviderConfig(ProviderConfig):
             'object-storage': object_storage,
             'image-format': v.Any('ova', 'vhd', 'vhdx', 'vmdk', 'raw'),
             'image-import-timeout': int,
+            'image-upload-concurrency': int,
+            'image-upload-bandwidth': v.Any(int, float),
             'max-servers': int,
             'max-cores': int,
             'max-ram': int,
@@ -14,7 +14,6 @@
 
 from nodepool.driver.statemachine import StateMachineDriver
 from nodepool.driver.azure.config import AzureProviderConfig
-from nodepool.driver.azure.adapter import AzureAdapter
 
 
 class AzureDriver(StateMachineDriver):
@@ -22,4 +21,5 @@ class AzureDriver(StateMachineDriver):
         return AzureProviderConfig(self, provider)
 
     def getAdapter(self, provider_config):
+        from nodepool.driver.azure.adapter import AzureAdapter
         return AzureAdapter(provider_config)
@@ -24,6 +24,7 @@ import cachetools.func
 from nodepool.driver.utils import (
     QuotaInformation,
     RateLimiter,
+    BandwidthLimiter,
     ImageUploader,
 )
 from nodepool.driver import statemachine
@@ -242,6 +243,11 @@ class AzureSnapshotUploader(ImageUploader):
             self.url, start, end, data
         )
 
+    def skipSegment(self, segment):
+        # A newly created upload disk reads as zeros, so pages of
+        # zeros need not be written.
+        return segment.isZero()
+
     def startUpload(self):
         disk_info = {
             "location": self.adapter.provider.location,
@@ -263,7 +269,10 @@ class AzureSnapshotUploader(ImageUploader):
         if r['status'] != 'Succeeded':
             raise Exception("Unable to create disk for image upload")
         self.disk_id = r['properties']['output']['id']
+        self._beginWriteAccess()
+        self.log.debug("Uploading image")
 
+    def _beginWriteAccess(self):
         disk_grant = {
             "access": "Write",
             "durationInSeconds": 24 * 60 * 60,
@@ -278,7 +287,37 @@ class AzureSnapshotUploader(ImageUploader):
         if r['status'] != 'Succeeded':
             raise Exception("Unable to begin write access on disk")
         self.url = r['properties']['output']['accessSAS']
-        self.log.debug("Uploading image")
+
+    def getResumeData(self):
+        # The SAS URL grants write access to the disk, so it is not
+        # saved; a new one is requested when resuming.
+        disk_id = getattr(self, 'disk_id', None)
+        if disk_id is None:
+            return None
+        return {'disk_id': disk_id}
+
+    def resumeUpload(self, data):
+        # Pages may be written to the disk as long as it is still
+        # in the upload state.
+        try:
+            with self.adapter.rate_limiter:
+                disk = self.adapter.azul.disks.get(
+                    self.adapter.resource_group, self.image_name)
+        except azul.AzureNotFoundError:
+            return False
+        state = disk.get('properties', {}).get('diskState')
+        if state != 'ActiveUpload':
+            self.log.info("Unable to resume upload to disk %s in state %s",
+                          self.image_name, state)
+            # Remove the disk so that startUpload can create it anew
+            with self.adapter.rate_limiter:
+                r = self.adapter.azul.disks.delete(
+                    self.adapter.resource_group, self.image_name)
+            self.adapter.azul.wait_for_async_operation(r)
+            return False
+        self.disk_id = data['disk_id']
+        self._beginWriteAccess()
+        return True
 
     def finishUpload(self):
         disk_grant = {}
@@ -330,6 +369,7 @@ class AzureSnapshotUploader(ImageUploader):
 
 class AzureAdapter(statemachine.Adapter):
     log = logging.getLogger("nodepool.driver.azure.AzureAdapter")
+    RESUMABLE_UPLOADS = True
 
     def __init__(self, provider_config):
         # Wrap these instance methods with a per-instance LRU cache so
@@ -343,6 +383,10 @@ class AzureAdapter(statemachine.Adapter):
         self.resource_group_location = self.provider.resource_group_location
         self.rate_limiter = RateLimiter(self.provider.name,
                                         self.provider.rate)
+        # Shared by all image uploads to this provider
+        self.upload_bandwidth_limiter = BandwidthLimiter(
+            self.provider.name,
+            (self.provider.image_upload_bandwidth or 0) * MIB)
         with open(self.provider.auth_path) as f:
             self.azul = azul.AzureCloud(json.load(f))
         if provider_config.subnet_id:
@@ -429,11 +473,14 @@ class AzureAdapter(statemachine.Adapter):
         return quota_info_from_sku(sku)
 
     def uploadImage(self, provider_image, image_name, filename,
-                    image_format, metadata, md5, sha256):
+                    image_format, metadata, md5, sha256, checkpoint=None):
         self.log.debug(f"Uploading image {image_name}")
 
-        uploader = AzureSnapshotUploader(self, self.log, filename, image_name,
-                                         metadata)
+        uploader = AzureSnapshotUploader(
+            self, self.log, filename, image_name, metadata,
+            concurrency=self.provider.image_upload_concurrency,
+            checkpoint=checkpoint,
+            bandwidth_limiter=self.upload_bandwidth_limiter)
         uploader.upload()
 
         self.log.info(f"Uploaded image {image_name}")
@@ -449,6 +496,25 @@ class AzureAdapter(statemachine.Adapter):
         if r['status'] != 'Succeeded':
             raise Exception("Unable to delete image")
 
+    def abortImageUpload(self, image_name, checkpoint):
+        if not checkpoint.session:
+            return
+        self.log.debug(f"Deleting disk of partial upload {image_name}")
+        try:
+            with self.rate_limiter:
+                r = self.azul.disks.post(
+                    self.resource_group, image_name, 'endGetAccess', {})
+            self.azul.wait_for_async_operation(r)
+        except azul.AzureNotFoundError:
+            return
+        with self.rate_limiter:
+            r = self.azul.disks.delete(self.resource_group, image_name)
+        r = self.azul.wait_for_async_operation(r)
+
+        self.log.info(f"Deleted disk of partial upload {image_name}")
+        if r['status'] != 'Succeeded':
+            raise Exception("Unable to delete disk")
+
     # Local implementation below
 
     def _metadataMatches(self, obj, metadata):
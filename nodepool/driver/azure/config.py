@@ -286,6 +286,10 @@ class AzureProviderConfig(ProviderConfig):
         self.image_type = 'vhd'
         self.image_name_format = '{image_name}-{timestamp}'
         self.post_upload_hook = self.provider.get('post-upload-hook')
+        self.image_upload_concurrency = self.provider.get(
+            'image-upload-concurrency', 10)
+        self.image_upload_bandwidth = self.provider.get(
+            'image-upload-bandwidth')
 
         self.rate = self.provider.get('rate', 1)
         self.launch_retries = self.provider.get('launch-retries', 3)
@@ -359,6 +363,8 @@ class AzureProviderConfig(ProviderConfig):
             'use-internal-ip': bool,
             'host-key-checking': bool,
             'post-upload-hook': str,
+            'image-upload-concurrency': int,
+            'image-upload-bandwidth': v.Any(int, float),
             'rate': v.Coerce(float),
             'boot-timeout': int,
             'launch-timeout': int,
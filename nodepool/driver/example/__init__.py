@@ -16,7 +16,6 @@
 
 from nodepool.driver.statemachine import StateMachineDriver
 from nodepool.driver.example.config import ExampleProviderConfig
-from nodepool.driver.example.adapter import Adapter
 
 
 class ExampleDriver(StateMachineDriver):
@@ -24,4 +23,5 @@ class ExampleDriver(StateMachineDriver):
         return ExampleProviderConfig(self, provider)
 
     def getAdapter(self, provider_config):
+        from nodepool.driver.example.adapter import Adapter
         return Adapter(provider_config)
@@ -12,23 +12,18 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-from openstack.config import loader
-
 from nodepool.driver.statemachine import StateMachineDriver
 from nodepool.driver.fake.config import FakeProviderConfig
-from nodepool.driver.fake.adapter import FakeAdapter
 
 
 class FakeDriver(StateMachineDriver):
     def reset(self):
+        from openstack.config import loader
         self.openstack_config = loader.OpenStackConfig()
 
-    def __init__(self):
-        self.reset()
-        super().__init__()
-
     def getProviderConfig(self, provider):
         return FakeProviderConfig(self, provider)
 
     def getAdapter(self, provider_config):
+        from nodepool.driver.fake.adapter import FakeAdapter
         return FakeAdapter(provider_config)
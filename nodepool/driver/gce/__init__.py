@@ -17,7 +17,6 @@
 
 from nodepool.driver.statemachine import StateMachineDriver
 from nodepool.driver.gce.config import GceProviderConfig
-from nodepool.driver.gce.adapter import GceAdapter
 
 
 class GceDriver(StateMachineDriver):
@@ -25,4 +24,5 @@ class GceDriver(StateMachineDriver):
         return GceProviderConfig(self, provider)
 
     def getAdapter(self, provider_config):
+        from nodepool.driver.gce.adapter import GceAdapter
         return GceAdapter(provider_config)
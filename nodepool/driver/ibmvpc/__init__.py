@@ -14,7 +14,6 @@
 
 from nodepool.driver.statemachine import StateMachineDriver
 from nodepool.driver.ibmvpc.config import IBMVPCProviderConfig
-from nodepool.driver.ibmvpc.adapter import IBMVPCAdapter
 
 
 class IBMVPCDriver(StateMachineDriver):
@@ -22,4 +21,5 @@ class IBMVPCDriver(StateMachineDriver):
         return IBMVPCProviderConfig(self, provider)
 
     def getAdapter(self, provider_config):
+        from nodepool.driver.ibmvpc.adapter import IBMVPCAdapter
         return IBMVPCAdapter(provider_config)
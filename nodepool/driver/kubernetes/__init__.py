@@ -14,14 +14,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from kubernetes import config as k8s_config
 from nodepool.driver import Driver
 from nodepool.driver.kubernetes.config import KubernetesProviderConfig
-from nodepool.driver.kubernetes.provider import KubernetesProvider
 
 
 class KubernetesDriver(Driver):
     def reset(self):
+        from kubernetes import config as k8s_config
         try:
             k8s_config.load_kube_config(persist_config=True)
         except k8s_config.config_exception.ConfigException as e:
@@ -36,4 +35,5 @@ class KubernetesDriver(Driver):
         return KubernetesProviderConfig(self, provider)
 
     def getProvider(self, provider_config):
+        from nodepool.driver.kubernetes.provider import KubernetesProvider
         return KubernetesProvider(provider_config)
@@ -15,7 +15,6 @@
 from nodepool.driver.statemachine import StateMachineDriver
 from nodepool.driver.statemachine import StateMachineProvider
 from nodepool.driver.metastatic.config import MetastaticProviderConfig
-from nodepool.driver.metastatic.adapter import MetastaticAdapter
 
 
 class MetastaticDriver(StateMachineDriver):
@@ -33,4 +32,5 @@ class MetastaticDriver(StateMachineDriver):
         return MetastaticProviderConfig(self, provider)
 
     def getAdapter(self, provider_config):
+        from nodepool.driver.metastatic.adapter import MetastaticAdapter
         return MetastaticAdapter(provider_config)
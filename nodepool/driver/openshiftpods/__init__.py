@@ -14,10 +14,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from kubernetes import config as k8s_config
 from nodepool.driver import Driver
 from nodepool.driver.openshiftpods.config import OpenshiftPodsProviderConfig
-from nodepool.driver.openshiftpods.provider import OpenshiftPodsProvider
 
 
 class OpenshiftPodsDriver(Driver):
@@ -25,6 +23,7 @@ class OpenshiftPodsDriver(Driver):
         super().__init__()
 
     def reset(self):
+        from kubernetes import config as k8s_config
         try:
             k8s_config.load_kube_config(persist_config=True)
         except k8s_config.config_exception.ConfigException as e:
@@ -39,4 +38,5 @@ class OpenshiftPodsDriver(Driver):
         return OpenshiftPodsProviderConfig(self, provider)
 
     def getProvider(self, provider_config):
-        return OpenshiftPodsProvider(provider_config)
+        from nodepool.driver.openshiftpods import provider
+        return provider.OpenshiftPodsProvider(provider_config)
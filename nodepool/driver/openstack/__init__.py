@@ -12,23 +12,18 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-from openstack.config import loader
-
 from nodepool.driver.statemachine import StateMachineDriver
 from nodepool.driver.openstack.config import OpenStackProviderConfig
-from nodepool.driver.openstack.adapter import OpenStackAdapter
 
 
 class OpenStackDriver(StateMachineDriver):
     def reset(self):
+        from openstack.config import loader
         self.openstack_config = loader.OpenStackConfig()
 
-    def __init__(self):
-        self.reset()
-        super().__init__()
-
     def getProviderConfig(self, provider):
         return OpenStackProviderConfig(self, provider)
 
     def getAdapter(self, provider_config):
+        from nodepool.driver.openstack.adapter import OpenStackAdapter
         return OpenStackAdapter(provider_config)
@@ -28,9 +28,11 @@ import time
 
 from nodepool.driver import Driver, NodeRequestHandler, Provider
 from nodepool.driver.utils import QuotaInformation, QuotaSupport
+from nodepool.driver.utils import UploadCheckpoint
 from nodepool.logconfig import get_annotated_logger
 from nodepool import stats
 from nodepool import exceptions
+from nodepool import nodeutils
 from nodepool.zk import zookeeper as zk
 
 from kazoo import exceptions as kze
@@ -63,6 +65,7 @@ class StateMachineNodeLauncher(stats.StatsReporter):
         self.zk = handler.zk
         self.node = node
         self.provider_config = provider_config
+        self.timeline = handler.timeline.node(node.id)
         # Local additions:
         self.start_future = None
         self.manager = handler.manager
@@ -92,6 +95,7 @@ class StateMachineNodeLauncher(stats.StatsReporter):
         else:
             # On subsequent attempts, run this synchronously since
             # we're out of the _assignHandlers thread.
+            self.timeline.mark('retry')
             self.startStateMachine()
 
     def startStateMachine(self):
@@ -140,6 +144,7 @@ class StateMachineNodeLauncher(stats.StatsReporter):
         self.state_machine = self.manager.adapter.getCreateStateMachine(
             hostname, label, image_external_id, metadata,
             self.handler.request, self.handler.chosen_az, self.log)
+        self.timeline.mark('started')
 
     def updateNodeFromInstance(self, instance):
         if instance is None:
@@ -208,7 +213,10 @@ class StateMachineNodeLauncher(stats.StatsReporter):
         try:
             if state_machine.external_id:
                 old_state = state_machine.state
-                state_machine.advance()
+                with stats.ADAPTER_CALL_SECONDS.time(
+                        provider=self.manager.provider.name,
+                        method='deleteStateMachine.advance'):
+                    state_machine.advance()
                 if state_machine.state != old_state:
                     self.log.debug(
                         "Launch-delete state machine for %s advanced "
@@ -253,6 +261,7 @@ class StateMachineNodeLauncher(stats.StatsReporter):
                 self.start_time = time.monotonic()
             if (state_machine.complete and self.nodescan_request
                 and self.nodescan_request.complete):
+                self.timeline.mark('nodescan-end')
                 try:
                     keys = self.nodescan_request.result()
                     dt = int(time.monotonic() -
@@ -270,6 +279,7 @@ class StateMachineNodeLauncher(stats.StatsReporter):
                 self.log.debug(f"Node {node.id} is ready")
                 node.state = zk.READY
                 self.zk.storeNode(node)
+                self.timeline.mark('ready')
                 try:
                     dt = int((time.monotonic() - self.start_time) * 1000)
                     self.recordLaunchStats(statsd_key, dt)
@@ -287,7 +297,10 @@ class StateMachineNodeLauncher(stats.StatsReporter):
                 return
 
             old_state = state_machine.state
-            instance = state_machine.advance()
+            with stats.ADAPTER_CALL_SECONDS.time(
+                    provider=self.manager.provider.name,
+                    method='createStateMachine.advance'):
+                instance = state_machine.advance()
             if state_machine.state != old_state:
                 self.log.debug("State machine for %s advanced from %s to %s",
                                node.id, old_state, state_machine.state)
@@ -295,15 +308,25 @@ class StateMachineNodeLauncher(stats.StatsReporter):
                 node.external_id = state_machine.external_id
                 self.zk.storeNode(node)
             if state_machine.complete and not self.nodescan_request:
+                self.timeline.mark('created')
                 self.updateNodeFromInstance(instance)
                 self.log.debug("Submitting nodescan request for %s",
                                node.interface_ip)
                 label = self.handler.pool.labels[self.node.type[0]]
+                # Nodes which already know their host keys (such as
+                # metastatic nodes on a long-lived backing node) may
+                # use cached keys rather than rescanning.
+                if node.host_keys:
+                    host_key_cache = self.manager.host_key_cache
+                else:
+                    host_key_cache = None
                 self.nodescan_request = NodescanRequest(
                     node,
                     label.host_key_checking,
-                    self.manager.provider.boot_timeout)
+                    self.manager.provider.boot_timeout,
+                    host_key_cache=host_key_cache)
                 self.manager.nodescan_worker.addRequest(self.nodescan_request)
+                self.timeline.mark('nodescan-start')
         except kze.SessionExpiredError:
             # Our node lock is gone, leaving the node state as BUILDING.
             # This will get cleaned up in ZooKeeper automatically, but we
@@ -393,6 +416,7 @@ class StateMachineNodeLauncher(stats.StatsReporter):
                 return
 
         if node.state != zk.BUILDING:
+            self.timeline.mark(node.state)
             try:
                 dt = int((time.monotonic() - self.start_time) * 1000)
                 self.recordLaunchStats(statsd_key, dt)
@@ -453,7 +477,10 @@ class StateMachineNodeDeleter:
 
             if node.external_id:
                 old_state = state_machine.state
-                state_machine.advance()
+                with stats.ADAPTER_CALL_SECONDS.time(
+                        provider=self.manager.provider.name,
+                        method='deleteStateMachine.advance'):
+                    state_machine.advance()
                 if state_machine.state != old_state:
                     self.log.debug("State machine for %s advanced "
                                    "from %s to %s",
@@ -684,6 +711,7 @@ class StateMachineProvider(Provider, QuotaSupport):
         self.launchers = []
         self._zk = None
         self.nodescan_worker = NodescanWorker()
+        self.host_key_cache = nodeutils.HostKeyCache()
         self.create_state_machine_thread = None
         self.delete_state_machine_thread = None
         self.start_machine_start_worker = None
@@ -704,10 +732,12 @@ class StateMachineProvider(Provider, QuotaSupport):
         self.nodescan_worker.start()
         self.create_state_machine_thread = threading.Thread(
             target=self._runCreateStateMachines,
+            name=f'StateMachineProvider.create-{self.provider.name}',
             daemon=True)
         self.create_state_machine_thread.start()
         self.delete_state_machine_thread = threading.Thread(
             target=self._runDeleteStateMachines,
+            name=f'StateMachineProvider.delete-{self.provider.name}',
             daemon=True)
         self.delete_state_machine_thread.start()
         # This is mostly ZK operations so we don't expect to need as
@@ -799,9 +829,14 @@ class StateMachineProvider(Provider, QuotaSupport):
     def labelReady(self, label):
         return self.adapter.labelReady(label)
 
+    def _timeAdapter(self, method):
+        return stats.ADAPTER_CALL_SECONDS.time(
+            provider=self.provider.name, method=method)
+
     def getProviderLimits(self):
         try:
-            return self.adapter.getQuotaLimits()
+            with self._timeAdapter('getQuotaLimits'):
+                return self.adapter.getQuotaLimits()
         except NotImplementedError:
             return QuotaInformation(
                 cores=math.inf,
@@ -815,7 +850,8 @@ class StateMachineProvider(Provider, QuotaSupport):
         if qi is not None:
             return qi
         try:
-            qi = self.adapter.getQuotaForLabel(provider_label)
+            with self._timeAdapter('getQuotaForLabel'):
+                qi = self.adapter.getQuotaForLabel(provider_label)
             self.log.debug("Quota required for %s: %s",
                            provider_label.name, qi)
         except exceptions.RuntimeConfigurationException as e:
@@ -843,7 +879,9 @@ class StateMachineProvider(Provider, QuotaSupport):
 
         node_ids = set([n.id for n in self._zk.nodeIterator(cached_ids=True)])
 
-        for instance in self.adapter.listInstances():
+        with self._timeAdapter('listInstances'):
+            instances = list(self.adapter.listInstances())
+        for instance in instances:
             meta = instance.metadata
             nodepool_provider_name = meta.get('nodepool_provider_name')
             if (nodepool_provider_name and
@@ -897,7 +935,9 @@ class StateMachineProvider(Provider, QuotaSupport):
 
         newly_leaked_nodes = {}
         newly_leaked_uploads = {}
-        for resource in self.adapter.listResources():
+        with self._timeAdapter('listResources'):
+            resources = list(self.adapter.listResources())
+        for resource in resources:
             pn = resource.metadata.get('nodepool_provider_name')
             if pn != self.provider.name:
                 continue
@@ -946,17 +986,33 @@ class StateMachineProvider(Provider, QuotaSupport):
     # Image handling
 
     def uploadImage(self, provider_image, image_name, filename,
-                    image_type=None, meta=None, md5=None, sha256=None):
+                    image_type=None, meta=None, md5=None, sha256=None,
+                    checkpoint=None, manifest=None, parent=None):
         meta = meta.copy()
         meta['nodepool_provider_name'] = self.provider.name
-        return self.adapter.uploadImage(provider_image, image_name,
-                                        filename,
-                                        image_format=image_type,
-                                        metadata=meta, md5=md5,
-                                        sha256=sha256)
+        kw = {}
+        if checkpoint is not None and self.adapter.RESUMABLE_UPLOADS:
+            kw['checkpoint'] = checkpoint
+        if self.adapter.INCREMENTAL_UPLOADS:
+            kw['manifest'] = manifest
+            kw['parent'] = parent
+        with self._timeAdapter('uploadImage'):
+            return self.adapter.uploadImage(provider_image, image_name,
+                                            filename,
+                                            image_format=image_type,
+                                            metadata=meta, md5=md5,
+                                            sha256=sha256, **kw)
 
     def deleteImage(self, name, id):
-        return self.adapter.deleteImage(external_id=id)
+        with self._timeAdapter('deleteImage'):
+            return self.adapter.deleteImage(external_id=id)
+
+    def abortImageUpload(self, name, resume_data):
+        if not self.adapter.RESUMABLE_UPLOADS:
+            return
+        with self._timeAdapter('abortImageUpload'):
+            return self.adapter.abortImageUpload(
+                name, UploadCheckpoint(resume_data))
 
 
 # Driver implementation
@@ -1154,7 +1210,8 @@ class NodescanWorker:
 
     def start(self):
         self._running = True
-        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread = threading.Thread(target=self.run,
+                                       name='NodescanWorker', daemon=True)
         self.thread.start()
 
     def stop(self):
@@ -1266,7 +1323,8 @@ class NodescanRequest:
     # For unit testing
     FAKE = False
 
-    def __init__(self, node, host_key_checking, timeout):
+    def __init__(self, node, host_key_checking, timeout,
+                 host_key_cache=None):
         self.state = self.START
         self.iteration = 'init'
         self.node = node
@@ -1295,6 +1353,11 @@ class NodescanRequest:
         self.worker = None
         self.exception = None
         self.connect_start_time = None
+        # If supplied, the node already carries the host keys we
+        # expect (e.g. from a metastatic backing node) and fresh
+        # matching keys in the cache let us skip the key exchange.
+        self.host_key_cache = host_key_cache
+        self.used_cached_keys = False
 
         logger = logging.getLogger("nodepool.NodescanRequest")
         self.log = get_annotated_logger(logger,
@@ -1398,6 +1461,17 @@ class NodescanRequest:
             if not self.host_key_checking:
                 self.state = self.COMPLETE
             else:
+                if (self.host_key_cache is not None and
+                    self.gather_hostkeys and not self.used_cached_keys):
+                    keys = self.host_key_cache.validate(
+                        self.ip, self.port, self.node.host_keys)
+                    if keys is not None:
+                        self.log.debug("Using cached host keys for %s",
+                                       self.ip)
+                        self.keys = keys
+                        self.used_cached_keys = True
+                        # Only check that the host is reachable
+                        self.gather_hostkeys = False
                 if 'fake' in self.ip or self.FAKE:
                     if self.gather_hostkeys:
                         self.keys = ['ssh-rsa FAKEKEY']
@@ -1499,6 +1573,9 @@ class NodescanRequest:
 
         if self.state == self.COMPLETE:
             self._close()
+            if (self.host_key_cache is not None and self.keys and
+                not self.used_cached_keys):
+                self.host_key_cache.put(self.ip, self.port, self.keys)
             self.complete = True
 
 
@@ -1515,6 +1592,13 @@ class Adapter:
         representing the provider.
 
     """
+    # Set to True if uploadImage accepts a checkpoint argument and
+    # can resume interrupted uploads.
+    RESUMABLE_UPLOADS = False
+    # Set to True if uploadImage accepts manifest and parent arguments
+    # and can upload only the blocks which differ from the parent.
+    INCREMENTAL_UPLOADS = False
+
     def __init__(self, provider_config):
         pass
 
@@ -1670,6 +1754,16 @@ class Adapter:
             stored on the image in the cloud.
         :param md5 str: The md5 hash of the image file
         :param sha256 str: The sha256 hash of the image file
+        :param checkpoint UploadCheckpoint: Only supplied if
+            RESUMABLE_UPLOADS is set; the progress of a previous
+            attempt at this upload, and a place to save progress
+            should this attempt fail.
+        :param manifest BlockManifest: Only supplied if
+            INCREMENTAL_UPLOADS is set; the block digests of the
+            image file.
+        :param parent ParentImage: Only supplied if
+            INCREMENTAL_UPLOADS is set; the most recent upload of an
+            earlier build of this image to this provider, or None.
 
         :return: The external id of the image in the cloud
         """
@@ -1682,6 +1776,17 @@ class Adapter:
         """
         raise NotImplementedError()
 
+    def abortImageUpload(self, image_name, checkpoint):
+        """Delete the partial upload of an image which will not be resumed
+
+        This must be implemented if RESUMABLE_UPLOADS is set.
+
+        :param image_name str: The name of the image
+        :param checkpoint UploadCheckpoint: The progress saved by the
+            failed upload.
+        """
+        raise NotImplementedError()
+
     # The following methods are optional
     def getConsoleLog(self, label, external_id):
         """Return the console log from the specified server
@@ -59,6 +59,9 @@ class StaticNodeProvider(Provider, QuotaSupport):
         # multiple threads (e.g. cleanup and deleted node worker).
         self._register_lock = threading.Lock()
         self._node_slots = {}  # nodeTuple -> [node]
+        # Host keys of static nodes rarely change; avoid a full key
+        # exchange every time we check a node.
+        self._host_key_cache = nodeutils.HostKeyCache()
         # Flag to indicates we need to stop processing state that could
         # interfere with a newer versions of ourselves running.
         self._idle = False
@@ -75,7 +78,9 @@ class StaticNodeProvider(Provider, QuotaSupport):
             keys = nodeutils.nodescan(static_node["name"],
                                       port=static_node["connection-port"],
                                       timeout=static_node["timeout"],
-                                      gather_hostkeys=gather_hostkeys)
+                                      gather_hostkeys=gather_hostkeys,
+                                      host_key_cache=self._host_key_cache,
+                                      expected_keys=static_node["host-key"])
         except exceptions.ConnectionTimeoutException:
             raise StaticNodeError(
                 "{}: ConnectionTimeoutException".format(
@@ -123,6 +128,15 @@ class StaticNodeProvider(Provider, QuotaSupport):
             return True
 
         try:
+            # If we have fresh host keys for the node, make sure they
+            # still match what the node was registered with.
+            cached_keys = self._host_key_cache.get(
+                static_node["name"], static_node["connection-port"])
+            if (cached_keys is not None and
+                not set(node.host_keys).issubset(set(cached_keys))):
+                raise StaticNodeError(
+                    "{}: host key mismatches ({})".format(
+                        node_tuple, cached_keys))
             nodeutils.nodescan(static_node["name"],
                                port=static_node["connection-port"],
                                timeout=static_node["timeout"],
@@ -131,6 +145,8 @@ class StaticNodeProvider(Provider, QuotaSupport):
         except Exception as exc:
             self.log.warning("Failed to connect to node %s: %s",
                              node_tuple, exc)
+            self._host_key_cache.invalidate(
+                static_node["name"], static_node["connection-port"])
 
         try:
             self.deregisterNode(node)
@@ -16,11 +16,18 @@
 # limitations under the License.
 
 import abc
+import bisect
 import concurrent.futures
 import copy
+import errno
+import functools
+import hashlib
+import io
 import logging
 import math
+import mmap
 import os
+import tempfile
 import threading
 import time
 from collections import defaultdict
@@ -65,6 +72,7 @@ class NodeLauncher(threading.Thread,
         self.zk = handler.zk
         self.node = node
         self.provider_config = provider_config
+        self.timeline = handler.timeline.node(node.id)
 
     @abc.abstractmethod
     def launch(self):
@@ -75,7 +83,9 @@ class NodeLauncher(threading.Thread,
         statsd_key = 'ready'
 
         try:
+            self.timeline.mark('started')
             self.launch()
+            self.timeline.mark('created')
         except kze.SessionExpiredError:
             # Our node lock is gone, leaving the node state as BUILDING.
             # This will get cleaned up in ZooKeeper automatically, but we
@@ -111,6 +121,7 @@ class NodeLauncher(threading.Thread,
             else:
                 statsd_key = 'error.unknown'
 
+        self.timeline.mark(self.node.state)
         try:
             dt = int((time.monotonic() - start_time) * 1000)
             self.recordLaunchStats(statsd_key, dt)
@@ -478,6 +489,37 @@ class RateLimiter:
         pass
 
 
+class BandwidthLimiter:
+    """Limit the rate at which data is sent
+
+    Each caller reserves the time its data would take at the limit
+    and waits until its reservation begins, so concurrent senders
+    share the bandwidth.
+
+    :param str name: The provider name; used in logging.
+    :param float rate: The limit in bytes per second, or None for
+        no limit.
+    """
+
+    def __init__(self, name, rate):
+        self.name = name
+        self.rate = rate
+        self.next_ts = None
+        self.lock = threading.Lock()
+
+    def consume(self, count):
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_ts or now)
+            self.next_ts = start + count / self.rate
+        delay = start - now
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
 class LazyExecutorTTLCache:
     """This is a lazy executor TTL cache.
 
@@ -553,25 +595,383 @@ class LazyExecutorTTLCache:
 
 
 class Segment:
-    def __init__(self, index, offset, data):
+    def __init__(self, index, offset, data, hole=False):
         self.index = index
         self.offset = offset
+        # A memoryview slice of the mapped image file
         self.data = data
+        # Whether the segment lies entirely within a hole in a sparse
+        # file (and is therefore zero)
+        self.hole = hole
+
+    def isZero(self):
+        if self.hole:
+            return True
+        # Compare against a block of zeros without copying the data
+        return _zeroBlock(len(self.data)).startswith(self.data)
+
+
+@functools.lru_cache(maxsize=4)
+def _zeroBlock(size):
+    return bytes(size)
+
+
+class SparseMap:
+    """The regions of a sparse file which contain data
+
+    Raw images are mostly unallocated; this lets callers skip the
+    holes without reading them.
+
+    :param list extents: A sorted list of (start, end) offsets of the
+        data regions of the file.
+    """
+
+    def __init__(self, extents):
+        self._starts = [e[0] for e in extents]
+        self._ends = [e[1] for e in extents]
+
+    def __len__(self):
+        return len(self._starts)
+
+    def isHole(self, offset, length):
+        """Return True if the range contains no data"""
+        # The first extent ending after the offset
+        index = bisect.bisect_right(self._ends, offset)
+        if index >= len(self._starts):
+            return True
+        return self._starts[index] >= offset + length
+
+    @staticmethod
+    def fromFile(f, size):
+        """Find the data regions of an open file using SEEK_DATA
+
+        Returns None if the platform or filesystem does not support
+        it.
+        """
+        if not hasattr(os, 'SEEK_DATA'):
+            return None
+        fd = f.fileno()
+        extents = []
+        pos = 0
+        try:
+            while pos < size:
+                try:
+                    start = os.lseek(fd, pos, os.SEEK_DATA)
+                except OSError as e:
+                    if e.errno == errno.ENXIO:
+                        # There is no data after pos
+                        break
+                    raise
+                end = os.lseek(fd, start, os.SEEK_HOLE)
+                extents.append((start, end))
+                pos = end
+        except OSError:
+            return None
+        finally:
+            os.lseek(fd, 0, os.SEEK_SET)
+        return SparseMap(extents)
+
+
+class SegmentReader(io.RawIOBase):
+    """A seekable, read-only file-like object for a segment.
+
+    Some client libraries only accept bytes or file-like objects as
+    request bodies; this lets them stream a segment's memoryview in
+    small reads rather than copying the whole segment up front.
+    """
+
+    def __init__(self, data):
+        super().__init__()
+        self._data = data
+        self._pos = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = len(self._data) + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        self._pos = max(0, pos)
+        return self._pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = len(self._data)
+        else:
+            end = min(self._pos + size, len(self._data))
+        ret = bytes(self._data[self._pos:end])
+        self._pos = max(self._pos, end)
+        return ret
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, buf):
+        end = min(self._pos + len(buf), len(self._data))
+        count = max(0, end - self._pos)
+        buf[:count] = self._data[self._pos:end]
+        self._pos += count
+        return count
+
+
+class SegmentTracker:
+    """Track which segments of an upload are complete.
+
+    Segments are uploaded roughly in order, so this is stored as the
+    index below which all segments are complete plus the (small) set
+    of completed segments above that.
+    """
+
+    def __init__(self, complete_below=0, complete=()):
+        self._lock = threading.Lock()
+        self.complete_below = complete_below
+        self.complete = set(complete)
+
+    def __contains__(self, index):
+        return index < self.complete_below or index in self.complete
+
+    def __len__(self):
+        return self.complete_below + len(self.complete)
+
+    def add(self, index):
+        with self._lock:
+            self.complete.add(index)
+            while self.complete_below in self.complete:
+                self.complete.remove(self.complete_below)
+                self.complete_below += 1
+
+    def toDict(self):
+        with self._lock:
+            return {
+                'complete_below': self.complete_below,
+                'complete': sorted(self.complete),
+            }
+
+    @staticmethod
+    def fromDict(d):
+        return SegmentTracker(d.get('complete_below', 0),
+                              d.get('complete', []))
+
+
+class UploadCheckpoint:
+    """Persistent progress of a resumable image upload.
+
+    This is supplied by the builder to adapters which support
+    resumable uploads.
+
+    :param dict data: The progress saved by a previous attempt at
+        this upload, or None.
+    :param save: A callable which persists a progress dictionary.
+    """
+
+    def __init__(self, data=None, save=None):
+        self.data = data
+        self._save = save
+
+    @property
+    def session(self):
+        """The upload session in the cloud, as returned by
+        ImageUploader.getResumeData, or None."""
+        if not self.data:
+            return None
+        return self.data.get('session')
+
+    def save(self, data):
+        self.data = data
+        if self._save:
+            self._save(data)
+
+
+class BlockManifest:
+    """Per-block sha256 digests of a local image file.
+
+    Adapters use these to determine which blocks of an image are
+    unchanged from an earlier build.  The digests are computed on
+    first use and cached in a file next to the image so that uploads
+    of the same build to several providers, and the upload of the next
+    build, can reuse them.  A short final block is zero-padded to the
+    block size.
+
+    :param str path: The path to the image file.
+    """
+    log = logging.getLogger("nodepool.BlockManifest")
+
+    suffix = '.blocks'
+    digest_size = hashlib.sha256().digest_size
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest_path = path + self.suffix
+        self._lock = threading.Lock()
+        self._block_size = None
+        self._digests = None
+
+    def getDigests(self, block_size):
+        """Return a list of the digests of each block of the image
+
+        Returns None if the image file is no longer present and there
+        is no usable cached manifest.
+        """
+        with self._lock:
+            if self._block_size != block_size:
+                digests = self._load(block_size)
+                if digests is None:
+                    digests = self._compute(block_size)
+                self._digests = digests
+                self._block_size = block_size
+            return self._digests
+
+    def _stat(self):
+        try:
+            return os.stat(self.path)
+        except FileNotFoundError:
+            return None
+
+    def _load(self, block_size):
+        try:
+            with open(self.manifest_path, 'rb') as f:
+                header = f.readline().split()
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            (kind, algorithm, manifest_block_size,
+             size, mtime) = header
+            manifest_block_size = int(manifest_block_size)
+            size = int(size)
+            mtime = int(mtime)
+        except ValueError:
+            self.log.warning("Ignoring invalid block manifest %s",
+                             self.manifest_path)
+            return None
+        if (kind != b'nodepool-blocks' or algorithm != b'sha256' or
+            manifest_block_size != block_size):
+            return None
+        # The image may have been removed after it was uploaded,
+        # in which case the manifest is all that remains.
+        st = self._stat()
+        if st and (st.st_size, st.st_mtime_ns) != (size, mtime):
+            return None
+        if len(data) != math.ceil(size / block_size) * self.digest_size:
+            return None
+        return [data[i:i + self.digest_size]
+                for i in range(0, len(data), self.digest_size)]
+
+    def _compute(self, block_size):
+        st = self._stat()
+        if st is None:
+            return None
+        self.log.debug("Computing block manifest for %s", self.path)
+        digests = []
+        zero_digest = hashlib.sha256(_zeroBlock(block_size)).digest()
+        with open(self.path, 'rb') as f:
+            sparse = SparseMap.fromFile(f, st.st_size)
+            for offset in range(0, st.st_size, block_size):
+                if sparse is not None and sparse.isHole(offset, block_size):
+                    digests.append(zero_digest)
+                    continue
+                f.seek(offset)
+                block = f.read(block_size)
+                if len(block) < block_size:
+                    block = block.ljust(block_size, b'\0')
+                digests.append(hashlib.sha256(block).digest())
+        try:
+            self._save(block_size, st, digests)
+        except Exception:
+            self.log.exception("Unable to save block manifest %s:",
+                               self.manifest_path)
+        return digests
+
+    def _save(self, block_size, st, digests):
+        header = (f'nodepool-blocks sha256 {block_size} '
+                  f'{st.st_size} {st.st_mtime_ns}\n')
+        # Write to a temporary file so that concurrent uploads never
+        # see a partial manifest.
+        (fd, tmp_path) = tempfile.mkstemp(
+            dir=os.path.dirname(self.manifest_path),
+            prefix=os.path.basename(self.manifest_path) + '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(header.encode('utf8'))
+                f.write(b''.join(digests))
+            os.replace(tmp_path, self.manifest_path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+
+class ParentImage:
+    """An earlier upload of an image to the same provider
+
+    This is supplied by the builder to adapters which support
+    incremental uploads.
+
+    :param str external_id: The id of the image in the cloud.
+    :param BlockManifest manifest: The block manifest of the image
+        file that was uploaded.
+    :param str sha256: The sha256 of the image file that was uploaded,
+        so that adapters may check that the cloud image was made from
+        it.
+    """
+
+    def __init__(self, external_id, manifest, sha256=None):
+        self.external_id = external_id
+        self.manifest = manifest
+        self.sha256 = sha256
 
 
 class ImageUploader:
     """
     A helper class for drivers that upload large images in chunks.
+
+    The image file is memory mapped and each segment is handed to
+    uploadSegment as a memoryview slice of the mapping, so the data
+    is never copied into new buffers and resident memory does not
+    grow with the segment size or concurrency.
+
+    If a checkpoint is supplied and the subclass implements
+    getResumeData and resumeUpload, the completed segments are
+    periodically saved to it.  If the upload fails, the session in the
+    cloud is left in place and a later attempt with the same
+    checkpoint uploads only the remaining segments.
+
+    Subclasses may implement skipSegment to avoid sending segments the
+    cloud already has (for example, blocks of zeros or blocks which are
+    unchanged from a previous upload).  If a bandwidth limiter is
+    supplied (usually one shared by all uploads to a provider), segments
+    are paced to its rate.  Segments which fall in holes
+    of a sparse image file are marked as such so that they are known
+    to be zero without reading them.  The number of bytes sent and
+    skipped is reported to statsd.
     """
 
     # These values probably don't need to be changed
     error_retries = 3
     concurrency = 10
+    # How often to save the upload progress to the checkpoint
+    checkpoint_interval = 60
 
     # Subclasses must implement these
     segment_size = None
 
-    def __init__(self, adapter, log, path, image_name, metadata):
+    def __init__(self, adapter, log, path, image_name, metadata,
+                 concurrency=None, checkpoint=None,
+                 bandwidth_limiter=None):
         if self.segment_size is None:
             raise Exception("Subclass must set block size")
         self.adapter = adapter
@@ -581,6 +981,15 @@ class ImageUploader:
         self.image_name = image_name
         self.metadata = metadata
         self.timeout = None
+        if concurrency is not None:
+            self.concurrency = concurrency
+        self.checkpoint = checkpoint
+        self.bandwidth_limiter = bandwidth_limiter
+        self.completed = SegmentTracker()
+        self._last_checkpoint = time.monotonic()
+        self._bytes_lock = threading.Lock()
+        self.bytes_sent = 0
+        self.bytes_skipped = 0
 
     def shouldRetryException(self, exception):
         return True
@@ -597,19 +1006,55 @@ class ImageUploader:
     def abortUpload(self):
         pass
 
+    def skipSegment(self, segment):
+        """Return True if the segment does not need to be uploaded"""
+        return False
+
+    # Subclasses which support resuming uploads implement these
+    def getResumeData(self):
+        """Return a dict identifying the upload session in the cloud
+
+        Return None if the upload can not be resumed.
+        """
+        return None
+
+    def resumeUpload(self, data):
+        """Re-attach to the upload session described by data
+
+        This is called instead of startUpload.  self.completed is
+        already populated with the segments which were uploaded.
+
+        :returns: True if the session may be resumed, otherwise
+            False (in which case startUpload is called).
+        """
+        return False
+
     # Main API
     def upload(self, timeout=None):
         if timeout:
             self.timeout = time.monotonic() + timeout
-        self.startUpload()
+        if not self._resume():
+            self.startUpload()
         try:
-            with concurrent.futures.ThreadPoolExecutor(
-                    max_workers=self.concurrency) as executor:
-                with open(self.path, 'rb') as image_file:
-                    self._uploadInner(executor, image_file)
-            return self.finishUpload()
+            with open(self.path, 'rb') as image_file:
+                # The map is unmapped once the last segment view
+                # referencing it is gone.
+                image_map = self._mapImage(image_file)
+                sparse = SparseMap.fromFile(image_file, self.size)
+                with concurrent.futures.ThreadPoolExecutor(
+                        max_workers=self.concurrency) as executor:
+                    self._uploadInner(executor, image_map, sparse)
+            ret = self.finishUpload()
+            self._reportStats()
+            return ret
         except Exception:
             self.log.exception("Error uploading image:")
+            if self._saveCheckpoint():
+                # Leave the upload session in place so that a later
+                # attempt can resume it.
+                self.log.info("Saved progress of %s of %s segments",
+                              len(self.completed), self._segmentCount())
+                raise
             self.abortUpload()
 
     # Subclasses can use this helper method for wrapping retryable calls
@@ -636,15 +1081,88 @@ class ImageUploader:
             raise Exception("Timed out uploading image")
 
     # Internal methods
-    def _uploadInner(self, executor, image_file):
+    def _segmentCount(self):
+        return math.ceil(self.size / self.segment_size)
+
+    def _resume(self):
+        if self.checkpoint is None or not self.checkpoint.data:
+            return False
+        data = self.checkpoint.data
+        if (data.get('size') != self.size or
+            data.get('segment_size') != self.segment_size):
+            self.log.info("Not resuming upload of a different image file")
+            return False
+        self.completed = SegmentTracker.fromDict(data.get('segments', {}))
+        try:
+            resumed = self.resumeUpload(data.get('session'))
+        except Exception:
+            self.log.exception("Unable to resume upload:")
+            resumed = False
+        if not resumed:
+            self.completed = SegmentTracker()
+            return False
+        self.log.info("Resuming upload with %s of %s segments complete",
+                      len(self.completed), self._segmentCount())
+        return True
+
+    def _saveCheckpoint(self):
+        if self.checkpoint is None:
+            return False
+        session = self.getResumeData()
+        if session is None:
+            return False
+        try:
+            self.checkpoint.save({
+                'size': self.size,
+                'segment_size': self.segment_size,
+                'session': session,
+                'segments': self.completed.toDict(),
+            })
+        except Exception:
+            self.log.exception("Unable to save upload progress:")
+            return False
+        self._last_checkpoint = time.monotonic()
+        return True
+
+    def _mapImage(self, image_file):
+        if self.size == 0:
+            # Empty files can not be mapped
+            return None
+        return mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _reportStats(self):
+        self.log.info("Uploaded %s bytes of %s; skipped %s bytes",
+                      self.bytes_sent, self.image_name, self.bytes_skipped)
+        provider_name = self.metadata.get('nodepool_provider_name')
+        statsd = stats.get_client()
+        if not (statsd and provider_name):
+            return
+        key = 'nodepool.image_upload.%s' % (provider_name,)
+        pipeline = statsd.pipeline()
+        pipeline.incr(key + '.bytes_sent', self.bytes_sent)
+        pipeline.incr(key + '.bytes_skipped', self.bytes_skipped)
+        pipeline.send()
+
+    def _uploadInner(self, executor, image_map, sparse=None):
+        if image_map is None:
+            return
         futures = set()
+        # Segments are views of the mapped file.  They share the page
+        # cache with the file so nothing is copied here; the kernel
+        # pages data in as the uploaders read it.
+        image_view = memoryview(image_map)
         for index, offset in enumerate(range(0, self.size, self.segment_size)):
-            segment = Segment(index, offset,
-                              image_file.read(self.segment_size))
-            future = executor.submit(self.uploadSegment, segment)
+            if index in self.completed:
+                continue
+            segment = Segment(
+                index, offset,
+                image_view[offset:offset + self.segment_size],
+                hole=(sparse is not None and
+                      sparse.isHole(offset, self.segment_size)))
+            future = executor.submit(self._uploadSegment, segment)
             futures.add(future)
-            # Keep the pool of workers supplied with data but without
-            # reading the entire file into memory.
+            # Limit the number of outstanding segments so that we
+            # don't race ahead of the uploaders.
             if len(futures) >= (self.concurrency * 2):
                 (done, futures) = concurrent.futures.wait(
                     futures,
@@ -655,6 +1173,9 @@ class ImageUploader:
                 # Only check the timeout after waiting (not every pass
                 # through the loop)
                 self.checkTimeout()
+                if (time.monotonic() - self._last_checkpoint >
+                    self.checkpoint_interval):
+                    self._saveCheckpoint()
         # We're done reading the file, wait for all uploads to finish
         (done, futures) = concurrent.futures.wait(
             futures,
@@ -662,3 +1183,15 @@ class ImageUploader:
         for future in done:
             future.result()
         self.checkTimeout()
+
+    def _uploadSegment(self, segment):
+        if self.skipSegment(segment):
+            with self._bytes_lock:
+                self.bytes_skipped += len(segment.data)
+        else:
+            if self.bandwidth_limiter:
+                self.bandwidth_limiter.consume(len(segment.data))
+            self.uploadSegment(segment)
+            with self._bytes_lock:
+                self.bytes_sent += len(segment.data)
+        self.completed.add(segment.index)
@@ -0,0 +1,189 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Forecasting of node request demand.
+
+The launcher records the arrival of each node request.  Arrivals are
+counted per label over a fixed interval, and each interval's rate
+updates two estimates:
+
+* an exponentially weighted moving average, which follows the recent
+  rate, and
+* a daily profile with one slot per interval of the day, each a moving
+  average of the rate at that time on previous days, which anticipates
+  recurring peaks before they arrive.
+
+The forecast rate is the higher of the two.  The number of ready nodes
+a label needs is the number of requests forecast to arrive within the
+time it takes to launch a node.
+"""
+
+import logging
+import math
+import threading
+import time
+
+# The interval over which arrivals are counted
+FORECAST_INTERVAL = 5 * 60
+# The half-life of the moving average of the rate
+FORECAST_HALF_LIFE = 15 * 60
+# The weight of the latest day in the daily profile
+SEASONAL_WEIGHT = 0.5
+DAY = 24 * 60 * 60
+
+
+class LabelForecast(object):
+    '''
+    The request rate estimates of a label.
+    '''
+    def __init__(self, slots):
+        self.count = 0
+        self.level = None
+        self.profile = [None] * slots
+        self.hits = 0
+        self.misses = 0
+
+    def update(self, slot, rate, alpha):
+        if self.level is None:
+            self.level = rate
+        else:
+            self.level += alpha * (rate - self.level)
+        seasonal = self.profile[slot]
+        if seasonal is None:
+            self.profile[slot] = rate
+        else:
+            self.profile[slot] = seasonal + SEASONAL_WEIGHT * (rate - seasonal)
+
+    def rate(self, slot):
+        '''
+        Return the forecast number of requests per second.
+        '''
+        rates = [r for r in (self.level, self.profile[slot]) if r is not None]
+        return max(rates, default=0.0)
+
+
+class DemandForecast(object):
+    '''
+    Forecast the node requests for each label.
+
+    Requests are recorded as they arrive, from any thread.  Once per
+    interval, the counts are folded into the estimates.
+
+    :param float interval: The interval over which arrivals are counted.
+    :param float half_life: The half-life of the moving average.
+    '''
+    log = logging.getLogger("nodepool.DemandForecast")
+
+    def __init__(self, interval=FORECAST_INTERVAL,
+                 half_life=FORECAST_HALF_LIFE):
+        self.interval = interval
+        self.alpha = 1 - math.exp(-math.log(2) * interval / half_life)
+        self._labels = {}
+        self._ready = {}
+        self._lock = threading.Lock()
+        self._interval_start = self._intervalStart(time.time())
+
+    def _intervalStart(self, now):
+        return now - now % self.interval
+
+    def _slot(self, now):
+        return int(now % DAY // self.interval)
+
+    def _getLabel(self, label):
+        forecast = self._labels.get(label)
+        if forecast is None:
+            forecast = LabelForecast(math.ceil(DAY / self.interval))
+            self._labels[label] = forecast
+        return forecast
+
+    def recordRequest(self, labels, now=None):
+        '''
+        Record the arrival of a node request.
+
+        A request counts as a hit for a label if a ready node of the
+        label was available for it when it arrived.
+
+        :param list labels: The labels requested.
+        :param float now: The time of arrival.
+        '''
+        with self._lock:
+            self._advance(now or time.time())
+            for label in set(labels):
+                forecast = self._getLabel(label)
+                forecast.count += 1
+                if self._ready.get(label, 0) > 0:
+                    self._ready[label] -= 1
+                    forecast.hits += 1
+                else:
+                    forecast.misses += 1
+
+    def setReady(self, label, count):
+        '''
+        Record the number of ready nodes of a label.
+        '''
+        with self._lock:
+            self._ready[label] = count
+
+    def _advance(self, now):
+        # Fold the counts of each interval that has ended into the
+        # estimates; intervals without arrivals have a rate of zero.
+        start = self._intervalStart(now)
+        if start - self._interval_start > DAY:
+            # Nothing was recorded for over a day; a day of empty
+            # intervals is enough to update every estimate.
+            self._interval_start = start - DAY
+        while self._interval_start < start:
+            slot = self._slot(self._interval_start)
+            for forecast in self._labels.values():
+                forecast.update(slot, forecast.count / self.interval,
+                                self.alpha)
+                forecast.count = 0
+            self._interval_start += self.interval
+
+    def getMinReady(self, label, floor, ceiling, lead_time, now=None):
+        '''
+        Return the number of ready nodes a label should have.
+
+        :param str label: The label name.
+        :param int floor: The fewest ready nodes to keep.
+        :param int ceiling: The most ready nodes to keep.
+        :param float lead_time: How far ahead to forecast, in seconds;
+            the time it takes to launch a node.
+        :param float now: The current time.
+        '''
+        now = now or time.time()
+        with self._lock:
+            self._advance(now)
+            forecast = self._labels.get(label)
+            if forecast is None:
+                return floor
+            rate = forecast.rate(self._slot(now + lead_time))
+        # Round first so that a rate which has decayed almost to
+        # nothing does not keep a node ready.
+        need = math.ceil(round(rate * lead_time, 2))
+        return max(floor, min(ceiling, need))
+
+    def getStats(self, label):
+        '''
+        Return the forecast rate of requests per hour and the hit and
+        miss counts of a label since the last call.
+        '''
+        now = time.time()
+        with self._lock:
+            self._advance(now)
+            forecast = self._labels.get(label)
+            if forecast is None:
+                return (0.0, 0, 0)
+            stats = (forecast.rate(self._slot(now)) * 3600,
+                     forecast.hits, forecast.misses)
+            forecast.hits = forecast.misses = 0
+            return stats
@@ -27,8 +27,10 @@ import uuid
 from kazoo import exceptions as kze
 
 from nodepool import exceptions
+from nodepool import forecast
 from nodepool import provider_manager
 from nodepool import stats
+from nodepool import tracing
 from nodepool import config as nodepool_config
 from nodepool.zk import zookeeper as zk
 from nodepool.zk import ZooKeeperClient
@@ -45,6 +47,15 @@ HOURS = 60 * MINS
 # Interval between checking if new servers needed
 WATERMARK_SLEEP = 1
 
+# Minimum interval between node and request stats reports
+STATS_FLUSH_INTERVAL = 1
+
+# The requestor of min-ready node requests
+MIN_READY_REQUESTOR = "NodePool:min-ready"
+
+# Interval between reports of the demand forecast
+FORECAST_STATS_INTERVAL = 1 * MINS
+
 # When to delete node request lock znodes
 LOCK_CLEANUP = 8 * HOURS
 
@@ -287,6 +298,7 @@ class PoolWorker(threading.Thread, stats.StatsReporter):
                 log.debug("Request is already declined")
                 continue
 
+            rh.timeline.mark('locked')
             if not reasons_to_decline:
                 # Got a lock, so assign it
                 log.info("Assigning node request %s", req)
@@ -910,8 +922,7 @@ class DeletedNodeWorker(BaseCleanupWorker):
             # request is now missing, deallocate it.
             if (node.state == zk.READY
                     and node.allocated_to
-                    and not zk_conn.getNodeRequest(
-                        node.allocated_to, cached=True)):
+                    and not zk_conn.nodeRequestExists(node.allocated_to)):
                 try:
                     zk_conn.lockNode(node, blocking=False)
                 except exceptions.ZKLockException:
@@ -920,7 +931,8 @@ class DeletedNodeWorker(BaseCleanupWorker):
                     # Double check node conditions after lock
                     if (node.state == zk.READY
                             and node.allocated_to
-                            and not zk_conn.getNodeRequest(node.allocated_to)):
+                            and not zk_conn.nodeRequestExists(
+                                node.allocated_to)):
                         old_req_id = node.allocated_to
                         node.allocated_to = None
                         try:
@@ -1029,26 +1041,27 @@ class StatsWorker(BaseCleanupWorker, stats.StatsReporter):
     def _run_stats(self):
         self.log.info('Won stats reporter election')
 
-        # enable us getting events
+        # enable us getting events, and report the current stats
         zk = self._nodepool.getZK()
         zk.setNodeStatsEvent(self.stats_event)
+        self.stats_event.set()
 
         while self._running:
-            signaled = self.stats_event.wait()
+            # Changes are batched and only changed gauges are sent;
+            # wake up periodically regardless so that all gauges are
+            # refreshed.
+            self.stats_event.wait(stats.GAUGE_REFRESH_INTERVAL)
 
             if not self._running:
                 break
 
-            if not signaled:
-                continue
-
             self.stats_event.clear()
             try:
                 self.updateNodeStats(zk)
                 self.updateNodeRequestStats(zk)
             except Exception:
                 self.log.exception("Exception while reporting stats:")
-            time.sleep(1)
+            time.sleep(STATS_FLUSH_INTERVAL)
 
         # Unregister from node stats events
         zk.setNodeStatsEvent(None)
@@ -1077,6 +1090,15 @@ class NodePool(threading.Thread):
         self._stats_thread = None
         self._local_stats_thread = None
         self._submittedRequests = {}
+        self._submitted_lock = threading.Lock()
+        # Completed min-ready requests which could not be removed
+        self._unremovedRequests = {}
+        self._seen_requests = set()
+        self.forecast = forecast.DemandForecast()
+        # Requests created before this are not new arrivals
+        self._start_time = time.time()
+        self._forecast_stats_time = 0
+        self.tracer = tracing.Tracer()
         self.ready = False
 
     def stop(self):
@@ -1102,6 +1124,8 @@ class NodePool(threading.Thread):
         if self._local_stats_thread:
             self._local_stats_thread.join()
 
+        self.tracer.stop()
+
         # Don't let stop() return until all pool threads have been
         # terminated.
         self.log.debug("Stopping pool threads")
@@ -1120,10 +1144,9 @@ class NodePool(threading.Thread):
         self.log.debug("Finished stopping")
 
     def loadConfig(self):
-        config = nodepool_config.loadConfig(self.configfile)
-        if self.securefile:
-            nodepool_config.loadSecureConfig(config, self.securefile)
-        return config
+        return nodepool_config.loadConfig(
+            self.configfile, previous=self.config,
+            secure_config_path=self.securefile)
 
     def reconfigureZooKeeper(self, config):
         if self.config:
@@ -1146,6 +1169,7 @@ class NodePool(threading.Thread):
             )
             self.zk_client.connect()
             self.zk = zk.ZooKeeper(self.zk_client)
+            self.zk.addRequestListener(self._onRequestChange)
 
             hostname = socket.gethostname()
             self.component_info = LauncherComponent(
@@ -1182,55 +1206,122 @@ class NodePool(threading.Thread):
             if provider_name not in config.provider_managers:
                 del config.providers[provider_name]
 
+        self.tracer.configure(config.tracing)
         self.setConfig(config)
 
-    def removeCompletedRequests(self):
+    def _removeSubmittedRequest(self, request_id):
+        # Stop tracking a min-ready request; returns the tracked request,
+        # if any.
+        with self._submitted_lock:
+            for label, label_requests in self._submittedRequests.items():
+                for req in label_requests:
+                    if req.id == request_id:
+                        break
+                else:
+                    continue
+                label_requests.remove(req)
+                if not label_requests:
+                    self.log.debug(
+                        "No more active min-ready requests for label %s",
+                        label)
+                    del self._submittedRequests[label]
+                return req
+        return None
+
+    def _onMinReadyRequestCreated(self, req, result):
+        if result.successful():
+            return
+        self.log.error("Unable to create min-ready request for %s: %s",
+                       req.node_types, result.exception)
+        # Forget the request so that it is submitted again
+        with self._submitted_lock:
+            for label in req.node_types:
+                label_requests = self._submittedRequests.get(label, [])
+                if req in label_requests:
+                    label_requests.remove(req)
+                if not label_requests:
+                    self._submittedRequests.pop(label, None)
+
+    def _onMinReadyRequestChange(self, request_id, request):
         '''
-        Remove (locally and in ZK) fulfilled node requests.
+        Remove (locally and in ZK) completed min-ready node requests.
 
-        We also must reset the allocated_to attribute for each Node assigned
-        to our request, since we are deleting the request.
+        This is called from the request cache, so ZooKeeper is updated
+        asynchronously.  We also must reset the allocated_to attribute
+        for each Node assigned to our request, since we are deleting the
+        request.
         '''
+        if request is not None and request.state not in (zk.FULFILLED,
+                                                         zk.FAILED):
+            return
+        if not self._removeSubmittedRequest(request_id):
+            return
+        if request is None:
+            return
 
-        # Use a copy of the labels because we modify _submittedRequests
-        # within the loop below. Note that keys() returns an iterator in
-        # py3, so we need to explicitly make a new list.
-        requested_labels = list(self._submittedRequests.keys())
-
-        for label in requested_labels:
-            label_requests = self._submittedRequests[label]
-            active_requests = []
-
-            for req in label_requests:
-                req = self.zk.getNodeRequest(req.id)
-
-                if not req:
+        log = get_annotated_logger(self.log, event_id=request.event_id,
+                                   node_request_id=request.id)
+        if request.state == zk.FULFILLED:
+            # Reset node allocated_to
+            for node_id in request.nodes:
+                node = self.zk.getNode(node_id, cached=True)
+                if not node or node.allocated_to != request.id:
                     continue
+                node.allocated_to = None
+                # NOTE: locking shouldn't be necessary since a node
+                # with allocated_to set should not be locked except
+                # by the creator of the request (us).
+                result = self.zk.storeNodeAsync(node)
+                result.rawlink(
+                    lambda result: self._onMinReadyRequestRemoved(
+                        request, result))
+        else:
+            log.debug("min-ready node request failed: %s", request)
+        result = self.zk.deleteNodeRequestAsync(request)
+        result.rawlink(
+            lambda result: self._onMinReadyRequestRemoved(request, result))
 
-                log = get_annotated_logger(self.log, event_id=req.event_id,
-                                           node_request_id=req.id)
-                if req.state == zk.FULFILLED:
-                    # Reset node allocated_to
-                    for node_id in req.nodes:
-                        node = self.zk.getNode(node_id)
-                        node.allocated_to = None
-                        # NOTE: locking shouldn't be necessary since a node
-                        # with allocated_to set should not be locked except
-                        # by the creator of the request (us).
-                        self.zk.storeNode(node)
-                    self.zk.deleteNodeRequest(req)
-                elif req.state == zk.FAILED:
-                    log.debug("min-ready node request failed: %s", req)
-                    self.zk.deleteNodeRequest(req)
-                else:
-                    active_requests.append(req)
-
-            if active_requests:
-                self._submittedRequests[label] = active_requests
-            else:
-                self.log.debug(
-                    "No more active min-ready requests for label %s", label)
-                del self._submittedRequests[label]
+    def _onMinReadyRequestRemoved(self, request, result):
+        if result.successful():
+            return
+        if isinstance(result.exception, kze.NoNodeError):
+            # The node or request was already deleted
+            return
+        log = get_annotated_logger(self.log, event_id=request.event_id,
+                                   node_request_id=request.id)
+        log.error("Unable to remove min-ready request: %s",
+                  result.exception)
+        # Track the request again so that no other request is
+        # submitted for its labels, and retry in createMinReady.
+        with self._submitted_lock:
+            if request.id in self._unremovedRequests:
+                return
+            self._unremovedRequests[request.id] = request
+            for label in request.node_types:
+                self._submittedRequests.setdefault(label, []).append(request)
+
+    def _retryMinReadyRequestRemoval(self):
+        with self._submitted_lock:
+            requests = list(self._unremovedRequests.values())
+            self._unremovedRequests.clear()
+        for request in requests:
+            self._onMinReadyRequestChange(request.id, request)
+
+    def _checkMinReadyRequests(self):
+        # The request cache does not report a change to a request
+        # which arrives while the request is locked, as it usually is
+        # when it is fulfilled, so also look for completed requests
+        # in the cache.
+        with self._submitted_lock:
+            tracked = set(req.id for label_requests in
+                          self._submittedRequests.values()
+                          for req in label_requests if req.id)
+        for request_id in tracked:
+            request = self.zk.getNodeRequest(request_id, cached=True,
+                                             only_cached=True)
+            if request is None or request.lock:
+                continue
+            self._onMinReadyRequestChange(request_id, request)
 
     def labelImageIsAvailable(self, label):
         '''
@@ -1257,6 +1348,64 @@ class NodePool(threading.Thread):
                         return True
         return False
 
+    def _onRequestChange(self, request_id, request):
+        if request is None or request.requestor == MIN_READY_REQUESTOR:
+            self._onMinReadyRequestChange(request_id, request)
+
+        # Record the arrival of each request for the demand forecast
+        # and start its timeline
+        if request is None:
+            self._seen_requests.discard(request_id)
+            self.tracer.discard(request_id)
+            return
+        if request_id in self._seen_requests:
+            return
+        self._seen_requests.add(request_id)
+        if request.state != zk.REQUESTED:
+            return
+        timeline = self.tracer.request(request)
+        if request.created_time:
+            timeline.mark('created', request.created_time)
+        timeline.mark('seen')
+        if request.requestor == MIN_READY_REQUESTOR:
+            return
+        if request.created_time and request.created_time < self._start_time:
+            # Delivered by the initial fill of the cache; this
+            # request arrived while the launcher was not running.
+            return
+        self.forecast.recordRequest(request.node_types)
+
+    def getMinReady(self, label):
+        '''
+        Return the number of ready nodes to keep for a label.
+
+        If the label has a min-ready ceiling, this follows the
+        forecast demand for the label.
+        '''
+        if label.min_ready < 0 or label.min_ready_ceiling <= label.min_ready:
+            return label.min_ready
+        return self.forecast.getMinReady(
+            label.name, label.min_ready, label.min_ready_ceiling,
+            label.min_ready_lead_time)
+
+    def _reportForecastStats(self, min_ready):
+        if not self.statsd:
+            return
+        now = time.monotonic()
+        if now - self._forecast_stats_time < FORECAST_STATS_INTERVAL:
+            return
+        self._forecast_stats_time = now
+        pipeline = self.statsd.pipeline()
+        for label_name, count in min_ready.items():
+            rate, hits, misses = self.forecast.getStats(label_name)
+            key = 'nodepool.label.%s' % label_name
+            pipeline.gauge(key + '.min_ready', count)
+            pipeline.gauge(key + '.request_rate', int(rate))
+            if hits or misses:
+                pipeline.gauge(key + '.min_ready_hit_rate',
+                               int(100 * hits / (hits + misses)))
+        pipeline.send()
+
     def createMinReady(self):
         '''
         Create node requests to make the minimum amount of ready nodes.
@@ -1264,39 +1413,51 @@ class NodePool(threading.Thread):
         Since this method will be called repeatedly, we need to take care to
         note when we have already submitted node requests to satisfy min-ready.
         Requests we've already submitted are stored in the _submittedRequests
-        dict, keyed by label.
+        dict, keyed by label, until they are complete in the request cache.
+
+        Requests are created asynchronously so that this makes no
+        synchronous ZooKeeper calls.
         '''
         def createRequest(label_name):
             req = zk.NodeRequest()
             req.state = zk.REQUESTED
-            req.requestor = "NodePool:min-ready"
+            req.requestor = MIN_READY_REQUESTOR
             req.node_types.append(label_name)
             req.reuse = False    # force new node launches
-            self.zk.storeNodeRequest(req, priority="900")
-            if label_name not in self._submittedRequests:
-                self._submittedRequests[label_name] = []
-            self._submittedRequests[label_name].append(req)
+            with self._submitted_lock:
+                self._submittedRequests.setdefault(label_name, []).append(req)
+            result = self.zk.storeNodeRequestAsync(req, priority="900")
+            result.rawlink(
+                lambda result: self._onMinReadyRequestCreated(req, result))
+
+        self._retryMinReadyRequestRemoval()
+        self._checkMinReadyRequests()
 
         # Since we could have already submitted node requests, do not
         # resubmit a request for a type if a request for that type is
         # still in progress.
-        self.removeCompletedRequests()
         label_names = list(self.config.labels.keys())
-        requested_labels = list(self._submittedRequests.keys())
+        with self._submitted_lock:
+            requested_labels = list(self._submittedRequests.keys())
         needed_labels = list(set(label_names) - set(requested_labels))
-        ready_nodes = self.zk.getReadyNodesOfTypes(needed_labels)
+        ready_nodes = self.zk.getReadyNodesOfTypes(label_names)
 
+        forecast_min_ready = {}
         for label in self.config.labels.values():
+            self.forecast.setReady(
+                label.name, len(ready_nodes.get(label.name, [])))
+            min_ready = self.getMinReady(label)
+            if label.min_ready_ceiling > label.min_ready >= 0:
+                forecast_min_ready[label.name] = min_ready
             if label.name not in needed_labels:
                 continue
-            min_ready = label.min_ready
             if min_ready <= 0:
                 continue   # disabled
 
             # Calculate how many nodes of this type we need created
             need = 0
             if label.name not in ready_nodes:
-                need = label.min_ready
+                need = min_ready
             elif len(ready_nodes[label.name]) < min_ready:
                 need = min_ready - len(ready_nodes[label.name])
 
@@ -1310,6 +1471,8 @@ class NodePool(threading.Thread):
                 for i in range(0, need):
                     createRequest(label.name)
 
+        self._reportForecastStats(forecast_min_ready)
+
     def _localStats(self):
         if not self.statsd:
             self.log.info("Statsd not configured")
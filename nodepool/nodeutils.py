@@ -18,6 +18,7 @@ import errno
 import time
 import socket
 import logging
+import threading
 
 import paramiko
 
@@ -27,6 +28,8 @@ log = logging.getLogger("nodepool.utils")
 
 # How long to sleep while waiting for something in a loop
 ITERATE_INTERVAL = 2
+# How long scanned ssh host keys are considered fresh
+HOST_KEY_CACHE_TTL = 600
 
 
 def iterate_timeout(max_seconds, exc, purpose, interval=ITERATE_INTERVAL):
@@ -55,12 +58,85 @@ def set_node_ip(node):
             "Unable to find public IP of server")
 
 
-def nodescan(ip, port=22, timeout=60, gather_hostkeys=True):
+class HostKeyCache:
+    '''
+    A cache of scanned ssh host keys keyed by (host, port).
+
+    Scanning host keys requires a full key exchange for every
+    supported key type.  Long-lived hosts (static nodes, metastatic
+    backing nodes) rarely change their keys, so while an entry is
+    fresh a cheap TCP connect can stand in for the full scan.
+    '''
+
+    def __init__(self, ttl=HOST_KEY_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # (host, port) -> (monotonic timestamp, [keys])
+        self._entries = {}
+
+    def get(self, host, port):
+        '''
+        Return the cached keys for the host, or None if there is no
+        fresh entry.
+        '''
+        with self._lock:
+            entry = self._entries.get((host, port))
+            if entry is None:
+                return None
+            timestamp, keys = entry
+            if time.monotonic() - timestamp > self.ttl:
+                del self._entries[(host, port)]
+                return None
+            return list(keys)
+
+    def put(self, host, port, keys):
+        with self._lock:
+            self._entries[(host, port)] = (time.monotonic(), list(keys))
+
+    def invalidate(self, host, port):
+        with self._lock:
+            self._entries.pop((host, port), None)
+
+    def validate(self, host, port, expected_keys):
+        '''
+        Return the cached keys for the host if they are fresh and
+        contain all of the expected keys, otherwise None.
+
+        A mismatch invalidates the entry so that the next scan
+        refreshes it.
+        '''
+        keys = self.get(host, port)
+        if keys is None:
+            return None
+        if not set(expected_keys or []).issubset(set(keys)):
+            log.debug("Cached host keys for %s on port %s do not match "
+                      "expected keys", host, port)
+            self.invalidate(host, port)
+            return None
+        return keys
+
+
+def nodescan(ip, port=22, timeout=60, gather_hostkeys=True,
+             host_key_cache=None, expected_keys=None):
     '''
     Scan the IP address for public SSH keys.
 
     Keys are returned formatted as: "<type> <base64_string>"
+
+    If a host key cache is supplied and it holds fresh keys for the
+    host which include all of the expected keys, only a TCP connect
+    is performed to check that the host is up and the cached keys are
+    returned.  Otherwise the keys are scanned and the cache updated.
     '''
+    if host_key_cache is not None and gather_hostkeys:
+        keys = host_key_cache.validate(ip, port, expected_keys)
+        if keys is not None:
+            nodescan(ip, port=port, timeout=timeout, gather_hostkeys=False)
+            return keys
+        keys = nodescan(ip, port=port, timeout=timeout)
+        host_key_cache.put(ip, port, keys)
+        return keys
+
     if 'fake' in ip:
         if gather_hostkeys:
             return ['ssh-rsa FAKEKEY']
@@ -0,0 +1,157 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""A sampling profiler.
+
+While running, the profiler periodically records the stack of every
+thread and counts how often each stack is seen.  This costs a little
+time per sample regardless of how busy the process is, unlike a
+tracing profiler which slows down every function call.
+
+The counts are output as collapsed stacks, one line per stack of the
+form ``thread;outer;...;inner count``, which can be turned into a
+flame graph with tools such as ``flamegraph.pl`` or speedscope.
+"""
+
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+
+# The default interval between samples, in seconds
+SAMPLE_INTERVAL = 0.1
+# The deepest stack to record
+MAX_DEPTH = 128
+
+
+class SamplingProfiler(object):
+    '''
+    Sample the stacks of all threads.
+    '''
+    log = logging.getLogger("nodepool.SamplingProfiler")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stacks = collections.Counter()
+        self._frame_names = {}
+        self._thread = None
+        self._stop_event = threading.Event()
+        self.interval = SAMPLE_INTERVAL
+        self.samples = 0
+        self.started = None
+        self.stop_time = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval=SAMPLE_INTERVAL, duration=None):
+        '''
+        Start sampling, if not already started.
+
+        :param float interval: The interval between samples, in seconds.
+        :param float duration: Stop after this many seconds.
+        '''
+        with self._lock:
+            if duration:
+                self.stop_time = time.monotonic() + duration
+            else:
+                self.stop_time = None
+            if self.running:
+                return
+            self.log.info("Starting profiler with interval %s", interval)
+            self.interval = interval
+            self.started = time.time()
+            self._stop_event.clear()
+            self._thread = threading.Thread(
+                target=self._run, name='SamplingProfiler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is None:
+            return
+        self.log.info("Stopping profiler")
+        self._stop_event.set()
+        thread.join()
+
+    def clear(self):
+        with self._lock:
+            self._stacks.clear()
+            self.samples = 0
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            if self.stop_time and time.monotonic() >= self.stop_time:
+                self.log.info("Profiler duration ended")
+                break
+            try:
+                self.sample()
+            except Exception:
+                self.log.exception("Error sampling stacks:")
+        with self._lock:
+            if self._thread is threading.current_thread():
+                self._thread = None
+
+    def _frameName(self, code):
+        name = self._frame_names.get(code)
+        if name is None:
+            name = '%s (%s:%s)' % (code.co_name,
+                                   os.path.basename(code.co_filename),
+                                   code.co_firstlineno)
+            self._frame_names[code] = name
+        return name
+
+    def sample(self):
+        '''
+        Record the current stack of every other thread.
+        '''
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None and len(stack) < MAX_DEPTH:
+                stack.append(self._frameName(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, 'unknown'))
+            stacks.append(tuple(reversed(stack)))
+        with self._lock:
+            self._stacks.update(stacks)
+            self.samples += 1
+
+    def collapsed(self, thread=None):
+        '''
+        Return the sampled stacks in the collapsed stack format.
+
+        :param str thread: If given, only threads whose names
+            contain it are included.
+        '''
+        with self._lock:
+            stacks = list(self._stacks.items())
+        lines = []
+        for stack, count in sorted(stacks):
+            if thread and thread not in stack[0]:
+                continue
+            # Semicolons separate the frames
+            frames = [f.replace(';', ':') for f in stack]
+            lines.append('%s %d' % (';'.join(frames), count))
+        return ''.join(line + '\n' for line in lines)
+
+
+PROFILER = SamplingProfiler()
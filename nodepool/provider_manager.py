@@ -49,7 +49,8 @@ class ProviderManager(object):
             oldmanager = None
             if old_config:
                 oldmanager = old_config.provider_managers.get(p.name)
-            if oldmanager and p != oldmanager.provider:
+            if (oldmanager and p is not oldmanager.provider and
+                    p != oldmanager.provider):
                 # Signal that actions not safe to run on both the old and
                 # new providers while we synchronize should cease to run.
                 oldmanager.idle()
@@ -11,18 +11,29 @@
 # under the License.
 
 """
-Helper to create a statsd client from environment variables
+Helper to create a statsd client from environment variables, and a
+registry of metrics kept in-process for the webapp's /metrics endpoint
 """
 
+import bisect
+import contextlib
+import math
 import os
 import logging
+import threading
+import time
+
 import statsd
 
-from nodepool.zk import zookeeper as zk
+from nodepool import tracing
 
 
 log = logging.getLogger("nodepool.stats")
 
+# How often to send every gauge, even those which have not changed, so
+# that a restarted statsd server learns the current values.
+GAUGE_REFRESH_INTERVAL = 5 * 60
+
 
 def get_client():
     """Return a statsd client object setup from environment variables; or
@@ -46,6 +57,239 @@ def normalize_statsd_name(name):
     return name.replace('.', '_').replace(':', '_')
 
 
+# The content type of the Prometheus text exposition format
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 25, 60, 120, 300, 600, 1800, 3600)
+
+
+def _escape_label(value):
+    return (str(value).replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric(object):
+    """A metric with a value for each combination of label values."""
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("Metric %s has labels %s, not %s" % (
+                self.name, self.labelnames, tuple(labels)))
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def _labelString(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join(
+            '%s="%s"' % (n, _escape_label(v)) for n, v in pairs)
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.extend(self._renderValue(key, value))
+        return lines
+
+    def _renderValue(self, key, value):
+        return ['%s%s %s' % (self.name, self._labelString(key),
+                             _format_value(value))]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self):
+        """Return the values by label values."""
+        with self._lock:
+            return dict(self._values)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def remove(self, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values.pop(key, None)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, count=1, **labels):
+        """Record an observation.
+
+        :param float value: The observed value.
+        :param int count: The number of observations this stands for,
+            if only a sample is observed.
+        """
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # A count for each bucket, then the sum
+                counts = self._values[key] = [0] * len(self.buckets) + [0]
+            counts[i] += count
+            counts[-1] += value * count
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the duration of the context."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def get(self, **labels):
+        """Return the count and sum of the observations."""
+        with self._lock:
+            counts = self._values.get(self._key(labels))
+            if counts is None:
+                return None
+            return (sum(counts[:-1]), counts[-1])
+
+    def totals(self):
+        """Return the count and sum of the observations by label values."""
+        with self._lock:
+            return {key: (sum(counts[:-1]), counts[-1])
+                    for key, counts in self._values.items()}
+
+    def _renderValue(self, key, counts):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets, counts):
+            total += count
+            lines.append('%s_bucket%s %d' % (
+                self.name,
+                self._labelString(key, [('le', _format_value(bound))]),
+                total))
+        labels = self._labelString(key)
+        lines.append('%s_sum%s %s' % (self.name, labels,
+                                      _format_value(counts[-1])))
+        lines.append('%s_count%s %d' % (self.name, labels, total))
+        return lines
+
+
+class MetricsRegistry(object):
+    """The metrics of this process.
+
+    Metrics are created on first use; asking for an existing metric
+    returns it.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _getMetric(self, cls, name, *args, **kw):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kw)
+            elif not isinstance(metric, cls):
+                raise ValueError("Metric %s is a %s" % (name, metric.type))
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._getMetric(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._getMetric(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self._getMetric(Histogram, name, documentation, labelnames,
+                               buckets=buckets)
+
+    def render(self):
+        """Return the metrics in the Prometheus text format."""
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        lines = []
+        for name, metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()
+
+LAUNCH_SECONDS = METRICS.histogram(
+    'nodepool_launch_seconds',
+    'Time taken to launch a node, by result',
+    ('provider', 'label', 'result'))
+LAUNCH_PHASE_SECONDS = METRICS.histogram(
+    'nodepool_launch_phase_seconds',
+    'Time spent in each phase of launching a node',
+    ('provider', 'phase'))
+ADAPTER_CALL_SECONDS = METRICS.histogram(
+    'nodepool_adapter_call_seconds',
+    'Time taken by calls to provider adapters',
+    ('provider', 'method'))
+CACHE_LAG_SECONDS = METRICS.histogram(
+    'nodepool_zk_cache_lag_seconds',
+    'Time between a ZooKeeper watch event and its cache update',
+    ('cache',))
+ZK_REQUEST_SECONDS = METRICS.histogram(
+    'nodepool_zk_request_seconds',
+    'Time taken by ZooKeeper requests, by request type',
+    ('request',))
+ZK_OPERATIONS = METRICS.counter(
+    'nodepool_zk_operations_total',
+    'Number of ZooKeeper operations, by operation and the '
+    'subsystem (thread) performing them',
+    ('operation', 'subsystem'))
+ZK_OPERATION_SECONDS = METRICS.histogram(
+    'nodepool_zk_operation_seconds',
+    'Time taken by a sample of ZooKeeper operations, by operation and '
+    'the subsystem (thread) performing them',
+    ('operation', 'subsystem'))
+CACHE_QUEUE_SIZE = METRICS.gauge(
+    'nodepool_zk_cache_queue_size',
+    'Number of events waiting in a ZooKeeper cache queue',
+    ('cache', 'queue'))
+
+
 class StatsReporter(object):
     '''
     Class adding statsd reporting functionality.
@@ -53,14 +297,49 @@ class StatsReporter(object):
     def __init__(self, statsd_client):
         super(StatsReporter, self).__init__()
         self._statsd = statsd_client
+        # The gauges last sent by sendChangedGauges
+        self._gauges = {}
+        self._gauges_refreshed = time.monotonic()
+
+    def sendChangedGauges(self, gauges):
+        '''
+        Send the gauges whose values changed since they were last sent.
+
+        :param dict gauges: The gauge values, by key.
+        '''
+        now = time.monotonic()
+        if now - self._gauges_refreshed >= GAUGE_REFRESH_INTERVAL:
+            self._gauges = {}
+            self._gauges_refreshed = now
+        pipeline = self._statsd.pipeline()
+        for key, value in gauges.items():
+            if self._gauges.get(key) != value:
+                pipeline.gauge(key, value)
+                self._gauges[key] = value
+        pipeline.send()
 
     def recordLaunchStats(self, subkey, dt):
         '''
         Record node launch statistics.
 
+        The total time is broken down into the phases recorded in the
+        timelines of the request and node.
+
         :param str subkey: statsd key
         :param int dt: Time delta in milliseconds
         '''
+        LAUNCH_SECONDS.observe(
+            dt / 1000,
+            provider=self.provider_config.name,
+            label=','.join(self.node.type),
+            result=subkey)
+        timeline = self.handler.timeline
+        phases = timeline.phases(tracing.REQUEST_PHASES)
+        phases.update(timeline.node(self.node.id).phases(tracing.NODE_PHASES))
+        for phase, seconds in phases.items():
+            LAUNCH_PHASE_SECONDS.observe(
+                seconds, provider=self.provider_config.name, phase=phase)
+
         if not self._statsd:
             return
 
@@ -85,17 +364,29 @@ class StatsReporter(object):
         for key in keys:
             pipeline.timing(key, dt)
             pipeline.incr(key)
+        for phase, seconds in phases.items():
+            pipeline.timing('nodepool.launch.phase.%s' % (phase,),
+                            int(seconds * 1000))
+            pipeline.timing('nodepool.launch.provider.%s.phase.%s' % (
+                self.provider_config.name, phase), int(seconds * 1000))
         pipeline.send()
 
     def updateNodeStats(self, zk_conn):
         '''
         Refresh statistics for all known nodes.
 
+        The node counts are maintained by the node cache as nodes
+        change, so this does not need to examine every node.
+
         :param ZooKeeper zk_conn: A ZooKeeper connection object.
         '''
         if not self._statsd:
             return
 
+        # NOTE: This is imported here since the ZooKeeper modules
+        # record metrics defined in this module.
+        from nodepool.zk import zookeeper as zk
+
         states = {}
 
         launcher_pools = zk_conn.getRegisteredPools()
@@ -120,35 +411,26 @@ class StatsReporter(object):
                 key = 'nodepool.label.%s.nodes.%s' % (label, state)
                 states[key] = 0
 
-        for node in zk_conn.nodeIterator(cached_ids=True):
+        summary_counts = zk_conn.getNodeSummaryCounts()
+        for (state, provider, node_labels), count in summary_counts.items():
             # nodepool.nodes.STATE
-            key = 'nodepool.nodes.%s' % node.state
-            states[key] += 1
+            key = 'nodepool.nodes.%s' % state
+            states[key] += count
 
             # nodepool.label.LABEL.nodes.STATE
             # nodes can have several labels
-            for label in node.type:
-                key = 'nodepool.label.%s.nodes.%s' % (label, node.state)
+            for label in node_labels:
+                key = 'nodepool.label.%s.nodes.%s' % (label, state)
                 # It's possible we could see node types that aren't in our
                 # config
-                if key in states:
-                    states[key] += 1
-                else:
-                    states[key] = 1
+                states[key] = states.get(key, 0) + count
 
             # nodepool.provider.PROVIDER.nodes.STATE
-            key = 'nodepool.provider.%s.nodes.%s' % (node.provider, node.state)
+            key = 'nodepool.provider.%s.nodes.%s' % (provider, state)
             # It's possible we could see providers that aren't in our config
-            if key in states:
-                states[key] += 1
-            else:
-                states[key] = 1
-
-        pipeline = self._statsd.pipeline()
-        for key, count in states.items():
-            pipeline.gauge(key, count)
+            states[key] = states.get(key, 0) + count
 
-        pipeline.send()
+        self.sendChangedGauges(states)
 
     def updateProviderLimits(self, provider):
         if not self._statsd:
@@ -185,7 +467,6 @@ class StatsReporter(object):
         if not self._statsd:
             return
 
-        pipeline = self._statsd.pipeline()
         provider_requests = {}
 
         provider_supported_labels = {}
@@ -197,15 +478,20 @@ class StatsReporter(object):
                 (pool.provider_name, pool.name)] = pool.supported_labels
             provider_requests[(pool.provider_name, pool.name)] = 0
 
-        for node_request in zk_conn.nodeRequestIterator(cached_ids=True):
+        # Requests are counted by the labels they request, so this is
+        # proportional to the number of distinct label combinations
+        # rather than the number of requests.
+        type_counts = zk_conn.getNodeRequestTypeCounts()
+        for node_types, count in type_counts.items():
             for (provider, pool), supported_labels in (
                     provider_supported_labels.items()):
                 if all(
                         label in supported_labels
-                        for label in node_request.node_types
+                        for label in node_types
                 ):
-                    provider_requests[(provider, pool)] += 1
+                    provider_requests[(provider, pool)] += count
 
+        gauges = {}
         for (provider_name,
              pool_name), requests_count in provider_requests.items():
             # nodepool.provider.PROVIDER.pool.POOL.addressable_requests
@@ -215,6 +501,6 @@ class StatsReporter(object):
                       "pool."
                       f"{pool_name}."
                       "addressable_requests")
-            pipeline.gauge(metric, requests_count)
+            gauges[metric] = requests_count
 
-        pipeline.send()
+        self.sendChangedGauges(gauges)
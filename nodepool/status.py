@@ -12,12 +12,20 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import bisect
+import collections
 from collections import OrderedDict
 import json
+import threading
 import time
 
 from prettytable import PrettyTable
 
+# The number of rows to send at a time when streaming JSON
+STREAM_BATCH_SIZE = 500
+# The number of state changes kept for clients to catch up on
+EVENT_HISTORY = 10000
+
 # General notes:
 #
 # All the _list functions should return a tuple
@@ -108,92 +116,148 @@ def output(results, fmt, fields=None):
         raise ValueError('Unknown format "%s"' % fmt)
 
 
-def node_list(zk, node_id=None):
-    headers_table = [
-        ("id", "ID"),
-        ("provider", "Provider"),
-        ("label", "Label"),
-        ("server_id", "Server ID"),
-        ("public_ipv4", "Public IPv4"),
-        ("ipv6", "IPv6"),
-        ("state", "State"),
-        ("age", "Age"),
-        ("locked", "Locked"),
-        ("pool", "Pool"),
-        ("hostname", "Hostname"),
-        ("private_ipv4", "Private IPv4"),
-        ("AZ", "AZ"),
-        ("username", "Username"),
-        ("connection_port", "Port"),
-        ("launcher", "Launcher"),
-        ("allocated_to", "Allocated To"),
-        ("hold_job", "Hold Job"),
-        ("comment", "Comment"),
-        ("user_data", "User Data"),
-        ("driver_data", "Driver Data"),
-    ]
-    headers_table = OrderedDict(headers_table)
+def stream_output(results, fmt, fields=None):
+    '''Generate output as the results are read
+
+    The ``json-lines`` format produces a line of JSON for each object
+    as soon as it is read; the other formats need every object first
+    and produce the whole output of :func:`output` at once.
 
-    def _get_node_values(node):
-        locked = "unlocked"
+    :param results: tuple (objs, headers) as returned by various _list
+                    functions
+    :param fmt: select from json-lines, ascii pretty-table or json
+    :param fields: list of fields to show
+    '''
+    objs, headers_table = results
+
+    if fmt == 'json-lines':
+        for obj in objs:
+            if fields:
+                obj = {k: v for k, v in obj.items() if k in fields}
+            yield json.dumps(obj)
+    else:
+        yield output(results, fmt, fields)
+
+
+NODE_HEADERS = OrderedDict([
+    ("id", "ID"),
+    ("provider", "Provider"),
+    ("label", "Label"),
+    ("server_id", "Server ID"),
+    ("public_ipv4", "Public IPv4"),
+    ("ipv6", "IPv6"),
+    ("state", "State"),
+    ("age", "Age"),
+    ("locked", "Locked"),
+    ("pool", "Pool"),
+    ("hostname", "Hostname"),
+    ("private_ipv4", "Private IPv4"),
+    ("AZ", "AZ"),
+    ("username", "Username"),
+    ("connection_port", "Port"),
+    ("launcher", "Launcher"),
+    ("allocated_to", "Allocated To"),
+    ("hold_job", "Hold Job"),
+    ("comment", "Comment"),
+    ("user_data", "User Data"),
+    ("driver_data", "Driver Data"),
+])
+
+
+def _node_values(zk, node, locked=None):
+    # The values of the NODE_HEADERS fields of a node, except that the
+    # age is the state time
+    if locked is None:
         if zk.enable_cache:
-            if node.lock_contenders:
-                locked = "locked"
+            locked = bool(node.lock_contenders)
         else:
-            if zk.getNodeLockContenders(node):
-                locked = "locked"
-        port = node.connection_port
-        try:
-            int(port)
-        except (ValueError, TypeError):
-            # The port field is being used to carry connection
-            # information which may contain credentials (e.g., k8s
-            # service account).  Suppress it.
-            port = "redacted"
-        values = [
-            node.id,
-            node.provider,
-            node.type,
-            node.external_id,
-            node.public_ipv4,
-            node.public_ipv6,
-            node.state,
-            age(node.state_time),
-            locked,
-            node.pool,
-            node.hostname,
-            node.private_ipv4,
-            node.az,
-            node.username,
-            port,
-            node.launcher,
-            node.allocated_to,
-            node.hold_job,
-            node.comment,
-            node.user_data,
-            node.driver_data,
-        ]
-        return values
+            locked = bool(zk.getNodeLockContenders(node))
+    locked = "locked" if locked else "unlocked"
+    port = node.connection_port
+    try:
+        int(port)
+    except (ValueError, TypeError):
+        # The port field is being used to carry connection
+        # information which may contain credentials (e.g., k8s
+        # service account).  Suppress it.
+        port = "redacted"
+    return [
+        node.id,
+        node.provider,
+        node.type,
+        node.external_id,
+        node.public_ipv4,
+        node.public_ipv6,
+        node.state,
+        node.state_time,
+        locked,
+        node.pool,
+        node.hostname,
+        node.private_ipv4,
+        node.az,
+        node.username,
+        port,
+        node.launcher,
+        node.allocated_to,
+        node.hold_job,
+        node.comment,
+        node.user_data,
+        node.driver_data,
+    ]
 
-    objs = []
-    if node_id:
-        node = zk.getNode(node_id)
-        if node:
-            values = _get_node_values(node)
-            objs.append(dict(zip(headers_table.keys(),
-                                 values)))
-    else:
-        cached_ids = zk.enable_cache
-        for node in zk.nodeIterator(cached_ids=cached_ids):
-            values = _get_node_values(node)
 
-            objs.append(dict(zip(headers_table.keys(),
-                                 values)))
+def node_list(zk, node_id=None, provider=None, label=None, state=None,
+              stream=False):
+    '''List nodes
+
+    Without the cache, nodes are read with pipelined requests, and
+    only the locks of the nodes which match the filters are read.
 
+    :param str node_id: only list this node
+    :param str provider: only list nodes of this provider
+    :param str label: only list nodes with this label
+    :param str state: only list nodes in this state
+    :param bool stream: return the objects as a generator which reads
+                        the nodes as it is iterated
+    '''
+    headers_table = NODE_HEADERS
+
+    def _matches(node):
+        return ((provider is None or node.provider == provider) and
+                (label is None or label in node.type) and
+                (state is None or node.state == state))
+
+    def _objs():
+        if node_id:
+            node = zk.getNode(node_id)
+            nodes = [(node, None)] if node and _matches(node) else []
+        elif zk.enable_cache:
+            nodes = ((node, None)
+                     for node in zk.nodeIterator(cached_ids=True)
+                     if _matches(node))
+        else:
+            nodes = zk.fetchNodeLocks(
+                node for node in zk.fetchNodes() if _matches(node))
+        for node, locked in nodes:
+            values = _node_values(zk, node, locked)
+            values[7] = age(node.state_time)
+            yield dict(zip(headers_table.keys(), values))
+
+    objs = _objs()
+    if not stream:
+        objs = list(objs)
     return (objs, headers_table)
 
 
-def dib_image_list(zk):
+def dib_image_list(zk, state=None, stream=False):
+    '''List image builds
+
+    Without the cache, builds are read with pipelined requests.
+
+    :param str state: only list builds in this state
+    :param bool stream: return the objects as a generator which reads
+                        the builds as it is iterated
+    '''
     headers_table = OrderedDict([
         ("id", "ID"),
         ("image", "Image"),
@@ -201,31 +265,31 @@ def dib_image_list(zk):
         ("formats", "Formats"),
         ("state", "State"),
         ("age", "Age")])
-    objs = []
-    builds = []
-    image_paused = {}
-    if zk.enable_cache:
-        builds = zk.getCachedBuilds()
-        for image in zk.getCachedImages():
-            image_paused[image.image_name] = image.paused
-    else:
-        for image_name in zk.getImageNames():
-            image_paused[image_name] = \
-                zk.getImagePaused(image_name)
-            for build_no in zk.getBuildIds(image_name):
-                build = zk.getBuild(image_name, build_no)
-                if build:
-                    builds.append(build)
-    for build in builds:
-        paused = image_paused.get(build._image_name, False)
-        state = paused and 'paused' or build.state
-        objs.append({'id': '-'.join([build._image_name, build.id]),
-                     'image': build._image_name,
-                     'builder': build.builder,
-                     'formats': build.formats,
-                     'state': state,
-                     'age': int(build.state_time)
-                     })
+
+    def _objs():
+        if zk.enable_cache:
+            image_paused = {}
+            for image in zk.getCachedImages():
+                image_paused[image.image_name] = image.paused
+            builds = ((build, image_paused.get(build._image_name, False))
+                      for build in zk.getCachedBuilds())
+        else:
+            builds = zk.fetchBuilds()
+        for build, paused in builds:
+            build_state = paused and 'paused' or build.state
+            if state is not None and build_state != state:
+                continue
+            yield {'id': '-'.join([build._image_name, build.id]),
+                   'image': build._image_name,
+                   'builder': build.builder,
+                   'formats': build.formats,
+                   'state': build_state,
+                   'age': int(build.state_time)
+                   }
+
+    objs = _objs()
+    if not stream:
+        objs = list(objs)
     return (objs, headers_table)
 
 
@@ -294,28 +358,54 @@ def image_list(zk):
     return (objs, headers_table)
 
 
-def request_list(zk):
-    headers_table = OrderedDict([
-        ("id", "Request ID"),
-        ("relative_priority", "Priority"),
-        ("state", "State"),
-        ("requestor", "Requestor"),
-        ("node_types", "Node Types"),
-        ("nodes", "Nodes"),
-        ("declined_by", "Declined By"),
-        ("event_id", "Event ID"),
-    ])
-    objs = []
-    cached_ids = zk.enable_cache
-    for req in zk.nodeRequestIterator(cached_ids=cached_ids):
-        values = [req.id, req.relative_priority,
-                  req.state, req.requestor,
-                  req.node_types,
-                  req.nodes,
-                  req.declined_by,
-                  req.event_id]
-        objs.append(dict(zip(headers_table.keys(),
-                             values)))
+REQUEST_HEADERS = OrderedDict([
+    ("id", "Request ID"),
+    ("relative_priority", "Priority"),
+    ("state", "State"),
+    ("requestor", "Requestor"),
+    ("node_types", "Node Types"),
+    ("nodes", "Nodes"),
+    ("declined_by", "Declined By"),
+    ("event_id", "Event ID"),
+])
+
+
+def _request_values(req):
+    return [req.id, req.relative_priority,
+            req.state, req.requestor,
+            req.node_types,
+            req.nodes,
+            req.declined_by,
+            req.event_id]
+
+
+def request_list(zk, provider=None, label=None, state=None, stream=False):
+    '''List node requests
+
+    Without the cache, requests are read with pipelined requests.
+
+    :param str provider: only list requests for this provider
+    :param str label: only list requests for this label
+    :param str state: only list requests in this state
+    :param bool stream: return the objects as a generator which reads
+                        the requests as it is iterated
+    '''
+    headers_table = REQUEST_HEADERS
+
+    def _objs():
+        if zk.enable_cache:
+            reqs = zk.nodeRequestIterator(cached_ids=True)
+        else:
+            reqs = zk.fetchNodeRequests()
+        for req in reqs:
+            if ((provider is None or req.provider == provider) and
+                    (label is None or label in req.node_types) and
+                    (state is None or req.state == state)):
+                yield dict(zip(headers_table.keys(), _request_values(req)))
+
+    objs = _objs()
+    if not stream:
+        objs = list(objs)
     return (objs, headers_table)
 
 
@@ -338,3 +428,287 @@ def label_list(zk):
         objs.append({'label': label})
 
     return (objs, headers_table)
+
+
+class StatusRow(object):
+    '''
+    A row of a status view, with its JSON serialization.
+
+    The age of an object changes without the object changing, so the
+    JSON is held in two parts either side of the age, which is
+    formatted as the row is output.
+    '''
+    __slots__ = ('values', 'head', 'state_time', 'tail', 'provider',
+                 'labels', 'state')
+
+    def __init__(self, headers_table, values, provider, labels, state):
+        self.values = values
+        self.provider = provider
+        self.labels = labels
+        self.state = state
+        obj = dict(zip(headers_table.keys(), values))
+        if 'age' in obj:
+            self.state_time = obj.pop('age')
+            keys = list(headers_table.keys())
+            split = keys.index('age')
+            head = json.dumps({k: obj[k] for k in keys[:split]})[1:-1]
+            tail = json.dumps({k: obj[k] for k in keys[split + 1:]})[1:-1]
+            self.head = ('{' + head + (', ' if head else '') +
+                         '"age": ').encode('utf8')
+            self.tail = ((', ' + tail if tail else '') + '}').encode('utf8')
+        else:
+            self.state_time = None
+            self.head = json.dumps(obj).encode('utf8')
+            self.tail = b''
+
+    def __eq__(self, other):
+        return (isinstance(other, StatusRow) and
+                self.head == other.head and
+                self.state_time == other.state_time and
+                self.tail == other.tail)
+
+    def json(self):
+        if self.state_time is None:
+            return self.head
+        return b'%s"%s"%s' % (self.head, age(self.state_time).encode('utf8'),
+                              self.tail)
+
+    def matches(self, provider=None, label=None, state=None):
+        return ((provider is None or provider == self.provider) and
+                (label is None or label in self.labels) and
+                (state is None or state == self.state))
+
+
+class StatusView(object):
+    '''
+    A status list kept up to date from the ZooKeeper cache.
+
+    The cache tells the view which objects may have changed; when the
+    view is next read, only their rows are rebuilt.  The version of
+    the view increases whenever a row changes.  Rows are kept in ID
+    order so that they can be paged through with a cursor.
+
+    :param ZooKeeper zk: A ZooKeeper object with caches enabled.
+    '''
+    # The name of the cache which holds the objects
+    cache = None
+    headers_table = None
+
+    def __init__(self, zk):
+        self.zk = zk
+        self.version = 0
+        self._lock = threading.Lock()
+        self._dirty = set()
+        self._rows = {}
+        self._ids = []
+        zk.addCacheListener(self._onChange)
+        self._dirty.update(self._getIds())
+
+    def _onChange(self, cache, object_id):
+        if cache == self.cache:
+            self._dirty.add(object_id)
+
+    def _getIds(self):
+        raise NotImplementedError()
+
+    def _getRow(self, object_id):
+        raise NotImplementedError()
+
+    def refresh(self):
+        '''
+        Rebuild the rows of the objects which may have changed.
+        '''
+        with self._lock:
+            changed = False
+            while self._dirty:
+                object_id = self._dirty.pop()
+                row = self._getRow(object_id)
+                old = self._rows.get(object_id)
+                if row == old:
+                    continue
+                changed = True
+                if row is None:
+                    del self._rows[object_id]
+                    del self._ids[bisect.bisect_left(self._ids, object_id)]
+                else:
+                    if old is None:
+                        bisect.insort(self._ids, object_id)
+                    self._rows[object_id] = row
+            if changed:
+                self.version += 1
+
+    def rows(self, provider=None, label=None, state=None,
+             after=None, limit=None):
+        '''
+        Return the matching rows in ID order, and the cursor from
+        which to continue if there are more than the limit.
+
+        :param str after: Start after the object with this ID.
+        :param int limit: The most rows to return.
+        '''
+        with self._lock:
+            start = bisect.bisect_right(self._ids, after) if after else 0
+            result = []
+            for object_id in self._ids[start:]:
+                row = self._rows[object_id]
+                if not row.matches(provider, label, state):
+                    continue
+                if limit is not None and len(result) >= limit:
+                    return result, result[-1].values[0]
+                result.append(row)
+            return result, None
+
+    def output(self, rows, fmt, fields=None):
+        '''
+        Generate output for rows of this view in the same form as
+        :py:func:`output`.
+        '''
+        if fmt == 'json':
+            return b''.join(self.iterJSON(rows))
+        objs = [dict(zip(self.headers_table.keys(), row.values))
+                for row in rows]
+        return output((objs, self.headers_table), fmt, fields)
+
+    def iterJSON(self, rows):
+        '''
+        Generate the JSON array of rows in chunks, so that it can be
+        sent as it is produced.
+        '''
+        yield b'['
+        for i in range(0, len(rows), STREAM_BATCH_SIZE):
+            chunk = b', '.join(row.json()
+                               for row in rows[i:i + STREAM_BATCH_SIZE])
+            yield (b', ' + chunk) if i else chunk
+        yield b']'
+
+
+class NodeListView(StatusView):
+    cache = 'nodes'
+    headers_table = NODE_HEADERS
+
+    def _getIds(self):
+        return [node.id for node in self.zk.nodeIterator(cached_ids=True)]
+
+    def _getRow(self, node_id):
+        node = self.zk.getNode(node_id, cached=True, only_cached=True)
+        if node is None:
+            return None
+        return StatusRow(self.headers_table, _node_values(self.zk, node),
+                         node.provider, node.type, node.state)
+
+
+class RequestListView(StatusView):
+    cache = 'requests'
+    headers_table = REQUEST_HEADERS
+
+    def _getIds(self):
+        return [req.id for req in self.zk.nodeRequestIterator(
+            cached_ids=True)]
+
+    def _getRow(self, request_id):
+        req = self.zk.getNodeRequest(request_id, cached=True,
+                                     only_cached=True)
+        if req is None:
+            return None
+        return StatusRow(self.headers_table, _request_values(req),
+                         req.provider, req.node_types, req.state)
+
+
+class StatusEvents(object):
+    '''
+    A feed of the state changes of nodes and node requests.
+
+    The ZooKeeper cache tells the feed which objects may have changed;
+    if the state of one has changed, or it was deleted, an event is
+    added to the feed.  Each event has a sequence number so that
+    clients can wait for the events after the last they have seen.
+
+    :param ZooKeeper zk: A ZooKeeper object with caches enabled.
+    :param int history: The number of events to keep.
+    '''
+    def __init__(self, zk, history=EVENT_HISTORY):
+        self.zk = zk
+        self.sequence = 0
+        self._events = collections.deque(maxlen=history)
+        # The last event of each object
+        self._last = {}
+        self._condition = threading.Condition()
+        self.closed = False
+        zk.addCacheListener(self._onChange)
+        # Only changes from now on are of interest
+        with self._condition:
+            for node in zk.nodeIterator(cached_ids=True):
+                self._last.setdefault(('nodes', node.id),
+                                      self._describe('nodes', node))
+            for req in zk.nodeRequestIterator(cached_ids=True):
+                self._last.setdefault(('requests', req.id),
+                                      self._describe('requests', req))
+
+    def _getObject(self, cache, object_id):
+        if cache == 'nodes':
+            return self.zk.getNode(object_id, cached=True, only_cached=True)
+        return self.zk.getNodeRequest(object_id, cached=True,
+                                      only_cached=True)
+
+    def _describe(self, cache, obj):
+        return {
+            'type': 'node' if cache == 'nodes' else 'request',
+            'id': obj.id,
+            'state': obj.state,
+            'provider': obj.provider,
+            'label': obj.type if cache == 'nodes' else obj.node_types,
+        }
+
+    def _onChange(self, cache, object_id):
+        obj = self._getObject(cache, object_id)
+        key = (cache, object_id)
+        with self._condition:
+            old = self._last.get(key)
+            if obj is None:
+                if old is None:
+                    return
+                # Describe the deleted object as it was
+                event = dict(old, state='deleted')
+                del self._last[key]
+            else:
+                if old is not None and old['state'] == obj.state:
+                    return
+                event = self._describe(cache, obj)
+                self._last[key] = event
+            self.sequence += 1
+            event = dict(event, time=time.time())
+            self._events.append((self.sequence, event))
+            self._condition.notify_all()
+
+    def close(self):
+        '''
+        Wake up and end all waiting clients.
+        '''
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+    def wait(self, after, timeout):
+        '''
+        Return the events after a sequence number, waiting up to the
+        timeout for one if there are none.
+
+        :param int after: The sequence number of the last event seen,
+            or None for only events from now on.
+        :param float timeout: The longest time to wait, in seconds.
+        :returns: A list of (sequence number, event) tuples, and the
+            sequence number to wait after next.
+        '''
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            if after is None or after > self.sequence:
+                after = self.sequence
+            while self.sequence <= after and not self.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            count = min(self.sequence - after, len(self._events))
+            events = [self._events[i] for i in
+                      range(len(self._events) - count, len(self._events))]
+            return events, self.sequence
@@ -371,19 +371,20 @@ class BuilderFixture(fixtures.Fixture):
     log = logging.getLogger("tests.BuilderFixture")
 
     def __init__(self, configfile, cleanup_interval, securefile=None,
-                 num_uploaders=1):
+                 num_uploaders=1, **kw):
         super(BuilderFixture, self).__init__()
         self.configfile = configfile
         self.securefile = securefile
         self.cleanup_interval = cleanup_interval
         self.builder = None
         self.num_uploaders = num_uploaders
+        self.kw = kw
 
     def setUp(self):
         super(BuilderFixture, self).setUp()
         self.builder = builder.NodePoolBuilder(
             self.configfile, secure_path=self.securefile,
-            num_uploaders=self.num_uploaders)
+            num_uploaders=self.num_uploaders, **self.kw)
         self.builder.cleanup_interval = self.cleanup_interval
         self.builder.build_interval = .1
         self.builder.upload_interval = .1
@@ -710,10 +711,10 @@ class DBTestCase(BaseTestCase):
         return app
 
     def useBuilder(self, configfile, securefile=None, cleanup_interval=.5,
-                   num_uploaders=1):
+                   num_uploaders=1, **kw):
         builder_fixture = self.useFixture(
             BuilderFixture(configfile, cleanup_interval, securefile,
-                           num_uploaders)
+                           num_uploaders, **kw)
         )
         return builder_fixture.builder
 
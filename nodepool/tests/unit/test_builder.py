@@ -13,14 +13,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import errno
+import hashlib
 import os
 import uuid
 import fixtures
 import mock
+import requests
 import socket
+import struct
+import threading
 import time
 
-from nodepool import builder, tests
+from nodepool import builder, buildlog, tests
 from nodepool.driver.fake import adapter as fakeadapter
 from nodepool.zk import zookeeper as zk
 from nodepool.config import Config
@@ -63,6 +68,211 @@ class TestNodepoolBuilderDibImage(tests.BaseTestCase):
         self.assertEqual(image.to_path('/imagedir/'),
                          '/imagedir/myid1234.qcow2')
 
+    def test_checksums(self):
+        tempdir = fixtures.TempDir()
+        self.useFixture(tempdir)
+        image_path = os.path.join(tempdir.path, 'myid1234.qcow2')
+        data = os.urandom(builder.CHECKSUM_CHUNK_SIZE + 100)
+        with open(image_path, 'wb') as f:
+            f.write(data)
+
+        checksums = builder.checksumImageFile(image_path)
+        self.assertEqual({
+            'md5': hashlib.md5(data).hexdigest(),
+            'sha256': hashlib.sha256(data).hexdigest(),
+        }, checksums)
+
+        # The checksum files are only read when needed
+        with open(image_path + '.md5', 'w') as f:
+            f.write('%s  myid1234.qcow2\n' % checksums['md5'])
+        image = builder.DibImageFile('myid1234', 'qcow2')
+        image.to_path(tempdir.path)
+        self.assertEqual(image_path + '.md5', image.md5_file)
+        self.assertIsNone(image.sha256_file)
+        self.assertEqual(checksums['md5'], image.md5)
+        self.assertIsNone(image.sha256)
+
+
+class TestNodepoolBuilderDedupe(tests.BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.images_dir = self.useFixture(fixtures.TempDir()).path
+
+    def _writeImage(self, name, data):
+        path = os.path.join(self.images_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_link_identical(self):
+        data = os.urandom(1024)
+        src = self._writeImage('image-0000000001.raw', data)
+        dest = self._writeImage('image-0000000002.raw', data)
+        builder.linkIdenticalImageFile(src, dest)
+        self.assertEqual(os.stat(src).st_ino, os.stat(dest).st_ino)
+        # Either build may be removed independently
+        os.unlink(src)
+        with open(dest, 'rb') as f:
+            self.assertEqual(data, f.read())
+
+    def test_dedupe_blocks(self):
+        block = builder.DEDUPE_BLOCK_SIZE
+        data = os.urandom(block * 4)
+        src = self._writeImage('image-0000000001.raw', data)
+        changed = data[:block] + os.urandom(block) + data[block * 2:]
+        dest = self._writeImage('image-0000000002.raw', changed)
+        try:
+            deduped = builder.dedupeImageFile(src, dest)
+        except OSError as e:
+            if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL):
+                self.skipTest("Filesystem does not support deduplication")
+            raise
+        self.assertEqual(block * 3, deduped)
+        with open(dest, 'rb') as f:
+            self.assertEqual(changed, f.read())
+
+
+class TestNodepoolBuilderDedupeRange(tests.BaseTestCase):
+    def _fakeIoctl(self, results):
+        # Record each request and answer it with the next of results
+        calls = []
+
+        def ioctl(fd, request, buf):
+            self.assertEqual(builder.FIDEDUPERANGE, request)
+            request = (struct.unpack_from('=QQHHI', buf, 0) +
+                       struct.unpack_from('=qQ', buf, 24))
+            calls.append((fd,) + request)
+            bytes_deduped, status = results.pop(0)
+            struct.pack_into('=qQQiI', buf, 24, request[5], request[6],
+                             bytes_deduped, status, 0)
+            return 0
+        self.useFixture(fixtures.MockPatch(
+            'nodepool.builder.fcntl.ioctl', side_effect=ioctl))
+        return calls
+
+    def test_dedupe_range(self):
+        limit = builder.DEDUPE_MAX_LENGTH
+        calls = self._fakeIoctl([
+            (limit, builder.FILE_DEDUPE_RANGE_SAME),
+            (100, builder.FILE_DEDUPE_RANGE_SAME),
+        ])
+        deduped = builder.dedupeFileRange(3, 10, 4, 20, limit + 100)
+        self.assertEqual(limit + 100, deduped)
+        # The range is split into requests of at most the limit, each
+        # with a single destination.
+        self.assertEqual([
+            (3, 10, limit, 1, 0, 0, 4, 20),
+            (3, 10 + limit, 100, 1, 0, 0, 4, 20 + limit),
+        ], calls)
+
+    def test_dedupe_range_differs(self):
+        calls = self._fakeIoctl([(0, 1)])
+        deduped = builder.dedupeFileRange(3, 0, 4, 0, 4096)
+        self.assertEqual(0, deduped)
+        self.assertEqual(1, len(calls))
+
+    def test_dedupe_range_short(self):
+        # Stop if the kernel makes no progress
+        calls = self._fakeIoctl([
+            (1024, builder.FILE_DEDUPE_RANGE_SAME),
+            (0, builder.FILE_DEDUPE_RANGE_SAME),
+        ])
+        deduped = builder.dedupeFileRange(3, 0, 4, 0, 4096)
+        self.assertEqual(1024, deduped)
+        self.assertEqual(2, len(calls))
+
+    def test_dedupe_range_error(self):
+        self._fakeIoctl([(0, -errno.EINVAL)])
+        e = self.assertRaises(OSError, builder.dedupeFileRange,
+                              3, 0, 4, 0, 4096)
+        self.assertEqual(errno.EINVAL, e.errno)
+
+
+class TestArtifactServer(tests.BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.images_dir = self.useFixture(fixtures.TempDir()).path
+        self.dest_dir = self.useFixture(fixtures.TempDir()).path
+        self.log_dir = self.useFixture(fixtures.TempDir()).path
+        self.server = builder.ArtifactServer(
+            self.images_dir, listen_address='localhost',
+            log_dir=self.log_dir)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.url = f'http://localhost:{self.server.port}/'
+
+    def _writeImage(self, name, data):
+        with open(os.path.join(self.images_dir, name), 'wb') as f:
+            f.write(data)
+        return hashlib.sha256(data).hexdigest()
+
+    def test_fetch(self):
+        name = 'image-%s.raw' % uuid.uuid4().hex
+        data = os.urandom(1024 * 10 + 7)
+        sha256 = self._writeImage(name, data)
+        dest = os.path.join(self.dest_dir, name)
+        builder.fetchArtifact(self.url + name, dest,
+                              sha256, chunk_size=1024)
+        with open(dest, 'rb') as f:
+            self.assertEqual(data, f.read())
+        self.assertFalse(
+            os.path.exists(dest + builder.ARTIFACT_PART_SUFFIX))
+
+    def test_fetch_resume(self):
+        name = 'image-%s.raw' % uuid.uuid4().hex
+        data = os.urandom(1024 * 10)
+        sha256 = self._writeImage(name, data)
+        dest = os.path.join(self.dest_dir, name)
+        with open(dest + builder.ARTIFACT_PART_SUFFIX, 'wb') as f:
+            f.write(data[:3000])
+        builder.fetchArtifact(self.url + name, dest,
+                              sha256, chunk_size=1024)
+        with open(dest, 'rb') as f:
+            self.assertEqual(data, f.read())
+
+    def test_fetch_checksum_mismatch(self):
+        name = 'image-%s.raw' % uuid.uuid4().hex
+        self._writeImage(name, os.urandom(1024))
+        dest = os.path.join(self.dest_dir, name)
+        self.assertRaises(
+            builder.exceptions.BuilderError,
+            builder.fetchArtifact, self.url + name, dest,
+            hashlib.sha256(b'other').hexdigest())
+        self.assertEqual([], os.listdir(self.dest_dir))
+
+    def test_only_images_served(self):
+        name = 'image-%s.raw' % uuid.uuid4().hex
+        self._writeImage('builder_id.txt', b'secret')
+        self._writeImage(name, b'image')
+        self._writeImage(name + '.sha256', b'checksum')
+        for other in ('builder_id.txt',
+                      'image-%s.raw' % uuid.uuid4().hex,
+                      '..%2F..%2Fetc%2Fpasswd'):
+            r = requests.get(self.url + other)
+            self.assertEqual(404, r.status_code)
+        r = requests.get(self.url + name)
+        self.assertEqual(b'image', r.content)
+        r = requests.get(self.url + name + '.sha256')
+        self.assertEqual(b'checksum', r.content)
+
+    def test_build_log(self):
+        # Build logs are named like the builder names them
+        name = '%s-%s.log' % ('image', uuid.uuid4().hex)
+        path = os.path.join(self.log_dir, name)
+        log = buildlog.BuildLog(path, compress=True)
+        log.write(b'started\n')
+        r = requests.get(self.url + 'logs/' + name, stream=True)
+        # Read the part written so far before the build finishes
+        self.assertEqual(b'started\n', r.raw.read(8))
+        log.write(b'finished\n')
+        log.close()
+        self.assertEqual(b'finished\n', r.raw.read())
+        # Finished logs are decompressed
+        r = requests.get(self.url + 'logs/' + name)
+        self.assertEqual(b'started\nfinished\n', r.content)
+        r = requests.get(self.url + 'logs/image-%s.log' % uuid.uuid4().hex)
+        self.assertEqual(404, r.status_code)
+
 
 class TestNodepoolBuilderImageInheritance(tests.BaseTestCase):
     def test_parent_job(self):
@@ -147,6 +357,134 @@ class TestNodepoolBuilderImageInheritance(tests.BaseTestCase):
         }, parsed.env_vars)
 
 
+class TestUploadQueue(tests.BaseTestCase):
+    def _pending(self, image_name, provider_name, priority=None,
+                 last_upload_time=0, build_id='0000000001'):
+        label = mock.Mock(diskimage=mock.Mock())
+        label.name = f'{image_name}-label'
+        label.diskimage.name = image_name
+        pool = mock.Mock(labels={label.name: label})
+        provider = mock.Mock(priority=priority, pools={'main': pool})
+        provider.name = provider_name
+        image = mock.Mock()
+        image.name = image_name
+        build = mock.Mock(id=build_id)
+        return builder.PendingUpload(provider, image, build, [],
+                                     last_upload_time)
+
+    def _request(self, state, labels):
+        req = zk.NodeRequest()
+        req.state = state
+        req.node_types = labels
+        return req
+
+    def test_upload_queue_order(self):
+        zk_client = mock.Mock()
+        zk_client.nodeRequestIterator.return_value = [
+            self._request(zk.REQUESTED, ['image2-label']),
+            self._request(zk.FULFILLED, ['image1-label'] * 5),
+        ]
+        queue = builder.UploadQueue(zk_client)
+        pending = [
+            self._pending('image1', 'provider1'),
+            self._pending('image1', 'provider2'),
+            self._pending('image2', 'provider1'),
+            self._pending('image3', 'provider1', priority=1),
+            self._pending('image4', 'provider3', last_upload_time=10),
+            self._pending('image5', 'provider3', last_upload_time=5),
+        ]
+
+        def image_order():
+            order = []
+            while True:
+                claimed = queue.claim(pending)
+                if not claimed:
+                    return order
+                order.append([p.key for p in claimed])
+
+        # Demand, then provider priority, then staleness; every
+        # provider needing a build is claimed at once.
+        self.assertEqual([
+            [('image2', 'provider1')],
+            [('image3', 'provider1')],
+            [('image1', 'provider1'), ('image1', 'provider2')],
+            [('image5', 'provider3')],
+            [('image4', 'provider3')],
+        ], image_order())
+        # Node requests are only counted periodically
+        self.assertEqual(1, zk_client.nodeRequestIterator.call_count)
+
+        claimed = pending[0:2]
+        queue.release(claimed)
+        self.assertEqual(claimed, queue.claim(pending))
+
+
+class TestBuildQueue(tests.BaseTestCase):
+    limits = {'max_load': 1.0, 'max_io_pressure': 50.0,
+              'min_free_space': 0}
+
+    def setUp(self):
+        super().setUp()
+        self.images_dir = self.useFixture(fixtures.TempDir()).path
+
+    def _pending(self, image_name, manual=False, overdue=0):
+        diskimage = mock.Mock()
+        diskimage.name = image_name
+        return builder.PendingBuild(diskimage, manual, overdue,
+                                    {f'{image_name}-label'})
+
+    def test_build_queue_order(self):
+        req = zk.NodeRequest()
+        req.state = zk.REQUESTED
+        req.node_types = ['image3-label']
+        zk_client = mock.Mock()
+        zk_client.nodeRequestIterator.return_value = [req]
+        queue = builder.BuildQueue(zk_client)
+        pending = [
+            self._pending('image1', overdue=10),
+            self._pending('image2', overdue=100),
+            self._pending('image3', overdue=1),
+            self._pending('image4', manual=True),
+        ]
+        order = []
+        while True:
+            claimed = queue.claim(pending)
+            if not claimed:
+                break
+            order.append(claimed.key)
+        # Manual requests, then demand, then how long overdue
+        self.assertEqual(['image4', 'image3', 'image2', 'image1'], order)
+        for p in pending:
+            self.assertIsNotNone(p.queued_time)
+
+    def test_build_queue_admission(self):
+        queue = builder.BuildQueue(mock.Mock())
+        p1 = self._pending('image1')
+        p2 = self._pending('image2')
+        self.assertEqual(p1, queue.claim([p1, p2]))
+        self.assertEqual(p2, queue.claim([p1, p2]))
+        self.useFixture(fixtures.MockPatch(
+            'nodepool.builder.getHostLoad', return_value=2.0))
+        self.useFixture(fixtures.MockPatch(
+            'nodepool.builder.getIOPressure', return_value=None))
+
+        # The first build is admitted regardless of load
+        self.assertTrue(queue.admit(p1, self.images_dir, self.limits))
+        # Another only once the first has settled and the load is low
+        self.assertFalse(queue.admit(p2, self.images_dir, self.limits))
+        queue._admit_time -= builder.BUILD_ADMISSION_SETTLE
+        self.assertFalse(queue.admit(p2, self.images_dir, self.limits))
+        builder.getHostLoad.return_value = 0.5
+        self.assertTrue(queue.admit(p2, self.images_dir, self.limits))
+
+        queue.release(p1)
+        queue.release(p2)
+        self.assertEqual(0, queue._building)
+        # Not enough free space for any build
+        limits = dict(self.limits, min_free_space=1024 * 1024)
+        self.assertFalse(queue.admit(p1, self.images_dir, limits))
+
+
 class TestNodePoolBuilder(tests.DBTestCase):
 
     def test_start_stop(self):
@@ -218,6 +556,40 @@ class TestNodePoolBuilder(tests.DBTestCase):
         # continue working with other providers after a failure).
         self.assertTrue(uploads4[0].state_time < uploads2[0].state_time)
 
+    def test_image_upload_concurrent(self):
+        """Test that a build is uploaded to both providers at once and
+        that a failure uploading to one does not affect the other."""
+        barrier = threading.Barrier(2, timeout=10)
+        failed = []
+        upload_image = builder.UploadWorker._uploadImage
+
+        def fake_upload_image(worker, build_id, upload_id, image_name,
+                              images, provider, *args, **kw):
+            if not failed:
+                # Both uploads must be in progress at the same time
+                barrier.wait()
+                if provider.name == 'fake-provider':
+                    failed.append(provider.name)
+                    raise Exception("Test upload failure")
+            return upload_image(worker, build_id, upload_id, image_name,
+                                images, provider, *args, **kw)
+
+        self.useFixture(fixtures.MockPatchObject(
+            builder.UploadWorker, '_uploadImage', fake_upload_image))
+
+        configfile = self.setup_config('node_two_provider.yaml')
+        self.useBuilder(configfile)
+        upload2 = self.waitForImage('fake-provider2', 'fake-image')
+        # The failed upload is retried, so its lock was released
+        upload1 = self.waitForImage('fake-provider', 'fake-image')
+        self.assertEqual(['fake-provider'], failed)
+        self.assertEqual(upload1.build_id, upload2.build_id)
+
+        for provider_name in ('fake-provider', 'fake-provider2'):
+            with self.zk.imageUploadLock('fake-image', upload1.build_id,
+                                         provider_name, blocking=False):
+                pass
+
     def test_provider_addition(self):
         configfile = self.setup_config('node.yaml')
         self.useBuilder(configfile)
@@ -280,6 +652,31 @@ class TestNodePoolBuilder(tests.DBTestCase):
         # second builder; we're really only interested in ZK.
         self.waitForBuild('fake-image1', check_files=False)
 
+    def test_image_upload_from_peer(self):
+        # The first builder makes the build and serves it; the second
+        # builder only uploads, to a provider the first does not use.
+        self.useFixture(fixtures.MonkeyPatch(
+            'nodepool.builder.PEER_UPLOAD_DELAY', 0))
+        configfile1 = self.setup_config('node.yaml')
+        builder1 = self.useBuilder(configfile1, cleanup_interval=0,
+                                   artifact_port=0,
+                                   artifact_listen_address='localhost',
+                                   artifact_host='localhost')
+        self.waitForImage('fake-provider', 'fake-image')
+        self.assertTrue(builder1.component_info.artifact_url)
+
+        configfile2 = self.setup_config('node_two_provider.yaml')
+        builder2 = self.useBuilder(configfile2, num_builders=0)
+        upload = self.waitForImage('fake-provider2', 'fake-image')
+        build = self.zk.getBuild('fake-image', upload.build_id)
+        self.assertEqual(builder1.component_info.id, build.builder_id)
+
+        path = os.path.join(builder2._config.images_dir,
+                            f'fake-image-{upload.build_id}.qcow2')
+        with open(path, 'rb') as f:
+            sha256 = hashlib.sha256(f.read()).hexdigest()
+        self.assertEqual(build.checksums['qcow2']['sha256'], sha256)
+
     def test_image_removal_dib_deletes_first(self):
         # Break cloud image deleting
         fake_client = fakeadapter.FakeDeleteImageFailCloud()
@@ -601,6 +998,39 @@ class TestNodePoolBuilder(tests.DBTestCase):
         self.waitForUploadRecordDeletion(image.provider_name, image.image_name,
                                          image.build_id, image.id)
 
+    def test_cleanup_expired_resumable_upload(self):
+        # A failed upload which saved its progress but is too old to
+        # be resumed has its partial image deleted from the cloud.
+        self.useFixture(fixtures.MockPatchObject(
+            builder, 'RESUMABLE_UPLOAD_AGE', 0))
+        configfile = self.setup_config('node.yaml')
+        bldr = self.useBuilder(configfile)
+        image = self.waitForImage('fake-provider', 'fake-image')
+
+        cleanup_mgr = bldr._janitor._config.provider_managers['fake-provider']
+        cleanup_mgr.abortImageUpload = mock.Mock()
+
+        resume_data = {'size': 1, 'segment_size': 1,
+                       'session': {'snapshot_id': 'snap-1'},
+                       'segments': {}}
+        upload = zk.ImageUpload()
+        upload.state = zk.FAILED
+        upload.external_name = 'fake-image-partial'
+        upload.resume_data = resume_data
+        with self.zk.imageUploadLock(image.image_name, image.build_id,
+                                     image.provider_name, blocking=True,
+                                     timeout=1):
+            upnum = self.zk.storeImageUpload(image.image_name,
+                                             image.build_id,
+                                             image.provider_name,
+                                             upload)
+
+        self.waitForUploadRecordDeletion(image.provider_name,
+                                         image.image_name,
+                                         image.build_id, upnum)
+        cleanup_mgr.abortImageUpload.assert_called_once_with(
+            'fake-image-partial', resume_data)
+
     def test_post_upload_hook(self):
         configfile = self.setup_config('node_upload_hook.yaml')
         bldr = self.useBuilder(configfile)
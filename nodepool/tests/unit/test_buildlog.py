@@ -0,0 +1,74 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import gzip
+import os
+import threading
+
+import fixtures
+
+from nodepool import buildlog
+from nodepool import tests
+
+
+class TestBuildLog(tests.BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.log_dir = self.useFixture(fixtures.TempDir()).path
+        self.useFixture(fixtures.MonkeyPatch(
+            'nodepool.buildlog.FLUSH_SIZE', 1000))
+        self.data = b''.join(b'line %d\n' % i for i in range(5000))
+
+    def _write(self, log, start, end):
+        for i in range(start, end, 512):
+            log.write(self.data[i:min(i + 512, end)])
+
+    def test_compressed(self):
+        path = os.path.join(self.log_dir, 'image-0000000001.log')
+        log = buildlog.BuildLog(path, compress=True)
+        self.assertEqual(log, buildlog.BuildLog.active['image-0000000001'])
+        self._write(log, 0, 10000)
+        # The flushed part of a running build can be read
+        readable = b''.join(buildlog.readBuildLog(log.path))
+        self.assertTrue(len(readable) >= 9000)
+        self.assertEqual(self.data[:len(readable)], readable)
+        self._write(log, 10000, len(self.data))
+        log.close()
+        self.assertNotIn('image-0000000001', buildlog.BuildLog.active)
+
+        self.assertEqual(path + '.gz', log.path)
+        with gzip.open(log.path) as f:
+            self.assertEqual(self.data, f.read())
+        self.assertTrue(len(buildlog.readBuildLogIndex(log.path)) > 40)
+        self.assertEqual(
+            self.data[12345:],
+            b''.join(buildlog.readBuildLog(log.path, 12345)))
+        self.assertEqual(
+            self.data[12345:20000],
+            b''.join(buildlog.readBuildLog(log.path, 12345, 20000)))
+
+    def test_follow(self):
+        for compress in (False, True):
+            path = os.path.join(self.log_dir, f'image-000000000{compress:d}')
+            log = buildlog.BuildLog(path + '.log', compress=compress)
+            self._write(log, 0, 20000)
+            followed = []
+            chunks = log.follow()
+            t = threading.Thread(
+                target=lambda: followed.append(b''.join(chunks)))
+            t.start()
+            self._write(log, 20000, len(self.data))
+            log.close()
+            t.join()
+            self.assertEqual(self.data, followed[0])
+            # Following a finished log reads it from the file
+            self.assertEqual(self.data, b''.join(log.follow()))
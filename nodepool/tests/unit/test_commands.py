@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import logging
 import os.path
 import shutil
@@ -161,6 +162,28 @@ class TestNodepoolCMD(tests.DBTestCase):
                 # node is not listed yet, retry later
                 pass
 
+    def test_list_nodes_json(self):
+        configfile = self.setup_config('node.yaml')
+        self.useBuilder(configfile)
+        self.waitForImage('fake-provider', 'fake-image')
+        pool = self.useNodepool(configfile, watermark_sleep=1)
+        self.startPool(pool)
+        nodes = self.waitForNodes('fake-label')
+
+        def list_nodes(*args):
+            self.patch_argv("-c", configfile, "list", "--json", *args)
+            with mock.patch('builtins.print') as m_print:
+                nodepoolcmd.main()
+            return [json.loads(call[0][0])
+                    for call in m_print.call_args_list]
+
+        rows = list_nodes('--provider', 'fake-provider',
+                          '--label', 'fake-label', '--state', zk.READY)
+        self.assertEqual([nodes[0].id], [row['id'] for row in rows])
+        self.assertEqual('unlocked', rows[0]['locked'])
+        self.assertEqual([], list_nodes('--provider', 'other-provider'))
+        self.assertEqual([], list_nodes('--state', zk.USED))
+
     def test_config_validate(self):
         config = os.path.join(os.path.dirname(tests.__file__),
                               'fixtures', 'config_validate', 'good.yaml')
@@ -0,0 +1,136 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import tempfile
+from unittest import mock
+
+import yaml
+
+from nodepool import config as nodepool_config
+from nodepool import tests
+
+
+def _static_provider(name, host, label='label1'):
+    return {
+        'name': name,
+        'driver': 'static',
+        'pools': [{
+            'name': 'main',
+            'nodes': [{
+                'name': host,
+                'labels': label,
+                'username': 'zuul',
+            }],
+        }],
+    }
+
+
+class TestConfigLoading(tests.BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.config = {
+            'zookeeper-servers': [{'host': 'localhost'}],
+            'labels': [{'name': 'label1'}, {'name': 'label2'}],
+            'diskimages': [{'name': 'image1'}],
+            'providers': [
+                _static_provider('provider1', 'host1'),
+                _static_provider('provider2', 'host2', 'label2'),
+            ],
+        }
+        fd, self.path = tempfile.mkstemp(suffix='.yaml')
+        os.close(fd)
+        self.addCleanup(os.unlink, self.path)
+
+    def _load(self, previous=None):
+        with open(self.path, 'w') as f:
+            yaml.safe_dump(self.config, f)
+        return nodepool_config.loadConfig(self.path, previous=previous)
+
+    def test_unchanged_providers_reused(self):
+        config1 = self._load()
+        self.config['providers'][1]['pools'][0]['nodes'][0]['name'] = 'host3'
+        self.config['labels'][0]['min-ready'] = 1
+        config2 = self._load(config1)
+
+        self.assertIs(config1.providers['provider1'],
+                      config2.providers['provider1'])
+        self.assertIsNot(config1.providers['provider2'],
+                         config2.providers['provider2'])
+        self.assertEqual(1, config2.labels['label1'].min_ready)
+        # The reused provider's pools are linked to the new labels
+        self.assertEqual(
+            [config1.providers['provider1'].pools['main']],
+            config2.labels['label1'].pools)
+        # The result is the same as loading from scratch
+        self.assertEqual(self._load(), config2)
+
+    def test_diskimage_change_reloads_providers(self):
+        config1 = self._load()
+        self.config['diskimages'][0]['rebuild-age'] = 3600
+        config2 = self._load(config1)
+        for name in ('provider1', 'provider2'):
+            self.assertIsNot(config1.providers[name],
+                             config2.providers[name])
+
+    def test_secure_diskimage_change_reloads_providers(self):
+        fd, secure_path = tempfile.mkstemp(suffix='.yaml')
+        os.close(fd)
+        self.addCleanup(os.unlink, secure_path)
+
+        def load(previous, env_vars):
+            with open(secure_path, 'w') as f:
+                yaml.safe_dump({'diskimages': [
+                    {'name': 'image1', 'env-vars': env_vars}]}, f)
+            with open(self.path, 'w') as f:
+                yaml.safe_dump(self.config, f)
+            return nodepool_config.loadConfig(
+                self.path, previous=previous,
+                secure_config_path=secure_path)
+
+        config1 = load(None, {'SECRET': 'a'})
+        config2 = load(config1, {'SECRET': 'a'})
+        self.assertIs(config1.providers['provider1'],
+                      config2.providers['provider1'])
+        config3 = load(config2, {'SECRET': 'b'})
+        self.assertEqual({'SECRET': 'b'},
+                         config3.diskimages['image1'].env_vars)
+        self.assertIsNot(config2.providers['provider1'],
+                         config3.providers['provider1'])
+
+    def test_removed_provider_not_reused(self):
+        # A provider which was dropped from the previous configuration,
+        # eg because it failed to start, is loaded again.
+        config1 = self._load()
+        del config1.providers['provider1']
+        config2 = self._load(config1)
+        self.assertIn('provider1', config2.providers)
+        self.assertIs(config1.providers['provider2'],
+                      config2.providers['provider2'])
+
+    def test_parse_cache(self):
+        def parses():
+            # Drivers may load other files, such as clouds.yaml
+            return len([c for c in m_load.call_args_list
+                        if isinstance(c[0][0], str)])
+
+        self._load()
+        with mock.patch('yaml.load', wraps=yaml.load) as m_load:
+            config1 = nodepool_config.openConfig(self.path, {})
+            config2 = nodepool_config.openConfig(self.path, {})
+            self.assertEqual(0, parses())
+            # Each caller gets its own copy
+            self.assertEqual(config1, config2)
+            self.assertIsNot(config1, config2)
+            self.config['labels'].append({'name': 'label3'})
+            self._load()
+            self.assertEqual(1, parses())
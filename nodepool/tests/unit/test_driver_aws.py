@@ -17,6 +17,7 @@ import base64
 
 import fixtures
 import logging
+import mock
 import urllib.parse
 
 import boto3
@@ -33,6 +34,7 @@ import nodepool.driver.statemachine
 from nodepool.driver.statemachine import StateMachineProvider
 import nodepool.driver.aws.adapter
 from nodepool.driver.aws.adapter import AwsInstance, AwsAdapter
+from nodepool.driver.utils import ParentImage
 
 from nodepool.tests.unit.fake_aws import FakeAws
 
@@ -1598,3 +1600,40 @@ class TestDriverAws(tests.DBTestCase):
         # Make sure the second high node exists now.
         req2 = self.waitForNodeRequest(req2)
         self.assertSuccess(req2)
+
+
+class TestAwsParentSnapshot(tests.BaseTestCase):
+    def _getParentSnapshot(self, tags, sha256='abc'):
+        adapter = mock.MagicMock()
+        adapter.ec2_client.describe_images.return_value = {'Images': [{
+            'ImageId': 'ami-1',
+            'Tags': [{'Key': k, 'Value': v} for k, v in tags.items()],
+            'BlockDeviceMappings': [{
+                'Ebs': {'SnapshotId': 'snap-1', 'VolumeSize': 1},
+            }],
+        }]}
+        parent = ParentImage('ami-1', mock.Mock(), sha256)
+        return AwsAdapter._getParentSnapshot(adapter, parent, 1)
+
+    def test_parent_ebs_direct(self):
+        self.assertEqual('snap-1', self._getParentSnapshot({
+            'nodepool_import_method': 'ebs-direct',
+            'nodepool_image_format': 'raw',
+            'nodepool_image_sha256': 'abc',
+        }))
+
+    def test_parent_import_image_rejected(self):
+        # AWS rewrites images imported with the image method, so the
+        # snapshot does not match the parent's image file.
+        self.assertIsNone(self._getParentSnapshot({
+            'nodepool_image_sha256': 'abc',
+        }))
+
+    def test_parent_other_file_rejected(self):
+        tags = {
+            'nodepool_import_method': 'ebs-direct',
+            'nodepool_image_format': 'raw',
+            'nodepool_image_sha256': 'abc',
+        }
+        self.assertIsNone(self._getParentSnapshot(tags, sha256='def'))
+        self.assertIsNone(self._getParentSnapshot(tags, sha256=None))
@@ -12,7 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import logging
 import os
+import subprocess
+import sys
+import textwrap
 
 from nodepool import tests
 from nodepool.driver import Drivers
@@ -37,3 +42,57 @@ class TestDrivers(tests.DBTestCase):
         configfile = self.setup_config('multi_drivers.yaml')
         self.useBuilder(configfile)
         self.waitForImage('fake-provider', 'fake-image')
+
+
+class TestDriverLoading(tests.BaseTestCase):
+    log = logging.getLogger("nodepool.TestDriverLoading")
+
+    # The cloud libraries which only the drivers that use them import
+    HEAVY_MODULES = ['boto3', 'openstack', 'kubernetes', 'googleapiclient',
+                     'azure', 'ibm_vpc']
+
+    def _run(self, script):
+        # Import in a new interpreter so that the modules imported by
+        # other tests do not count
+        script = textwrap.dedent(script) + textwrap.dedent("""
+            import json
+            print(json.dumps({
+                'elapsed': time.monotonic() - start,
+                'modules': sorted(set(m.split('.')[0]
+                                      for m in sys.modules)),
+            }))
+        """)
+        out = subprocess.check_output([sys.executable, '-c', script])
+        return json.loads(out.decode('utf8').splitlines()[-1])
+
+    def test_cli_import_time(self):
+        result = self._run("""
+            import sys
+            import time
+            start = time.monotonic()
+            import nodepool.cmd.nodepoolcmd  # noqa
+            from nodepool.driver import Drivers
+            Drivers.load()
+            Drivers.get('static')
+        """)
+        self.log.info("Imported the CLI and static driver in %.3f seconds",
+                      result['elapsed'])
+        for module in self.HEAVY_MODULES:
+            self.assertNotIn(module, result['modules'])
+
+    def test_driver_loaded_on_use(self):
+        result = self._run("""
+            import sys
+            import time
+            start = time.monotonic()
+            from nodepool.driver import Drivers
+            Drivers.load()
+            assert 'aws' in Drivers.manifest
+            assert 'aws' not in Drivers.drivers
+            Drivers.get('aws')
+        """)
+        self.assertNotIn('openstack', result['modules'])
+        self.assertNotIn('boto3', result['modules'])
+
+    def test_unknown_driver(self):
+        self.assertRaises(RuntimeError, Drivers.get, 'no-such-driver')
@@ -0,0 +1,87 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from nodepool import forecast
+from nodepool import tests
+
+# A time at the start of a day
+START = 1000 * forecast.DAY
+
+
+class TestDemandForecast(tests.BaseTestCase):
+    def _forecast(self):
+        f = forecast.DemandForecast(interval=60, half_life=60)
+        f._interval_start = START
+        return f
+
+    def _record(self, f, label, count, start, interval=60):
+        for i in range(count):
+            f.recordRequest([label], now=start + i * interval / count)
+
+    def test_no_demand(self):
+        f = self._forecast()
+        self.assertEqual(1, f.getMinReady('fake-label', 1, 10, 300, START))
+        self._record(f, 'other-label', 10, START)
+        self.assertEqual(
+            1, f.getMinReady('fake-label', 1, 10, 300, START + 60))
+
+    def test_rate(self):
+        f = self._forecast()
+        # Six requests a minute, for five minutes
+        for minute in range(5):
+            self._record(f, 'fake-label', 6, START + minute * 60)
+        # Ten seconds of lead time needs one node
+        self.assertEqual(
+            1, f.getMinReady('fake-label', 0, 10, 10, START + 300))
+        # Five minutes needs thirty, but no more than the ceiling
+        self.assertEqual(
+            10, f.getMinReady('fake-label', 0, 10, 300, START + 300))
+        self.assertEqual(
+            30, f.getMinReady('fake-label', 0, 50, 300, START + 300))
+
+    def test_decay(self):
+        f = self._forecast()
+        self._record(f, 'fake-label', 60, START)
+        self.assertEqual(
+            60, f.getMinReady('fake-label', 0, 100, 60, START + 60))
+        # The rate halves each minute without requests; the forecast
+        # for the next minute also considers the same minute of the
+        # day before, when there were no requests.
+        self.assertEqual(
+            30, f.getMinReady('fake-label', 0, 100, 60, START + 120))
+        self.assertEqual(
+            15, f.getMinReady('fake-label', 0, 100, 60, START + 180))
+        self.assertEqual(
+            2, f.getMinReady('fake-label', 2, 100, 60, START + 3600))
+
+    def test_daily_profile(self):
+        f = self._forecast()
+        # A burst of requests at the same time every day
+        peak = 12 * 3600
+        for day in range(3):
+            self._record(f, 'fake-label', 60,
+                         START + day * forecast.DAY + peak)
+        # Shortly before the next peak, the recent rate is zero but
+        # the daily profile anticipates the burst.
+        now = START + 3 * forecast.DAY + peak - 30
+        self.assertEqual(0, f.getMinReady('fake-label', 0, 100, 10, now))
+        self.assertEqual(60, f.getMinReady('fake-label', 0, 100, 60, now))
+
+    def test_hits(self):
+        f = self._forecast()
+        f.setReady('fake-label', 2)
+        self._record(f, 'fake-label', 3, START)
+        rate, hits, misses = f.getStats('fake-label')
+        self.assertEqual(2, hits)
+        self.assertEqual(1, misses)
+        # The counts are reset once reported
+        self.assertEqual((0, 0), f.getStats('fake-label')[1:])
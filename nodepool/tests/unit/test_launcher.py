@@ -22,6 +22,7 @@ import socket
 import testtools
 
 from nodepool import tests
+from nodepool import tracing
 import nodepool.exceptions
 from nodepool.zk import zookeeper as zk
 from nodepool.zk.components import PoolComponent
@@ -969,6 +970,118 @@ class TestLauncher(tests.DBTestCase):
         self.assertEqual(nodes[0].provider, 'fake-provider')
         self.assertEqual(nodes[0].type, ['fake-label'])
 
+    def test_min_ready_requests_completed(self):
+        """Test that fulfilled min-ready requests are removed"""
+        configfile = self.setup_config('node.yaml')
+        self.useBuilder(configfile)
+        self.waitForImage('fake-provider', 'fake-image')
+        pool = self.useNodepool(configfile, watermark_sleep=1)
+        self.startPool(pool)
+        nodes = self.waitForNodes('fake-label')
+        self.assertEqual(1, len(nodes))
+        self.assertIsNone(nodes[0].allocated_to)
+
+        for _ in iterate_timeout(60, Exception,
+                                 "min-ready requests removed",
+                                 interval=1):
+            if not pool._submittedRequests and not self.zk.getNodeRequests():
+                break
+
+    def test_min_ready_request_delete_fails(self):
+        """Test that removing a min-ready request is retried"""
+        delete_request = zk.ZooKeeper.deleteNodeRequestAsync
+        failed = []
+
+        def fail_delete(zk_conn, request):
+            if failed:
+                return delete_request(zk_conn, request)
+            failed.append(request.id)
+            result = zk_conn.kazoo_client.handler.async_result()
+            result.set_exception(Exception("Test delete failure"))
+            return result
+
+        self.useFixture(fixtures.MockPatchObject(
+            zk.ZooKeeper, 'deleteNodeRequestAsync', fail_delete))
+
+        configfile = self.setup_config('node.yaml')
+        self.useBuilder(configfile)
+        self.waitForImage('fake-provider', 'fake-image')
+        pool = self.useNodepool(configfile, watermark_sleep=1)
+        self.startPool(pool)
+        nodes = self.waitForNodes('fake-label')
+        self.assertEqual(1, len(nodes))
+
+        for _ in iterate_timeout(60, Exception,
+                                 "min-ready requests removed",
+                                 interval=1):
+            if not pool._submittedRequests and not self.zk.getNodeRequests():
+                break
+        self.assertEqual(1, len(failed))
+        self.assertEqual({}, pool._unremovedRequests)
+        self.assertIsNone(self.zk.getNode(nodes[0].id).allocated_to)
+
+    def test_min_ready_request_fulfilled_while_locked(self):
+        """Test that min-ready requests are removed if the cache drops
+        the update which fulfilled them"""
+        unlock_request = zk.ZooKeeper.unlockNodeRequest
+
+        def slow_unlock(zk_conn, request):
+            if request.state == zk.FULFILLED:
+                # Hold the lock until the cache has seen the update
+                # and ignored it because the request is locked.
+                time.sleep(2)
+            return unlock_request(zk_conn, request)
+
+        self.useFixture(fixtures.MockPatchObject(
+            zk.ZooKeeper, 'unlockNodeRequest', slow_unlock))
+
+        configfile = self.setup_config('node.yaml')
+        self.useBuilder(configfile)
+        self.waitForImage('fake-provider', 'fake-image')
+        pool = self.useNodepool(configfile, watermark_sleep=1)
+        self.startPool(pool)
+        nodes = self.waitForNodes('fake-label')
+        self.assertEqual(1, len(nodes))
+
+        for _ in iterate_timeout(60, Exception,
+                                 "min-ready requests removed",
+                                 interval=1):
+            if not pool._submittedRequests and not self.zk.getNodeRequests():
+                break
+        self.assertIsNone(self.zk.getNode(nodes[0].id).allocated_to)
+
+    def test_request_timeline(self):
+        """Test that the timeline of a request is recorded"""
+        configfile = self.setup_config('node_no_min_ready.yaml')
+        self.useBuilder(configfile)
+        self.waitForImage('fake-provider', 'fake-image')
+        pool = self.useNodepool(configfile, watermark_sleep=1)
+        self.startPool(pool)
+
+        req = zk.NodeRequest()
+        req.state = zk.REQUESTED
+        req.node_types.append('fake-label')
+        self.zk.storeNodeRequest(req)
+        req = self.waitForNodeRequest(req)
+        self.assertEqual(req.state, zk.FULFILLED)
+
+        for _ in iterate_timeout(30, Exception, "timeline finished"):
+            timeline = pool.tracer.get(req.id)
+            if timeline and timeline.get(zk.FULFILLED):
+                break
+        events = [e for e, t in timeline.events]
+        self.assertIn('seen', events)
+        self.assertIn('locked', events)
+        self.assertEqual(zk.FULFILLED, events[-1])
+        self.assertIn('assign', timeline.phases(tracing.REQUEST_PHASES))
+        node = timeline.node(req.nodes[0])
+        self.assertEqual(
+            ['init', 'building', 'started', 'created', 'nodescan-start',
+             'nodescan-end', zk.READY],
+            [e for e, t in node.events])
+        self.assertEqual({'start', 'create', 'nodescan'},
+                         set(node.phases(tracing.NODE_PHASES)))
+
     def test_disabled_label(self):
         """Test that a node is not created with min-ready=0"""
         configfile = self.setup_config('node_disabled_label.yaml')
@@ -2872,3 +2985,23 @@ class TestLauncher(tests.DBTestCase):
             'main.'
             'addressable_requests',
             value='2', kind='g')
+
+
+class TestLauncherForecast(tests.BaseTestCase):
+    def _request(self, request_id, created_time):
+        req = zk.NodeRequest(request_id)
+        req.state = zk.REQUESTED
+        req.node_types = ['fake-label']
+        req.created_time = created_time
+        return req
+
+    def test_forecast_skips_old_requests(self):
+        pool = nodepool.launcher.NodePool('secure.conf', 'nodepool.yaml')
+        # Requests delivered by the initial fill of the cache were
+        # created before the launcher started.
+        old = self._request('100-0000000001', pool._start_time - 60)
+        pool._onRequestChange(old.id, old)
+        new = self._request('100-0000000002', time.time())
+        pool._onRequestChange(new.id, new)
+        rate, hits, misses = pool.forecast.getStats('fake-label')
+        self.assertEqual(1, hits + misses)
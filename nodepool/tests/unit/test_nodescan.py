@@ -15,7 +15,7 @@
 
 from nodepool import exceptions
 from nodepool import tests
-from nodepool.nodeutils import iterate_timeout
+from nodepool.nodeutils import HostKeyCache, iterate_timeout
 from nodepool.zk.zookeeper import Node
 from nodepool.driver.statemachine import NodescanWorker, NodescanRequest
 from unittest.mock import patch
@@ -222,3 +222,68 @@ class TestNodescanWorker(tests.BaseTestCase):
         self.assertEqual(result2, ['fake key fake base64'])
         worker.stop()
         worker.join()
+
+    @patch('paramiko.transport.Transport')
+    @patch('socket.socket')
+    @patch('select.epoll')
+    def test_nodescan_host_key_cache(
+            self, mock_epoll, mock_socket, mock_transport):
+        # Test that fresh cached keys skip the key exchange
+        fake_socket = FakeSocket()
+        mock_socket.return_value = fake_socket
+        mock_epoll.return_value = FakePoll()
+        mock_transport.return_value = FakeTransport()
+        cache = HostKeyCache()
+        worker = NodescanWorker()
+        node = Node()
+        node.id = '1'
+        node.interface_ip = '198.51.100.1'
+        node.connection_port = 22
+        node.connection_type = 'ssh'
+        node.host_keys = ['fake key fake base64']
+        worker.start()
+
+        # The first scan populates the cache
+        request = NodescanRequest(node, True, 300, host_key_cache=cache)
+        worker.addRequest(request)
+        for _ in iterate_timeout(30, Exception, 'nodescan'):
+            if request.complete:
+                break
+        self.assertEqual(request.result(), ['fake key fake base64'])
+        self.assertFalse(request.used_cached_keys)
+        self.assertEqual(cache.get('198.51.100.1', 22),
+                         ['fake key fake base64'])
+
+        # The second only connects
+        mock_transport.reset_mock()
+        request = NodescanRequest(node, True, 300, host_key_cache=cache)
+        worker.addRequest(request)
+        for _ in iterate_timeout(30, Exception, 'nodescan'):
+            if request.complete:
+                break
+        self.assertEqual(request.result(), ['fake key fake base64'])
+        self.assertTrue(request.used_cached_keys)
+        mock_transport.assert_not_called()
+        worker.stop()
+        worker.join()
+
+
+class TestHostKeyCache(tests.BaseTestCase):
+
+    def test_host_key_cache(self):
+        cache = HostKeyCache(ttl=300)
+        self.assertIsNone(cache.get('host', 22))
+        cache.put('host', 22, ['ssh-rsa KEY1', 'ssh-ed25519 KEY2'])
+        self.assertEqual(cache.get('host', 22),
+                         ['ssh-rsa KEY1', 'ssh-ed25519 KEY2'])
+        self.assertIsNone(cache.get('host', 2222))
+        self.assertEqual(cache.validate('host', 22, ['ssh-rsa KEY1']),
+                         ['ssh-rsa KEY1', 'ssh-ed25519 KEY2'])
+        # A mismatch invalidates the entry
+        self.assertIsNone(cache.validate('host', 22, ['ssh-rsa OTHER']))
+        self.assertIsNone(cache.get('host', 22))
+
+    def test_host_key_cache_ttl(self):
+        cache = HostKeyCache(ttl=-1)
+        cache.put('host', 22, ['ssh-rsa KEY1'])
+        self.assertIsNone(cache.get('host', 22))
@@ -0,0 +1,111 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import threading
+
+import fixtures
+import webob
+
+from nodepool import profiler
+from nodepool import tests
+from nodepool import webapp
+from nodepool.nodeutils import iterate_timeout
+
+
+def profiledWait(event):
+    event.wait()
+
+
+class TestSamplingProfiler(tests.BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.event = threading.Event()
+        self.thread = threading.Thread(
+            target=profiledWait, args=(self.event,), name='TestWorker.1')
+        self.thread.start()
+        self.addCleanup(self.thread.join)
+        self.addCleanup(self.event.set)
+
+    def _stacks(self, output):
+        stacks = {}
+        for line in output.splitlines():
+            stack, count = line.rsplit(' ', 1)
+            stacks[stack] = int(count)
+        return stacks
+
+    def test_sample(self):
+        prof = profiler.SamplingProfiler()
+        prof.sample()
+        prof.sample()
+        self.assertEqual(2, prof.samples)
+        stacks = self._stacks(prof.collapsed(thread='TestWorker'))
+        self.assertEqual(1, len(stacks))
+        stack, count = stacks.popitem()
+        self.assertEqual(2, count)
+        frames = stack.split(';')
+        self.assertEqual('TestWorker.1', frames[0])
+        self.assertIn('profiledWait (test_profiler.py:', stack)
+        # The sampling thread itself is never recorded
+        self.assertNotIn('MainThread', prof.collapsed())
+        prof.clear()
+        self.assertEqual('', prof.collapsed())
+
+    def test_start_stop(self):
+        prof = profiler.SamplingProfiler()
+        prof.start(interval=0.01)
+        self.assertTrue(prof.running)
+        for _ in iterate_timeout(10, Exception, "samples"):
+            if prof.samples >= 2:
+                break
+        prof.stop()
+        self.assertFalse(prof.running)
+        samples = prof.samples
+        self.assertIn('TestWorker.1', prof.collapsed())
+
+        # A profile with a duration stops itself
+        prof.start(interval=0.01, duration=0.1)
+        for _ in iterate_timeout(10, Exception, "profiler stopped"):
+            if not prof.running:
+                break
+        self.assertGreater(prof.samples, samples)
+
+    def test_webapp(self):
+        prof = profiler.SamplingProfiler()
+        self.useFixture(fixtures.MonkeyPatch(
+            'nodepool.profiler.PROFILER', prof))
+        web = webapp.WebApp.__new__(webapp.WebApp)
+        web.profiler = False
+        app = webob.dec.wsgify(web.app)
+
+        def call(path, method='GET'):
+            return webob.Request.blank(path, method=method).get_response(app)
+
+        # The profiler may only be controlled if enabled
+        self.assertEqual(403, call('/profile/start', 'POST').status_code)
+        self.assertFalse(prof.running)
+        web.profiler = True
+
+        self.assertEqual(405, call('/profile/start').status_code)
+        resp = call('/profile/start?interval=0.01', 'POST')
+        self.assertTrue(json.loads(resp.text)['running'])
+        for _ in iterate_timeout(10, Exception, "samples"):
+            if json.loads(call('/profile/status').text)['samples'] >= 2:
+                break
+        resp = call('/profile/stop', 'POST')
+        self.assertFalse(json.loads(resp.text)['running'])
+
+        resp = call('/profile?thread=TestWorker')
+        self.assertEqual('text/plain', resp.content_type)
+        self.assertTrue(resp.text.startswith('TestWorker.1;'))
+        self.assertEqual('', call('/profile?thread=Other').text)
+        self.assertEqual(404, call('/profile/other').status_code)
@@ -0,0 +1,159 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from unittest import mock
+
+from nodepool import stats
+from nodepool import tests
+from nodepool.zk import zookeeper as zk
+
+
+class TestStatsReporter(tests.BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.statsd = mock.Mock()
+        self.pipeline = self.statsd.pipeline.return_value
+        self.reporter = stats.StatsReporter(self.statsd)
+
+    def _sent(self):
+        sent = {c.args[0]: c.args[1]
+                for c in self.pipeline.gauge.call_args_list}
+        self.pipeline.gauge.reset_mock()
+        return sent
+
+    def test_node_stats(self):
+        zk_conn = mock.Mock()
+        pool = mock.Mock(supported_labels={'label1'}, provider_name='p1')
+        pool.name = 'main'
+        zk_conn.getRegisteredPools.return_value = [pool]
+        zk_conn.getNodeSummaryCounts.return_value = {
+            (zk.READY, 'p1', ('label1',)): 2,
+            (zk.READY, 'p2', ('label1', 'label2')): 1,
+        }
+        self.reporter.updateNodeStats(zk_conn)
+        sent = self._sent()
+        self.assertEqual(3, sent['nodepool.nodes.ready'])
+        self.assertEqual(3, sent['nodepool.label.label1.nodes.ready'])
+        self.assertEqual(1, sent['nodepool.label.label2.nodes.ready'])
+        self.assertEqual(2, sent['nodepool.provider.p1.nodes.ready'])
+        self.assertEqual(1, sent['nodepool.provider.p2.nodes.ready'])
+        self.assertEqual(0, sent['nodepool.nodes.building'])
+
+        # Only the gauges which changed are sent again
+        zk_conn.getNodeSummaryCounts.return_value = {
+            (zk.READY, 'p1', ('label1',)): 1,
+            (zk.IN_USE, 'p1', ('label1',)): 1,
+            (zk.READY, 'p2', ('label1', 'label2')): 1,
+        }
+        self.reporter.updateNodeStats(zk_conn)
+        self.assertEqual({
+            'nodepool.nodes.ready': 2,
+            'nodepool.nodes.in-use': 1,
+            'nodepool.label.label1.nodes.ready': 2,
+            'nodepool.label.label1.nodes.in-use': 1,
+            'nodepool.provider.p1.nodes.ready': 1,
+            'nodepool.provider.p1.nodes.in-use': 1,
+        }, self._sent())
+
+        # Every gauge is sent once the refresh interval passes
+        self.reporter._gauges_refreshed -= stats.GAUGE_REFRESH_INTERVAL
+        self.reporter.updateNodeStats(zk_conn)
+        self.assertEqual(0, self._sent()['nodepool.nodes.building'])
+
+    def test_node_request_stats(self):
+        zk_conn = mock.Mock()
+        pool = mock.Mock(supported_labels={'label1', 'label2'},
+                         provider_name='p1')
+        pool.name = 'main'
+        zk_conn.getRegisteredPools.return_value = [pool]
+        zk_conn.getNodeRequestTypeCounts.return_value = {
+            ('label1',): 3,
+            ('label1', 'label2'): 2,
+            ('label3',): 1,
+        }
+        self.reporter.updateNodeRequestStats(zk_conn)
+        self.assertEqual(
+            {'nodepool.provider.p1.pool.main.addressable_requests': 5},
+            self._sent())
+
+
+class TestMetricsRegistry(tests.BaseTestCase):
+    def test_render(self):
+        registry = stats.MetricsRegistry()
+        counter = registry.counter('test_total', 'A counter', ('name',))
+        counter.inc(name='a')
+        counter.inc(2, name='a')
+        counter.inc(name='b"\n')
+        self.assertIs(counter, registry.counter('test_total', 'A counter',
+                                                ('name',)))
+        self.assertRaises(ValueError, registry.gauge, 'test_total', 'A')
+        self.assertRaises(ValueError, counter.inc, other='a')
+        gauge = registry.gauge('test_gauge', 'A gauge')
+        gauge.set(1.5)
+        histogram = registry.histogram('test_seconds', 'A histogram',
+                                       ('name',), buckets=(1, 10))
+        histogram.observe(0.5, name='a')
+        histogram.observe(1, name='a')
+        histogram.observe(20, name='a')
+        self.assertEqual((3, 21.5), histogram.get(name='a'))
+
+        self.assertEqual([
+            '# HELP test_gauge A gauge',
+            '# TYPE test_gauge gauge',
+            'test_gauge 1.5',
+            '# HELP test_seconds A histogram',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{name="a",le="1"} 2',
+            'test_seconds_bucket{name="a",le="10"} 2',
+            'test_seconds_bucket{name="a",le="+Inf"} 3',
+            'test_seconds_sum{name="a"} 21.5',
+            'test_seconds_count{name="a"} 3',
+            '# HELP test_total A counter',
+            '# TYPE test_total counter',
+            'test_total{name="a"} 3',
+            'test_total{name="b\\"\\n"} 1',
+        ], registry.render().splitlines())
+
+
+class TestInstrumented(tests.BaseTestCase):
+    def test_instrumented(self):
+        @zk.instrumented
+        def testInner():
+            pass
+
+        @zk.instrumented
+        def testOuter():
+            testInner()
+
+        def counts():
+            return {op: count for (op, subsystem), count in
+                    stats.ZK_OPERATIONS.values().items()
+                    if op.startswith('test')}
+
+        def timed():
+            return {op: count for (op, subsystem), (count, total) in
+                    stats.ZK_OPERATION_SECONDS.totals().items()
+                    if op.startswith('test')}
+
+        # Every call is counted but only those sampled are timed
+        with mock.patch('random.random', return_value=0.5):
+            for i in range(5):
+                testOuter()
+        self.assertEqual({'testOuter': 5}, counts())
+        self.assertEqual({}, timed())
+
+        # Calls within another operation count as part of it
+        with mock.patch('random.random', return_value=0.0):
+            for i in range(3):
+                testOuter()
+        self.assertEqual({'testOuter': 8}, counts())
+        self.assertEqual({'testOuter': 3}, timed())
@@ -0,0 +1,185 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import threading
+
+from nodepool import status
+from nodepool import tests
+from nodepool.nodeutils import iterate_timeout
+from nodepool.zk import zookeeper as zk
+
+
+class FakeZooKeeper(object):
+    enable_cache = True
+
+    def __init__(self):
+        self.nodes = {}
+        self.listeners = []
+        self.gets = 0
+
+    def addCacheListener(self, listener):
+        self.listeners.append(listener)
+
+    def nodeIterator(self, cached_ids=False):
+        return list(self.nodes.values())
+
+    def getNode(self, node_id, cached=False, only_cached=False):
+        self.gets += 1
+        return self.nodes.get(node_id)
+
+    def nodeRequestIterator(self, cached_ids=False):
+        return []
+
+    def getNodeRequest(self, request_id, cached=False, only_cached=False):
+        return None
+
+    def storeNode(self, node):
+        self.nodes[node.id] = node
+        for listener in self.listeners:
+            listener('nodes', node.id)
+
+    def deleteNode(self, node):
+        del self.nodes[node.id]
+        for listener in self.listeners:
+            listener('nodes', node.id)
+
+
+class TestStatusView(tests.BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.zk = FakeZooKeeper()
+        for i in range(5):
+            self.zk.storeNode(self._node(i))
+
+    def _node(self, i, state=zk.READY):
+        node = zk.Node('%010d' % i)
+        node.provider = 'provider%d' % (i % 2)
+        node.type = ['label%d' % (i % 3)]
+        node.state = state
+        node.state_time = 1000.0 + i
+        node.connection_port = 22
+        return node
+
+    def test_node_list(self):
+        view = status.NodeListView(self.zk)
+        view.refresh()
+        rows, cursor = view.rows()
+        self.assertIsNone(cursor)
+        # The output is the same as that of the full listing
+        expected, headers = status.node_list(self.zk)
+        self.assertEqual(json.loads(status.output((expected, headers),
+                                                  'json')),
+                         json.loads(view.output(rows, 'json')))
+        self.assertEqual(status.output((expected, headers), 'pretty'),
+                         view.output(rows, 'pretty'))
+
+    def test_incremental(self):
+        view = status.NodeListView(self.zk)
+        view.refresh()
+        version = view.version
+        gets = self.zk.gets
+
+        # Nothing changed
+        view.refresh()
+        self.assertEqual(version, view.version)
+        self.assertEqual(gets, self.zk.gets)
+
+        # Only the changed rows are rebuilt
+        node = self.zk.nodes['0000000001']
+        node.state = zk.USED
+        self.zk.storeNode(node)
+        self.zk.deleteNode(self.zk.nodes['0000000002'])
+        self.zk.storeNode(self._node(7))
+        view.refresh()
+        self.assertEqual(gets + 3, self.zk.gets)
+        self.assertEqual(version + 1, view.version)
+        objs = json.loads(view.output(view.rows()[0], 'json'))
+        self.assertEqual(['0000000000', '0000000001', '0000000003',
+                          '0000000004', '0000000007'],
+                         [o['id'] for o in objs])
+        self.assertEqual(zk.USED, objs[1]['state'])
+
+        # A change which does not change the row keeps the version
+        self.zk.storeNode(self.zk.nodes['0000000003'])
+        view.refresh()
+        self.assertEqual(version + 1, view.version)
+
+    def test_filter_and_pages(self):
+        view = status.NodeListView(self.zk)
+        view.refresh()
+        rows, cursor = view.rows(provider='provider0')
+        self.assertEqual(['0000000000', '0000000002', '0000000004'],
+                         [r.values[0] for r in rows])
+        rows, cursor = view.rows(label='label1', state=zk.READY)
+        self.assertEqual(['0000000001', '0000000004'],
+                         [r.values[0] for r in rows])
+
+        ids = []
+        cursor = None
+        while True:
+            rows, cursor = view.rows(after=cursor, limit=2)
+            ids.extend(r.values[0] for r in rows)
+            if cursor is None:
+                break
+        self.assertEqual(sorted(self.zk.nodes), ids)
+
+
+class TestStatusEvents(tests.BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.zk = FakeZooKeeper()
+        node = zk.Node('0000000001')
+        node.provider = 'provider'
+        node.type = ['label']
+        node.state = zk.BUILDING
+        self.zk.storeNode(node)
+        self.node = node
+
+    def test_events(self):
+        feed = status.StatusEvents(self.zk)
+        # Nothing has changed yet
+        self.assertEqual(([], 0), feed.wait(None, 0))
+
+        # Changes other than to the state are not events
+        self.node.comment = 'comment'
+        self.zk.storeNode(self.node)
+        self.node.state = zk.READY
+        self.zk.storeNode(self.node)
+        self.zk.deleteNode(self.node)
+        events, sequence = feed.wait(0, 0)
+        self.assertEqual(2, sequence)
+        self.assertEqual([(1, zk.READY), (2, 'deleted')],
+                         [(seq, e['state']) for seq, e in events])
+        self.assertEqual(['label'], events[1][1]['label'])
+        self.assertEqual(events[1:], feed.wait(1, 0)[0])
+
+    def test_wait(self):
+        feed = status.StatusEvents(self.zk)
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(feed.wait(None, 30)))
+        thread.start()
+        for _ in iterate_timeout(10, Exception, "waiting"):
+            with feed._condition:
+                if feed._condition._waiters:
+                    break
+        self.node.state = zk.READY
+        self.zk.storeNode(self.node)
+        thread.join()
+        events, sequence = result[0]
+        self.assertEqual(1, sequence)
+        self.assertEqual(zk.READY, events[0][1]['state'])
+
+        # Closing the feed ends any wait
+        feed.close()
+        self.assertEqual(([], 1), feed.wait(1, 30))
@@ -0,0 +1,95 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+
+import fixtures
+
+from nodepool import tests
+from nodepool import tracing
+from nodepool.zk import zookeeper as zk
+
+
+class TestTracing(tests.BaseTestCase):
+    def _request(self, request_id):
+        request = zk.NodeRequest(request_id)
+        request.node_types = ['label1', 'label2']
+        request.requestor = 'unit-test'
+        return request
+
+    def test_phases(self):
+        timeline = tracing.Timeline('node-request', '100-0000000001')
+        for event, when in [('seen', 10), ('locked', 12), ('paused', 13),
+                            ('unpaused', 20), ('paused', 30),
+                            ('unpaused', 31), ('paused', 40)]:
+            timeline.mark(event, when)
+        self.assertEqual({'assign': 2, 'paused': 8},
+                         timeline.phases(tracing.REQUEST_PHASES))
+        # A phase which has not ended can be measured up to a time
+        self.assertEqual({'assign': 2, 'paused': 13},
+                         timeline.phases(tracing.REQUEST_PHASES, until=45))
+        self.assertEqual(12, timeline.get('locked'))
+        self.assertIsNone(timeline.get('fulfilled'))
+
+    def test_tracer(self):
+        tracer = tracing.Tracer(history=2)
+        timeline = tracer.request(self._request('100-0000000001'))
+        self.assertIs(timeline,
+                      tracer.request(self._request('100-0000000001')))
+        self.assertEqual('label1,label2', timeline.attributes['labels'])
+
+        # A request which was never locked is forgotten when deleted
+        tracer.discard('100-0000000001')
+        self.assertIsNone(tracer.get('100-0000000001'))
+
+        for i in range(3):
+            request_id = '100-000000001%s' % i
+            tracer.request(self._request(request_id)).mark('locked')
+            tracer.discard(request_id)
+            tracer.finish(request_id, 'fulfilled')
+        # Only the most recent finished timelines are kept
+        self.assertIsNone(tracer.get('100-0000000010'))
+        timeline = tracer.get('100-0000000012')
+        self.assertEqual(['locked', 'fulfilled'],
+                         [e for e, t in timeline.events])
+
+    def test_export(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'traces.json')
+        tracer = tracing.Tracer()
+        tracer.configure({'file': path})
+        self.addCleanup(tracer.stop)
+        timeline = tracer.request(self._request('100-0000000001'))
+        for event, when in [('seen', 10), ('locked', 12)]:
+            timeline.mark(event, when)
+        node = timeline.node('0000000001')
+        for event, when in [('building', 13), ('started', 14),
+                            ('created', 50), ('ready', 60)]:
+            node.mark(event, when)
+        tracer.finish('100-0000000001', 'fulfilled')
+        tracer.stop()
+
+        with open(path) as f:
+            document = json.loads(f.readline())
+        spans = document['resourceSpans'][0]['scopeSpans'][0]['spans']
+        names = [s['name'] for s in spans]
+        self.assertEqual(
+            ['node-request', 'assign', 'node', 'start', 'create'], names)
+        self.assertEqual(1, len(set(s['traceId'] for s in spans)))
+        request_span = spans[0]
+        self.assertEqual('', request_span['parentSpanId'])
+        self.assertEqual(str(10 * 10**9), request_span['startTimeUnixNano'])
+        node_span = spans[2]
+        self.assertEqual(request_span['spanId'], node_span['parentSpanId'])
+        self.assertEqual(node_span['spanId'], spans[4]['parentSpanId'])
+        self.assertEqual(str(50 * 10**9), spans[4]['endTimeUnixNano'])
@@ -14,11 +14,29 @@
 
 from concurrent.futures import ThreadPoolExecutor
 import copy
+import hashlib
+import logging
 import math
+import os
+import tempfile
+import threading
 import time
+from unittest import mock
+
+import fixtures
+import testtools
 
 from nodepool import tests
-from nodepool.driver.utils import QuotaInformation, LazyExecutorTTLCache
+from nodepool.driver.utils import (
+    BandwidthLimiter,
+    BlockManifest,
+    ImageUploader,
+    LazyExecutorTTLCache,
+    QuotaInformation,
+    SegmentReader,
+    SparseMap,
+    UploadCheckpoint,
+)
 from nodepool.nodeutils import iterate_timeout
 
 
@@ -107,3 +125,252 @@ class TestLazyExecutorTTLCache(tests.BaseTestCase):
             ret4 = adapter.get_time()
             if ret4 > ret3:
                 break
+
+
+class FakeUploader(ImageUploader):
+    segment_size = 1024
+
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self.segments = {}
+        self.data_types = set()
+        self.lock = threading.Lock()
+
+    def uploadSegment(self, segment):
+        data = SegmentReader(segment.data).read()
+        with self.lock:
+            self.data_types.add(type(segment.data))
+            self.segments[segment.index] = (segment.offset, data)
+
+    def finishUpload(self):
+        return len(self.segments)
+
+
+class FakeSparseUploader(FakeUploader):
+    def skipSegment(self, segment):
+        return segment.isZero()
+
+
+class FakeResumableUploader(FakeUploader):
+    def __init__(self, *args, fail_index=None, **kw):
+        super().__init__(*args, **kw)
+        self.fail_index = fail_index
+        self.started = False
+        self.resumed = False
+        self.aborted = False
+
+    def uploadSegment(self, segment):
+        if segment.index == self.fail_index:
+            raise Exception("Upload failure")
+        super().uploadSegment(segment)
+
+    def startUpload(self):
+        self.started = True
+        self.session_id = 'session'
+
+    def abortUpload(self):
+        self.aborted = True
+
+    def getResumeData(self):
+        return {'session_id': self.session_id}
+
+    def resumeUpload(self, data):
+        self.session_id = data['session_id']
+        self.resumed = True
+        return True
+
+
+class TestImageUploader(tests.BaseTestCase):
+    def _writeImage(self, size):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.unlink, path)
+        data = os.urandom(size)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return path, data
+
+    def test_upload(self):
+        path, data = self._writeImage(10 * 1024 + 100)
+        uploader = FakeUploader(None, logging.getLogger('test'), path,
+                                'image', {}, concurrency=2)
+        self.assertEqual(2, uploader.concurrency)
+        self.assertEqual(11, uploader.upload())
+        # Segments are views of the file rather than copies
+        self.assertEqual({memoryview}, uploader.data_types)
+        uploaded = b''.join(
+            uploader.segments[i][1] for i in sorted(uploader.segments))
+        self.assertEqual(data, uploaded)
+        self.assertEqual(10 * 1024, uploader.segments[10][0])
+        self.assertEqual(100, len(uploader.segments[10][1]))
+
+    def test_upload_empty(self):
+        path, data = self._writeImage(0)
+        uploader = FakeUploader(None, logging.getLogger('test'), path,
+                                'image', {})
+        self.assertEqual(0, uploader.upload())
+
+    def test_segment_reader(self):
+        reader = SegmentReader(memoryview(b'0123456789'))
+        self.assertEqual(10, len(reader))
+        self.assertEqual(b'012', reader.read(3))
+        self.assertEqual(3, reader.tell())
+        self.assertEqual(b'3456789', reader.read())
+        self.assertEqual(b'', reader.read())
+        reader.seek(-2, os.SEEK_END)
+        self.assertEqual(b'89', reader.read(5))
+        reader.seek(0)
+        buf = bytearray(4)
+        self.assertEqual(4, reader.readinto(buf))
+        self.assertEqual(b'0123', bytes(buf))
+
+    def test_resume(self):
+        path, data = self._writeImage(20 * 1024)
+        saved = []
+        checkpoint = UploadCheckpoint(save=saved.append)
+
+        uploader = FakeResumableUploader(
+            None, logging.getLogger('test'), path, 'image', {},
+            concurrency=1, checkpoint=checkpoint, fail_index=12)
+        with testtools.ExpectedException(Exception, "Upload failure"):
+            uploader.upload()
+        self.assertTrue(uploader.started)
+        # The session is kept for resumption
+        self.assertFalse(uploader.aborted)
+        self.assertEqual(1, len(saved))
+        self.assertEqual({'session_id': 'session'},
+                         checkpoint.data['session'])
+        completed = len(uploader.completed)
+        self.assertTrue(completed >= 12)
+        self.assertNotIn(12, uploader.completed)
+
+        # Resume and upload only the remaining segments
+        uploader = FakeResumableUploader(
+            None, logging.getLogger('test'), path, 'image', {},
+            concurrency=1, checkpoint=checkpoint)
+        self.assertEqual(20 - completed, uploader.upload())
+        self.assertTrue(uploader.resumed)
+        self.assertFalse(uploader.started)
+        self.assertEqual(20, len(uploader.completed))
+        for index, (offset, segment_data) in uploader.segments.items():
+            self.assertEqual(data[offset:offset + 1024], segment_data)
+
+    def test_resume_different_file(self):
+        path, data = self._writeImage(20 * 1024)
+        checkpoint = UploadCheckpoint({
+            'size': 10 * 1024,
+            'segment_size': 1024,
+            'session': {'session_id': 'session'},
+            'segments': {'complete_below': 5, 'complete': []},
+        })
+        uploader = FakeResumableUploader(
+            None, logging.getLogger('test'), path, 'image', {},
+            checkpoint=checkpoint)
+        self.assertEqual(20, uploader.upload())
+        self.assertTrue(uploader.started)
+        self.assertFalse(uploader.resumed)
+
+    def test_skip_segments(self):
+        path, data = self._writeImage(10 * 1024)
+        with open(path, 'r+b') as f:
+            for index in (0, 3, 4, 9):
+                f.seek(index * 1024)
+                f.write(bytes(1024))
+        uploader = FakeSparseUploader(None, logging.getLogger('test'), path,
+                                      'image', {})
+        self.assertEqual(6, uploader.upload())
+        self.assertEqual({1, 2, 5, 6, 7, 8}, set(uploader.segments))
+        # Skipped segments are complete as far as resuming goes
+        self.assertEqual(10, len(uploader.completed))
+        self.assertEqual(6 * 1024, uploader.bytes_sent)
+        self.assertEqual(4 * 1024, uploader.bytes_skipped)
+
+    def test_sparse_image(self):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.unlink, path)
+        data = os.urandom(1024)
+        with os.fdopen(fd, 'wb') as f:
+            f.truncate(1024 * 1024)
+            f.seek(512 * 1024)
+            f.write(data)
+        uploader = FakeSparseUploader(None, logging.getLogger('test'), path,
+                                      'image', {})
+        self.assertEqual(1, uploader.upload())
+        self.assertEqual((512 * 1024, data), uploader.segments[512])
+        self.assertEqual(1023 * 1024, uploader.bytes_skipped)
+
+    def test_sparse_map(self):
+        sparse = SparseMap([(4096, 8192), (16384, 20000)])
+        self.assertTrue(sparse.isHole(0, 4096))
+        self.assertFalse(sparse.isHole(0, 4097))
+        self.assertFalse(sparse.isHole(8191, 1024))
+        self.assertTrue(sparse.isHole(8192, 8192))
+        self.assertFalse(sparse.isHole(12288, 8192))
+        self.assertTrue(sparse.isHole(20000, 1024))
+        self.assertTrue(SparseMap([]).isHole(0, 1024))
+
+
+class TestBandwidthLimiter(tests.BaseTestCase):
+    def test_bandwidth_limiter(self):
+        limiter = BandwidthLimiter('provider', 100 * 1024)
+        start = time.monotonic()
+        # The first consumer is not delayed; each after that waits
+        # for the time the previous data takes at the limit.
+        self.assertEqual(0.0, limiter.consume(10 * 1024))
+        limiter.consume(10 * 1024)
+        limiter.consume(10 * 1024)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    def test_bandwidth_unlimited(self):
+        limiter = BandwidthLimiter('provider', None)
+        self.assertEqual(0.0, limiter.consume(10 * 1024))
+        self.assertEqual(0.0, limiter.consume(10 * 1024))
+
+
+class TestBlockManifest(tests.BaseTestCase):
+    def test_block_manifest(self):
+        images_dir = self.useFixture(fixtures.TempDir()).path
+        path = os.path.join(images_dir, 'image-0000000001.raw')
+        data = os.urandom(2500)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+        manifest = BlockManifest(path)
+        digests = manifest.getDigests(1024)
+        self.assertEqual([
+            hashlib.sha256(data[0:1024]).digest(),
+            hashlib.sha256(data[1024:2048]).digest(),
+            # The last block is padded
+            hashlib.sha256(data[2048:].ljust(1024, b'\0')).digest(),
+        ], digests)
+        self.assertTrue(os.path.exists(path + '.blocks'))
+
+        # A second upload reuses the saved manifest
+        manifest = BlockManifest(path)
+        with mock.patch.object(manifest, '_compute') as compute:
+            self.assertEqual(digests, manifest.getDigests(1024))
+        compute.assert_not_called()
+
+        # A different block size is computed anew
+        manifest = BlockManifest(path)
+        self.assertEqual(5, len(manifest.getDigests(512)))
+
+        # The manifest remains usable after the image is removed
+        os.unlink(path)
+        manifest = BlockManifest(path)
+        self.assertEqual(5, len(manifest.getDigests(512)))
+        self.assertIsNone(manifest.getDigests(1024))
+
+    def test_block_manifest_stale(self):
+        images_dir = self.useFixture(fixtures.TempDir()).path
+        path = os.path.join(images_dir, 'image-0000000001.raw')
+        with open(path, 'wb') as f:
+            f.write(bytes(2048))
+        BlockManifest(path).getDigests(1024)
+
+        # Replace the image with different contents
+        data = os.urandom(3072)
+        with open(path, 'wb') as f:
+            f.write(data)
+        digests = BlockManifest(path).getDigests(1024)
+        self.assertEqual(3, len(digests))
+        self.assertEqual(hashlib.sha256(data[0:1024]).digest(), digests[0])
@@ -13,9 +13,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import gzip
 import json
 import logging
 import yaml
+import fixtures
 from urllib import request
 from urllib.error import HTTPError
 
@@ -267,6 +269,87 @@ class TestWebApp(tests.DBTestCase):
         objs = json.loads(data.decode('utf8'))
         self.assertEqual(0, len(objs), objs)
 
+    def test_node_list_view(self):
+        configfile = self.setup_config('node.yaml')
+        pool = self.useNodepool(configfile, watermark_sleep=1)
+        self.useBuilder(configfile)
+        self.startPool(pool)
+        webapp = self.useWebApp(pool, port=0)
+        webapp.start()
+        port = webapp.server.socket.getsockname()[1]
+
+        self.waitForImage('fake-provider', 'fake-image')
+        self.waitForNodes('fake-label')
+
+        # Keep the ETag from changing with the ages during the test
+        self.useFixture(fixtures.MonkeyPatch(
+            'nodepool.webapp.ETAG_AGE_INTERVAL', 10 ** 10))
+        url = ("http://localhost:%s/node-list?provider=fake-provider"
+               "&state=ready&limit=1" % port)
+        req = request.Request(url)
+        req.add_header('Accept', 'application/json')
+        req.add_header('Accept-Encoding', 'gzip')
+        f = request.urlopen(req)
+        self.assertEqual('gzip', f.info().get('Content-Encoding'))
+        objs = json.loads(gzip.decompress(f.read()).decode('utf8'))
+        self.assertEqual(1, len(objs))
+        self.assertEqual('fake-provider', objs[0]['provider'])
+        self.assertEqual('ready', objs[0]['state'])
+        etag = f.info().get('ETag')
+        self.assertIsNotNone(etag)
+
+        # The node list has not changed
+        req.add_header('If-None-Match', etag)
+        with self.assertRaises(HTTPError) as e:
+            request.urlopen(req)
+        self.assertEqual(304, e.exception.code)
+
+        # The ETag changes with time so that the ages are refreshed
+        self.useFixture(fixtures.MonkeyPatch(
+            'nodepool.webapp.ETAG_AGE_INTERVAL', 10 ** -10))
+        f = request.urlopen(req)
+        self.assertNotEqual(etag, f.info().get('ETag'))
+
+        req = request.Request(
+            "http://localhost:%s/node-list?provider=other" % port)
+        req.add_header('Accept', 'application/json')
+        f = request.urlopen(req)
+        self.assertEqual([], json.loads(f.read().decode('utf8')))
+
+    def test_events(self):
+        configfile = self.setup_config('node.yaml')
+        pool = self.useNodepool(configfile, watermark_sleep=1)
+        self.useBuilder(configfile)
+        self.startPool(pool)
+        webapp = self.useWebApp(pool, port=0)
+        webapp.start()
+        port = webapp.server.socket.getsockname()[1]
+
+        self.waitForImage('fake-provider', 'fake-image')
+        nodes = self.waitForNodes('fake-label')
+
+        # Start following events, then change a node
+        f = request.urlopen(
+            "http://localhost:%s/events?timeout=0" % port)
+        sequence = json.loads(f.read().decode('utf8'))['sequence']
+        req = request.Request(
+            "http://localhost:%s/events?type=node&state=used&after=%s" % (
+                port, sequence))
+        req.add_header('Accept', 'text/event-stream')
+        stream = request.urlopen(req)
+        nodes[0].state = zk.USED
+        self.zk.storeNode(nodes[0])
+
+        data = None
+        for line in stream:
+            if line.startswith(b'data: '):
+                data = json.loads(line[len(b'data: '):].decode('utf8'))
+                break
+        stream.close()
+        self.assertEqual({'type': 'node', 'id': nodes[0].id,
+                          'state': zk.USED},
+                         {k: data[k] for k in ('type', 'id', 'state')})
+
     def test_request_list_json(self):
         configfile = self.setup_config('node.yaml')
         pool = self.useNodepool(configfile, watermark_sleep=1)
@@ -358,3 +441,26 @@ class TestWebApp(tests.DBTestCase):
 
         data = f.read()
         self.assertEqual(data, b"OK")
+
+    def test_metrics(self):
+        configfile = self.setup_config('node.yaml')
+        pool = self.useNodepool(configfile, watermark_sleep=1)
+        self.useBuilder(configfile)
+        self.startPool(pool)
+        webapp = self.useWebApp(pool, port=0)
+        webapp.start()
+        port = webapp.server.socket.getsockname()[1]
+
+        self.waitForImage('fake-provider', 'fake-image')
+        self.waitForNodes('fake-label')
+
+        req = request.Request("http://localhost:%s/metrics" % port)
+        f = request.urlopen(req)
+        self.assertEqual(f.info().get('Content-Type'),
+                         'text/plain; version=0.0.4; charset=utf-8')
+        data = f.read().decode('utf8')
+        self.assertIn('# TYPE nodepool_launch_seconds histogram', data)
+        self.assertIn('nodepool_launch_seconds_count{provider="fake-provider",'
+                      'label="fake-label",result="ready"}', data)
+        self.assertIn('nodepool_zk_cache_lag_seconds_count'
+                      '{cache="/nodepool/nodes"}', data)
@@ -11,6 +11,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import fixtures
+import mock
 import testtools
 import time
 import uuid
@@ -19,6 +21,7 @@ import socket
 from kazoo.protocol.states import KazooState
 
 from nodepool import exceptions as npe
+from nodepool import stats
 from nodepool import tests
 from nodepool.zk import zookeeper as zk
 from nodepool.zk.components import PoolComponent
@@ -775,6 +778,22 @@ class TestZooKeeper(tests.DBTestCase):
             self.zk.kazoo_client.exists(self.zk._requestPath(req.id))
         )
 
+    def test_nodeRequestExists(self):
+        req = self._create_node_request()
+        self.assertTrue(self.zk.nodeRequestExists(req.id))
+        self.zk.deleteNodeRequest(req)
+        self.assertFalse(self.zk.nodeRequestExists(req.id))
+        # Once the cache has seen the deletion, ZooKeeper isn't queried
+        for _ in iterate_timeout(10, Exception, "wait for cache"):
+            if req.id in self.zk._request_cache._deleted:
+                break
+        with mock.patch.object(self.zk.kazoo_client, 'exists',
+                               return_value=None) as exists:
+            self.assertFalse(self.zk.nodeRequestExists(req.id))
+            self.assertFalse(self.zk.nodeRequestExists('500-0000000000'))
+            self.assertFalse(self.zk.nodeRequestExists('500-0000000000'))
+        self.assertEqual(1, exists.call_count)
+
     def test_deleteNode(self):
         n1 = self._create_node()
         self.zk.deleteNode(n1)
@@ -782,6 +801,49 @@ class TestZooKeeper(tests.DBTestCase):
             self.zk.kazoo_client.exists(self.zk._nodePath(n1.id))
         )
 
+    def test_operation_stats(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'nodepool.zk.zookeeper.OPERATION_SAMPLE_RATE', 1))
+        node = self._create_node()
+        self.zk.getNode(node.id)
+        counts = stats.ZK_OPERATIONS.values()
+        self.assertGreaterEqual(counts[('getNode', 'MainThread')], 1)
+        totals = stats.ZK_OPERATION_SECONDS.totals()
+        self.assertGreaterEqual(totals[('getNode', 'MainThread')][0], 1)
+        self.assertGreaterEqual(totals[('storeNode', 'MainThread')][0], 1)
+        self.assertIsNotNone(stats.ZK_REQUEST_SECONDS.get(request='Create'))
+
+        statsd = mock.Mock()
+        self.zk.reportStats(statsd, 'nodepool.launcher.test')
+        pipeline = statsd.pipeline.return_value
+        pipeline.incr.assert_any_call(
+            'nodepool.launcher.test.zk.operation.getNode.MainThread', mock.ANY)
+
+    def test_getNodeSummaryCounts(self):
+        n1 = self._create_node()
+        n1.type = ['label1', 'label2']
+        self.zk.storeNode(n1)
+        n2 = self._create_node()
+        n2.type = ['label1', 'label2']
+        self.zk.storeNode(n2)
+        req = self._create_node_request()
+
+        building = (zk.BUILDING, 'rax', ('label1', 'label2'))
+        for _ in iterate_timeout(10, Exception, "wait for cache"):
+            if (self.zk.getNodeSummaryCounts() == {building: 2} and
+                    self.zk.getNodeRequestTypeCounts() == {('label1',): 1}):
+                break
+
+        n1.state = zk.READY
+        self.zk.storeNode(n1)
+        self.zk.deleteNode(n2)
+        self.zk.deleteNodeRequest(req)
+        ready = (zk.READY, 'rax', ('label1', 'label2'))
+        for _ in iterate_timeout(10, Exception, "wait for cache"):
+            if (self.zk.getNodeSummaryCounts() == {ready: 1} and
+                    self.zk.getNodeRequestTypeCounts() == {}):
+                break
+
     def test_getReadyNodesOfTypes(self):
         n1 = self._create_node()
         n1.type = 'label1'
@@ -841,6 +903,43 @@ class TestZooKeeper(tests.DBTestCase):
         with testtools.ExpectedException(StopIteration):
             next(i)
 
+    def test_fetchNodes(self):
+        nodes = [self._create_node() for x in range(5)]
+        self.zk.lockNode(nodes[1], blocking=False)
+        # A window smaller than the number of nodes
+        fetched = list(self.zk.fetchNodes(window=2))
+        self.assertEqual(nodes, fetched)
+        locks = list(self.zk.fetchNodeLocks(iter(fetched), window=2))
+        self.assertEqual([False, True, False, False, False],
+                         [locked for node, locked in locks])
+        self.zk.unlockNode(nodes[1])
+
+        # Missing nodes are skipped
+        self.zk.deleteNode(nodes[0])
+        fetched = list(self.zk.fetchNodes([n.id for n in nodes]))
+        self.assertEqual(nodes[1:], fetched)
+
+    def test_fetchNodeRequests(self):
+        reqs = [self._create_node_request() for x in range(3)]
+        self.assertEqual(reqs, list(self.zk.fetchNodeRequests(window=2)))
+
+    def test_fetchBuilds(self):
+        for image in ('image1', 'image2'):
+            path = self.zk._imageBuildsPath(image)
+            for build_id in ('1', '2'):
+                build = zk.ImageBuild()
+                build.state = zk.READY
+                self.zk.kazoo_client.create(path + "/" + build_id,
+                                            value=build.serialize(),
+                                            makepath=True)
+            self.zk.kazoo_client.create(path + "/lock", makepath=True)
+        self.zk.setImagePaused('image2', True)
+        builds = list(self.zk.fetchBuilds(window=1))
+        self.assertEqual(
+            [('image1', '1', False), ('image1', '2', False),
+             ('image2', '1', True), ('image2', '2', True)],
+            sorted((b._image_name, b.id, paused) for b, paused in builds))
+
     def test_getNodeRequestLockIDs(self):
         req = self._create_node_request()
         self.zk.lockNodeRequest(req, blocking=False)
@@ -956,6 +1055,7 @@ class TestZKModel(tests.BaseTestCase):
         o.builder = 'localhost'
         o.builder_id = 'ABC-123'
         o.formats = ['qemu', 'raw']
+        o.checksums = {'raw': {'md5': 'abc', 'sha256': 'def'}}
 
         d = o.toDict()
         self.assertNotIn('id', d)
@@ -964,6 +1064,7 @@ class TestZKModel(tests.BaseTestCase):
         self.assertEqual(','.join(o.formats), d['formats'])
         self.assertEqual(o.builder, d['builder'])
         self.assertEqual(o.builder_id, d['builder_id'])
+        self.assertEqual(o.checksums, d['checksums'])
 
     def test_ImageBuild_fromDict(self):
         now = int(time.time())
@@ -973,7 +1074,8 @@ class TestZKModel(tests.BaseTestCase):
             'builder_id': 'ABC-123',
             'formats': 'qemu,raw',
             'state': zk.BUILDING,
-            'state_time': now
+            'state_time': now,
+            'checksums': {'raw': {'md5': 'abc', 'sha256': 'def'}},
         }
 
         o = zk.ImageBuild.fromDict(d, 'image_name', d_id)
@@ -983,6 +1085,7 @@ class TestZKModel(tests.BaseTestCase):
         self.assertEqual(o.builder, d['builder'])
         self.assertEqual(o.builder_id, d['builder_id'])
         self.assertEqual(o.formats, d['formats'].split(','))
+        self.assertEqual(d['checksums'], o.checksums)
 
     def test_ImageUpload_toDict(self):
         o = zk.ImageUpload('0001', '0003')
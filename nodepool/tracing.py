@@ -0,0 +1,371 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Timelines of node requests.
+
+The launcher records the time of each step in the life of a node
+request and of the nodes launched for it: when the request was seen,
+locked, paused and fulfilled, and when each node was built, created
+by the provider, scanned and ready.  A timeline is only a list of
+``(event, time)`` pairs, so recording costs little.
+
+Phases are measured between pairs of events.  A finished timeline can
+be converted to spans in the OpenTelemetry (OTLP) JSON format and
+exported to a collector or a file.
+"""
+
+import collections
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import urllib.request
+import uuid
+
+# The phases of a node request, as (phase, start event, end event)
+REQUEST_PHASES = (
+    ('assign', 'seen', 'locked'),
+    ('paused', 'paused', 'unpaused'),
+)
+# The phases of a node launch, as (phase, start event, end event)
+NODE_PHASES = (
+    ('start', 'building', 'started'),
+    ('create', 'started', 'created'),
+    ('nodescan', 'nodescan-start', 'nodescan-end'),
+)
+# The number of finished timelines to keep
+TIMELINE_HISTORY = 1000
+# The most spans to send in one export
+EXPORT_BATCH_SIZE = 100
+
+
+class Timeline(object):
+    '''
+    The events in the life of a node request or node.
+
+    :param str name: The span name of the timeline.
+    :param str id: The request or node id.
+    '''
+    __slots__ = ('name', 'id', 'events', 'nodes', 'attributes')
+
+    def __init__(self, name, id, **attributes):
+        self.name = name
+        self.id = id
+        self.events = []
+        self.nodes = {}
+        self.attributes = attributes
+
+    def mark(self, event, when=None):
+        '''
+        Record an event.
+
+        :param str event: The event name.
+        :param float when: The time of the event; defaults to now.
+        '''
+        self.events.append((event, when or time.time()))
+
+    def node(self, node_id):
+        '''
+        Return the timeline of a node launched for this request.
+        '''
+        timeline = self.nodes.get(node_id)
+        if timeline is None:
+            timeline = Timeline('node', node_id)
+            self.nodes[node_id] = timeline
+        return timeline
+
+    def get(self, event):
+        '''
+        Return the time of the first occurence of an event, or None.
+        '''
+        for name, when in self.events:
+            if name == event:
+                return when
+        return None
+
+    def intervals(self, start, end, until=None):
+        '''
+        Return the intervals from each start event to the next end
+        event.
+
+        An interval which has not ended lasts until the given time,
+        or is omitted if none is given.
+        '''
+        result = []
+        begin = None
+        for name, when in self.events:
+            if name == start and begin is None:
+                begin = when
+            elif name == end and begin is not None:
+                result.append((begin, when))
+                begin = None
+        if begin is not None and until is not None:
+            result.append((begin, until))
+        return result
+
+    def phases(self, phases, until=None):
+        '''
+        Return the total duration of each phase which occurred, in
+        seconds.
+
+        :param tuple phases: The phases, as (phase, start event, end
+            event).
+        :param float until: The end of any phase which has not ended.
+        '''
+        result = {}
+        for phase, start, end in phases:
+            intervals = self.intervals(start, end, until)
+            if intervals:
+                result[phase] = sum(e - s for s, e in intervals)
+        return result
+
+    def toDict(self, phases=REQUEST_PHASES):
+        return {
+            'name': self.name,
+            'id': self.id,
+            'attributes': self.attributes,
+            'events': [{'name': e, 'time': t} for e, t in self.events],
+            'phases': self.phases(phases),
+            'nodes': [n.toDict(NODE_PHASES) for n in self.nodes.values()],
+        }
+
+
+def _spanId():
+    return os.urandom(8).hex()
+
+
+def _nanos(when):
+    return str(int(when * 1e9))
+
+
+def _attributes(attributes):
+    return [{'key': k, 'value': {'stringValue': str(v)}}
+            for k, v in attributes.items() if v is not None]
+
+
+def _span(timeline, trace_id, span_id, parent_id, phases, end):
+    # The span of a timeline has a child span per phase interval
+    start = timeline.events[0][1] if timeline.events else end
+    spans = [{
+        'traceId': trace_id,
+        'spanId': span_id,
+        'parentSpanId': parent_id,
+        'name': timeline.name,
+        'kind': 1,
+        'startTimeUnixNano': _nanos(start),
+        'endTimeUnixNano': _nanos(end),
+        'attributes': _attributes(dict(timeline.attributes,
+                                       **{'nodepool.id': timeline.id})),
+        'events': [{'timeUnixNano': _nanos(t), 'name': e}
+                   for e, t in timeline.events],
+    }]
+    for phase, start_event, end_event in phases:
+        for s, e in timeline.intervals(start_event, end_event, end):
+            spans.append({
+                'traceId': trace_id,
+                'spanId': _spanId(),
+                'parentSpanId': span_id,
+                'name': phase,
+                'kind': 1,
+                'startTimeUnixNano': _nanos(s),
+                'endTimeUnixNano': _nanos(e),
+            })
+    return spans
+
+
+def toSpans(timeline):
+    '''
+    Return the OTLP spans of a request timeline and its nodes.
+    '''
+    end = max((t for _, t in timeline.events), default=time.time())
+    trace_id = uuid.uuid4().hex
+    span_id = _spanId()
+    spans = _span(timeline, trace_id, span_id, '', REQUEST_PHASES, end)
+    for node in timeline.nodes.values():
+        node_end = max((t for _, t in node.events), default=end)
+        spans.extend(_span(node, trace_id, _spanId(), span_id,
+                           NODE_PHASES, node_end))
+    return spans
+
+
+class Exporter(object):
+    '''
+    Export spans in the OTLP JSON format.
+
+    Spans are sent in the background by a thread, either to an
+    OTLP/HTTP collector or appended as one JSON document per line to
+    a file.
+
+    :param str endpoint: The URL of the collector's traces endpoint.
+    :param str path: The path of the file to write.
+    :param str service: The service name of the spans.
+    '''
+    log = logging.getLogger("nodepool.tracing.Exporter")
+
+    def __init__(self, endpoint=None, path=None, service='nodepool-launcher'):
+        self.endpoint = endpoint
+        self.path = path
+        self.service = service
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name='TraceExporter', daemon=True)
+        self._thread.start()
+
+    def export(self, spans):
+        self._queue.put(spans)
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _document(self, spans):
+        return {'resourceSpans': [{
+            'resource': {
+                'attributes': _attributes({'service.name': self.service}),
+            },
+            'scopeSpans': [{
+                'scope': {'name': 'nodepool'},
+                'spans': spans,
+            }],
+        }]}
+
+    def _send(self, spans):
+        data = json.dumps(self._document(spans))
+        if self.path:
+            with open(self.path, 'a') as f:
+                f.write(data + '\n')
+        if self.endpoint:
+            req = urllib.request.Request(
+                self.endpoint, data=data.encode('utf8'),
+                headers={'Content-Type': 'application/json'})
+            with urllib.request.urlopen(req, timeout=10) as resp:
+                resp.read()
+
+    def _run(self):
+        running = True
+        while running:
+            spans = self._queue.get()
+            if spans is None:
+                break
+            # Send whatever else is waiting along with these spans
+            while len(spans) < EXPORT_BATCH_SIZE:
+                try:
+                    more = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if more is None:
+                    running = False
+                    break
+                spans.extend(more)
+            try:
+                self._send(spans)
+            except Exception:
+                self.log.exception("Error exporting %s spans:", len(spans))
+
+
+class Tracer(object):
+    '''
+    Keep the timelines of the node requests handled by a launcher.
+
+    Timelines are started when a request is first seen and finished
+    when a handler is done with it; finished timelines are kept in a
+    bounded history and exported if an exporter is configured.
+    '''
+    log = logging.getLogger("nodepool.tracing.Tracer")
+
+    def __init__(self, history=TIMELINE_HISTORY):
+        self._lock = threading.Lock()
+        self._active = {}
+        self._finished = collections.OrderedDict()
+        self._history = history
+        self._exporter = None
+        self._exporter_config = None
+
+    def configure(self, tracing_config):
+        '''
+        Start, replace or stop the exporter according to the tracing
+        configuration.
+        '''
+        if tracing_config == self._exporter_config:
+            return
+        self._exporter_config = tracing_config
+        old = self._exporter
+        if tracing_config:
+            self.log.info("Exporting traces to %s",
+                          tracing_config.get('endpoint') or
+                          tracing_config.get('file'))
+            self._exporter = Exporter(
+                endpoint=tracing_config.get('endpoint'),
+                path=tracing_config.get('file'),
+                service=tracing_config.get('service-name',
+                                           'nodepool-launcher'))
+        else:
+            self._exporter = None
+        if old:
+            old.stop()
+
+    def stop(self):
+        self.configure(None)
+
+    def request(self, request, **attributes):
+        '''
+        Return the timeline of a node request, starting it if needed.
+
+        :param NodeRequest request: The node request.
+        '''
+        with self._lock:
+            timeline = self._active.get(request.id)
+            if timeline is None:
+                timeline = Timeline(
+                    'node-request', request.id,
+                    event_id=request.event_id,
+                    requestor=request.requestor,
+                    labels=','.join(request.node_types),
+                    **attributes)
+                self._active[request.id] = timeline
+            return timeline
+
+    def discard(self, request_id):
+        '''
+        Forget the timeline of a request unless a handler has locked
+        it, in which case the handler will finish it.
+        '''
+        with self._lock:
+            timeline = self._active.get(request_id)
+            if timeline and timeline.get('locked') is None:
+                del self._active[request_id]
+
+    def finish(self, request_id, event):
+        '''
+        Finish the timeline of a request with a final event.
+        '''
+        with self._lock:
+            timeline = self._active.pop(request_id, None)
+            if timeline is None:
+                return
+            timeline.mark(event)
+            self._finished[request_id] = timeline
+            while len(self._finished) > self._history:
+                self._finished.popitem(last=False)
+            exporter = self._exporter
+        if exporter:
+            exporter.export(toSpans(timeline))
+
+    def get(self, request_id):
+        '''
+        Return the active or finished timeline of a request, or None.
+        '''
+        with self._lock:
+            return (self._active.get(request_id) or
+                    self._finished.get(request_id))
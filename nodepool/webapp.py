@@ -13,14 +13,23 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import hashlib
 import json
 import logging
+import socket
+import socketserver
 import threading
 import time
-from paste import httpserver
+import urllib.parse
+import uuid
+from wsgiref import simple_server
+import zlib
+
 import webob
 from webob import dec
 
+from nodepool import profiler
+from nodepool import stats
 from nodepool import status
 
 """Nodepool main web app.
@@ -30,48 +39,109 @@ status. These responses are provided as preformatted text for now, but
 should be augmented or replaced with JSON data structures.
 """
 
+# How often to send something on an idle event stream, in seconds
+EVENT_KEEPALIVE = 15
+# The longest time a long-poll for events may wait, in seconds
+EVENT_MAX_WAIT = 60
+# How often the ETag of a status view changes even if the view does
+# not, so that the ages in it are refreshed, in seconds
+ETAG_AGE_INTERVAL = 10
+
 
 class Cache(object):
     def __init__(self, expiry=1):
         self.cache = {}
         self.expiry = expiry
+        self.lock = threading.Lock()
 
     def get(self, key):
         now = time.time()
-        if key in self.cache:
-            lm, value = self.cache[key]
-            if now > lm + self.expiry:
-                del self.cache[key]
-                return None
-            return (lm, value)
+        with self.lock:
+            if key in self.cache:
+                lm, value = self.cache[key]
+                if now > lm + self.expiry:
+                    del self.cache[key]
+                    return None
+                return (lm, value)
 
     def put(self, key, value):
         now = time.time()
         res = (now, value)
-        self.cache[key] = res
+        with self.lock:
+            self.cache[key] = res
         return res
 
 
+class WSGIServer(socketserver.ThreadingMixIn, simple_server.WSGIServer):
+    '''
+    A WSGI server which handles each connection in its own thread.
+
+    Slow responses, such as large lists or event streams, do not
+    delay others.
+    '''
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class):
+        if ':' in server_address[0]:
+            self.address_family = socket.AF_INET6
+        super().__init__(server_address, handler_class)
+
+
+class WSGIRequestHandler(simple_server.WSGIRequestHandler):
+    def log_message(self, format, *args):
+        WebApp.log.debug("%s %s", self.address_string(), format % args)
+
+
+def gzip_chunks(chunks):
+    '''Compress an iterable of bytes with gzip as it is produced.'''
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# The status views kept up to date from the ZooKeeper caches
+STATUS_VIEWS = {
+    '/node-list': status.NodeListView,
+    '/request-list': status.RequestListView,
+}
+
+
 class WebApp(threading.Thread):
     log = logging.getLogger("nodepool.WebApp")
 
     def __init__(self, nodepool, port=8005, listen_address='0.0.0.0',
-                 cache_expiry=1):
+                 cache_expiry=1, profiler=False):
         threading.Thread.__init__(self)
         self.nodepool = nodepool
         self.port = port
         self.listen_address = listen_address
         self.cache = Cache(cache_expiry)
         self.cache_expiry = cache_expiry
+        # Whether the profiler may be controlled through the webapp
+        self.profiler = profiler
+        # Status views, created on first use
+        self.views = {}
+        self._views_lock = threading.Lock()
+        # Distinguishes the ETags of this process from those of others
+        self._etag_prefix = uuid.uuid4().hex[:8]
+        self.events = None
         self.daemon = True
-        self.server = httpserver.serve(dec.wsgify(self.app),
-                                       host=self.listen_address,
-                                       port=self.port, start_loop=False)
+        self.server = simple_server.make_server(
+            self.listen_address, self.port, dec.wsgify(self.app),
+            server_class=WSGIServer, handler_class=WSGIRequestHandler)
 
     def run(self):
         self.server.serve_forever()
 
     def stop(self):
+        with self._views_lock:
+            if self.events:
+                self.events.close()
+        if self.is_alive():
+            self.server.shutdown()
         self.server.server_close()
 
     def get_cache(self, path, params, request_type):
@@ -105,9 +175,15 @@ class WebApp(threading.Thread):
             results = status.image_status(zk)
         elif path == '/node-list':
             results = status.node_list(zk,
-                                       node_id=params.get('node_id'))
+                                       node_id=params.get('node_id'),
+                                       provider=params.get('provider'),
+                                       label=params.get('label'),
+                                       state=params.get('state'))
         elif path == '/request-list':
-            results = status.request_list(zk)
+            results = status.request_list(zk,
+                                          provider=params.get('provider'),
+                                          label=params.get('label'),
+                                          state=params.get('state'))
         elif path == '/label-list':
             results = status.label_list(zk)
         else:
@@ -133,9 +209,235 @@ class WebApp(threading.Thread):
         else:
             return 'pretty'
 
+    def get_view(self, path, params):
+        '''
+        Return the status view for a path, or None if the path has no
+        view or the view cannot be used.
+        '''
+        view_class = STATUS_VIEWS.get(path)
+        if view_class is None:
+            return None
+        if path == '/node-list' and params.get('node_id'):
+            return None
+        zk = self.nodepool.getZK()
+        if not zk.enable_cache:
+            return None
+        with self._views_lock:
+            view = self.views.get(path)
+            if view is None:
+                view = view_class(zk)
+                self.views[path] = view
+        return view
+
+    def view_response(self, request, view, request_type):
+        '''
+        Serve a page of a status view.
+
+        Responses have an ETag which changes with the version of the
+        view, and are compressed if the client accepts it.  The ages
+        in the view change with time alone, so the ETag also changes
+        every ETAG_AGE_INTERVAL seconds.
+        '''
+        params = request.params
+        try:
+            limit = params.get('limit')
+            limit = int(limit) if limit else None
+        except ValueError:
+            raise webob.exc.HTTPBadRequest()
+        if limit is not None and limit <= 0:
+            raise webob.exc.HTTPBadRequest()
+        view.refresh()
+
+        index = "%s.%s.%s" % (request.path,
+                              json.dumps(params.dict_of_lists(),
+                                         sort_keys=True),
+                              request_type)
+        etag = '%s-%s-%d-%s' % (self._etag_prefix, view.version,
+                                time.time() // ETAG_AGE_INTERVAL,
+                                hashlib.sha1(index.encode('utf8')).hexdigest())
+        if etag in request.if_none_match:
+            response = webob.exc.HTTPNotModified()
+            response.etag = (etag, False)
+            return response
+
+        rows, cursor = view.rows(provider=params.get('provider'),
+                                 label=params.get('label'),
+                                 state=params.get('state'),
+                                 after=params.get('after'),
+                                 limit=limit)
+        if request_type == 'json':
+            # Send the rows as they are serialized
+            content_type = 'application/json'
+            output = view.iterJSON(rows)
+        else:
+            content_type = 'text/plain'
+            fields = None
+            if params.get('fields'):
+                fields = params.get('fields').split(',')
+            output = [view.output(rows, request_type,
+                                  fields).encode('utf8')]
+        encoding = None
+        if (request.headers.get('Accept-Encoding') and
+                request.accept_encoding.acceptable_offers(['gzip'])):
+            encoding = 'gzip'
+            output = gzip_chunks(output)
+
+        response = webob.Response(app_iter=output,
+                                  charset='UTF-8',
+                                  content_type=content_type)
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.vary = ('Accept', 'Accept-Encoding')
+        if encoding:
+            response.content_encoding = encoding
+        if cursor is not None:
+            next_params = [(k, v) for k, v in params.items() if k != 'after']
+            next_params.append(('after', cursor))
+            response.headers['Link'] = '<%s?%s>; rel="next"' % (
+                request.path, urllib.parse.urlencode(next_params))
+        response.etag = (etag, False)
+        response.cache_control.public = True
+        response.cache_control.max_age = self.cache_expiry
+        response.last_modified = time.time()
+        return response
+
+    def get_events(self):
+        '''
+        Return the feed of state changes, or None if it cannot be used.
+        '''
+        zk = self.nodepool.getZK()
+        if not zk.enable_cache:
+            return None
+        with self._views_lock:
+            if self.events is None:
+                self.events = status.StatusEvents(zk)
+            return self.events
+
+    def _stream_events(self, feed, after, match):
+        # Tell clients how soon to reconnect
+        yield b'retry: 5000\n\n'
+        while not feed.closed:
+            events, after = feed.wait(after, EVENT_KEEPALIVE)
+            chunks = [b'id: %d\nevent: %s\ndata: %s\n\n' % (
+                seq, event['type'].encode('utf8'),
+                json.dumps(event).encode('utf8'))
+                for seq, event in events if match(event)]
+            # A comment keeps the connection from being idle
+            yield b''.join(chunks) or b': keepalive\n\n'
+
+    def event_response(self, request):
+        '''
+        Serve the state changes of nodes and requests.
+
+        Clients which accept ``text/event-stream`` receive server-sent
+        events as they happen; others long-poll for a JSON list.
+        '''
+        feed = self.get_events()
+        if feed is None:
+            raise webob.exc.HTTPNotFound()
+        params = request.params
+        try:
+            after = params.get('after', request.headers.get('Last-Event-ID'))
+            after = int(after) if after else None
+            timeout = min(float(params.get('timeout', EVENT_MAX_WAIT)),
+                          EVENT_MAX_WAIT)
+        except ValueError:
+            raise webob.exc.HTTPBadRequest()
+
+        def match(event):
+            label = params.get('label')
+            return ((params.get('type') in (None, event['type'])) and
+                    (params.get('provider') in (None, event['provider'])) and
+                    (params.get('state') in (None, event['state'])) and
+                    (label is None or label in event['label']))
+
+        if ('text/event-stream' in request.headers.get('Accept', '')):
+            response = webob.Response(
+                app_iter=self._stream_events(feed, after, match),
+                content_type='text/event-stream', charset='UTF-8')
+            response.cache_control.no_cache = True
+        else:
+            events, sequence = feed.wait(after, timeout)
+            result = {
+                'sequence': sequence,
+                'events': [dict(event, sequence=seq)
+                           for seq, event in events if match(event)],
+            }
+            response = webob.Response(
+                body=json.dumps(result).encode('utf8'),
+                content_type='application/json', charset='UTF-8')
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        return response
+
+    def metrics(self):
+        return webob.Response(body=stats.METRICS.render().encode('utf8'),
+                              content_type=stats.METRICS_CONTENT_TYPE,
+                              charset=None)
+
+    def profile(self, request):
+        prof = profiler.PROFILER
+        action = request.path[len('/profile'):].lstrip('/')
+        if action in ('start', 'stop', 'clear'):
+            if request.method != 'POST':
+                raise webob.exc.HTTPMethodNotAllowed()
+            if not self.profiler:
+                raise webob.exc.HTTPForbidden()
+            if action == 'start':
+                try:
+                    interval = float(request.params.get(
+                        'interval', profiler.SAMPLE_INTERVAL))
+                    duration = float(request.params.get('duration', 0))
+                except ValueError:
+                    raise webob.exc.HTTPBadRequest()
+                if interval <= 0:
+                    raise webob.exc.HTTPBadRequest()
+                prof.start(interval, duration)
+            elif action == 'stop':
+                prof.stop()
+            else:
+                prof.clear()
+        elif action == 'status':
+            pass
+        elif action == '':
+            output = prof.collapsed(request.params.get('thread'))
+            return webob.Response(body=output.encode('utf8'),
+                                  charset='UTF-8',
+                                  content_type='text/plain')
+        else:
+            raise webob.exc.HTTPNotFound()
+        status = {
+            'running': prof.running,
+            'interval': prof.interval,
+            'samples': prof.samples,
+            'started': prof.started,
+        }
+        return webob.Response(body=json.dumps(status).encode('utf8'),
+                              charset='UTF-8',
+                              content_type='application/json')
+
+    def trace(self, request):
+        request_id = request.path[len('/trace/'):]
+        timeline = self.nodepool.tracer.get(request_id)
+        if timeline is None:
+            raise webob.exc.HTTPNotFound()
+        return webob.Response(
+            body=json.dumps(timeline.toDict()).encode('utf8'),
+            charset='UTF-8',
+            content_type='application/json')
+
     def app(self, request):
+        if request.path == '/metrics':
+            return self.metrics()
+        if request.path.startswith('/trace/'):
+            return self.trace(request)
+        if request.path == '/events':
+            return self.event_response(request)
+        if request.path == '/profile' or request.path.startswith('/profile/'):
+            return self.profile(request)
 
         request_type = self._request_wants(request)
+        view = self.get_view(request.path, request.params)
+        if view is not None:
+            return self.view_response(request, view, request_type)
         result = self.get_cache(request.path, request.params,
                                 request_type)
         if result is None:
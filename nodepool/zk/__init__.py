@@ -21,6 +21,7 @@ from nodepool.zk.vendor.connection import ZuulConnectionHandler
 from kazoo.handlers.threading import KazooTimeoutError
 from kazoo.protocol.states import KazooState
 
+from nodepool import stats
 from nodepool.zk.exceptions import NoClientException
 from nodepool.zk.handler import PoolSequentialThreadingHandler
 
@@ -28,6 +29,21 @@ from nodepool.zk.handler import PoolSequentialThreadingHandler
 kazoo.client.ConnectionHandler = ZuulConnectionHandler
 
 
+class InstrumentedKazooClient(ZuulKazooClient):
+    """A kazoo client which records how long each request takes."""
+
+    def _call(self, request, async_object):
+        if async_object is not None:
+            start = time.monotonic()
+            name = type(request).__name__
+
+            def _record(result):
+                stats.ZK_REQUEST_SECONDS.observe(
+                    time.monotonic() - start, request=name)
+            async_object.rawlink(_record)
+        return super()._call(request, async_object)
+
+
 class ZooKeeperClient(object):
     log = logging.getLogger("nodepool.zk.ZooKeeperClient")
 
@@ -141,7 +157,7 @@ class ZooKeeperClient(object):
                 args['keyfile'] = self.tls_key
                 args['certfile'] = self.tls_cert
                 args['ca'] = self.tls_ca
-            self.client = ZuulKazooClient(**args)
+            self.client = InstrumentedKazooClient(**args)
             self.client.add_listener(self._connectionListener)
             # Manually retry initial connection attempt
             while True:
@@ -190,6 +190,15 @@ class LauncherComponent(BaseComponent):
 class BuilderComponent(BaseComponent):
     kind = "builder"
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.initial_state = {
+            "id": None,
+            # Where other builders may fetch this builder's image builds
+            "artifact_url": None,
+        }
+        self.content.update(self.initial_state)
+
 
 # Not a process, but rather a provider-pool within a launcher.
 class PoolComponent(BaseComponent):
@@ -13,9 +13,12 @@
 from contextlib import contextmanager
 from copy import copy
 import abc
+import collections
+import functools
 import json
 import logging
 import queue
+import random
 import threading
 import time
 import uuid
@@ -31,6 +34,7 @@ from kazoo.protocol.states import (
 )
 
 from nodepool import exceptions as npe
+from nodepool import stats
 from nodepool.logconfig import get_annotated_logger
 from nodepool.zk.components import COMPONENT_REGISTRY
 from nodepool.zk import ZooKeeperBase
@@ -71,6 +75,62 @@ ABORTED = 'aborted'
 DELETED = 'deleted'
 
 
+# One in this many ZooKeeper operations, chosen at random, is timed
+OPERATION_SAMPLE_RATE = 10
+# The most reads to keep in flight when fetching many objects
+FETCH_WINDOW = 100
+
+# The operation being timed in each thread
+_operation = threading.local()
+
+
+def _subsystem():
+    # The subsystem is the start of the thread name, eg "PoolWorker"
+    # for "PoolWorker.provider-pool".
+    subsystem = getattr(_operation, 'subsystem', None)
+    if subsystem is None:
+        name = threading.current_thread().name
+        match = re.match(r'[A-Za-z]+', name)
+        subsystem = match.group(0) if match else 'unknown'
+        _operation.subsystem = subsystem
+    return subsystem
+
+
+def instrumented(func):
+    '''
+    Count a ZooKeeper operation and record how long it takes.
+
+    Every operation is counted, but only a random sample is timed, so
+    this is cheap enough even for operations answered from the caches.
+    Sampling at random rather than every Nth call keeps the sample
+    from lining up with the operations of a periodic loop.  Operations
+    called by other operations are counted as part of the outermost
+    one.
+    '''
+    operation = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kw):
+        if getattr(_operation, 'active', False):
+            return func(*args, **kw)
+        _operation.active = True
+        try:
+            subsystem = _subsystem()
+            stats.ZK_OPERATIONS.inc(operation=operation, subsystem=subsystem)
+            if random.random() >= 1 / OPERATION_SAMPLE_RATE:
+                return func(*args, **kw)
+            start = time.monotonic()
+            try:
+                return func(*args, **kw)
+            finally:
+                stats.ZK_OPERATION_SECONDS.observe(
+                    time.monotonic() - start,
+                    operation=operation, subsystem=subsystem)
+        finally:
+            _operation.active = False
+    return wrapper
+
+
 # NOTE(Shrews): Importing this from nodepool.config causes an import error
 # since that file imports this file.
 def as_list(item):
@@ -199,6 +259,8 @@ class ImageBuild(BaseModel):
         self.username = None
         self.python_path = None
         self.shell_type = None
+        # Checksums of each format, keyed by format then algorithm
+        self.checksums = {}
 
     def __repr__(self):
         d = self.toDict()
@@ -233,6 +295,8 @@ class ImageBuild(BaseModel):
         d['username'] = self.username
         d['python_path'] = self.python_path
         d['shell_type'] = self.shell_type
+        if self.checksums:
+            d['checksums'] = self.checksums
         return d
 
     @staticmethod
@@ -256,6 +320,7 @@ class ImageBuild(BaseModel):
         self.username = d.get('username', 'zuul')
         self.python_path = d.get('python_path', '/usr/bin/python2')
         self.shell_type = d.get('shell_type')
+        self.checksums = d.get('checksums', {})
         # Only attempt the split on non-empty string
         if d.get('formats', ''):
             self.formats = d.get('formats', '').split(',')
@@ -312,6 +377,8 @@ class ImageUpload(BaseModel):
         self.shell_type = shell_type
         self.external_id = None      # Provider ID of the image
         self.external_name = None    # Provider name of the image
+        # Progress of an interrupted upload that may be resumed
+        self.resume_data = None
 
     def __repr__(self):
         d = self.toDict()
@@ -343,6 +410,8 @@ class ImageUpload(BaseModel):
         d['username'] = self.username
         d['python_path'] = self.python_path
         d['shell_type'] = self.shell_type
+        if self.resume_data is not None:
+            d['resume_data'] = self.resume_data
         return d
 
     @staticmethod
@@ -370,6 +439,7 @@ class ImageUpload(BaseModel):
         self.username = d.get('username', 'zuul')
         self.python_path = d.get('python_path', '/usr/bin/python2')
         self.shell_type = d.get('shell_type')
+        self.resume_data = d.get('resume_data')
 
 
 class NodeRequestLockStats(object):
@@ -767,7 +837,7 @@ class NodepoolTreeCache(abc.ABC):
             self.zk.kazoo_client.handler.short_spawn(self._start)
 
     def _cacheListener(self, event):
-        self._event_queue.put(event)
+        self._event_queue.put((event, time.monotonic()))
 
     def _start(self):
         with self._init_lock:
@@ -787,14 +857,16 @@ class NodepoolTreeCache(abc.ABC):
             self._event_queue = queue.Queue()
             # Prepare (but don't start) the new worker.
             self._event_worker = threading.Thread(
-                target=self._eventWorker)
+                target=self._eventWorker,
+                name=f'CacheEventWorker.{self.root}')
             self._event_worker.daemon = True
 
             if self._playback_worker:
                 self._playback_worker.join()
             self._playback_queue = queue.Queue()
             self._playback_worker = threading.Thread(
-                target=self._playbackWorker)
+                target=self._playbackWorker,
+                name=f'CachePlaybackWorker.{self.root}')
             self._playback_worker.daemon = True
 
             # Clear the stop flag and start the workers now that we
@@ -858,12 +930,13 @@ class NodepoolTreeCache(abc.ABC):
 
     def _eventWorker(self):
         while not (self._stopped or self._stop_workers):
-            event = self._event_queue.get()
-            if event is None:
+            item = self._event_queue.get()
+            if item is None:
                 self._event_queue.task_done()
                 continue
 
             qsize = self._event_queue.qsize()
+            stats.CACHE_QUEUE_SIZE.set(qsize, cache=self.root, queue='event')
             if qsize > self.qsize_warning_threshold:
                 now = time.monotonic()
                 if now - self._last_event_warning > 60:
@@ -871,13 +944,14 @@ class NodepoolTreeCache(abc.ABC):
                                      self.root, qsize)
                     self._last_event_warning = now
 
+            event, received = item
             try:
-                self._handleCacheEvent(event)
+                self._handleCacheEvent(event, received)
             except Exception:
                 self.log.exception("Error handling event %s:", event)
             self._event_queue.task_done()
 
-    def _handleCacheEvent(self, event):
+    def _handleCacheEvent(self, event, received):
         # Ignore root node since we don't maintain a cached object for
         # it (all cached objects are under the root in our tree
         # caches).
@@ -907,7 +981,7 @@ class NodepoolTreeCache(abc.ABC):
             future = self.zk.kazoo_client.get_async(event.path)
         else:
             future = None
-        self._playback_queue.put((event, future, key))
+        self._playback_queue.put((event, future, key, received))
 
     def _playbackWorker(self):
         while not (self._stopped or self._stop_workers):
@@ -917,6 +991,8 @@ class NodepoolTreeCache(abc.ABC):
                 continue
 
             qsize = self._playback_queue.qsize()
+            stats.CACHE_QUEUE_SIZE.set(
+                qsize, cache=self.root, queue='playback')
             if qsize > self.qsize_warning_threshold:
                 now = time.monotonic()
                 if now - self._last_playback_warning > 60:
@@ -925,11 +1001,13 @@ class NodepoolTreeCache(abc.ABC):
                         self.root, qsize)
                     self._last_playback_warning = now
 
-            event, future, key = item
+            event, future, key, received = item
             try:
                 self._handlePlayback(event, future, key)
             except Exception:
                 self.log.exception("Error playing back event %s:", event)
+            stats.CACHE_LAG_SECONDS.observe(
+                time.monotonic() - received, cache=self.root)
             self._playback_queue.task_done()
 
     def _handlePlayback(self, event, future, key):
@@ -1118,15 +1196,55 @@ class ImageCache(NodepoolTreeCache):
 
 
 class NodeCache(NodepoolTreeCache):
+    def __init__(self, zk, root):
+        # The (state, provider, labels) of each node, and the number of
+        # nodes with each, maintained as nodes change for statistics.
+        self._summaries = {}
+        self._summary_counts = collections.Counter()
+        self._summary_lock = threading.Lock()
+        super().__init__(zk, root)
+
     def parsePath(self, path):
         return self.zk._parseNodePath(path)
 
+    def _updateSummary(self, node_id):
+        # Returns whether the summary of the node changed
+        node = self._cached_objects.get((node_id,))
+        new = None
+        if node is not None:
+            new = (node.state, node.provider, tuple(node.type))
+        with self._summary_lock:
+            old = self._summaries.get(node_id)
+            if old == new:
+                return False
+            if old is not None:
+                self._summary_counts[old] -= 1
+                if not self._summary_counts[old]:
+                    del self._summary_counts[old]
+            if new is not None:
+                self._summaries[node_id] = new
+                self._summary_counts[new] += 1
+            else:
+                del self._summaries[node_id]
+        return True
+
+    def _nodeStatsChanged(self):
+        # set the stats event so the stats reporting thread can act upon it
+        if self.zk.node_stats_event is not None:
+            self.zk.node_stats_event.set()
+
     def preCacheHook(self, event, exists):
         key = self.zk._parseNodeLockPath(event.path)
         if key is None:
+            # Updates to locked nodes are skipped by the cache, so
+            # tell listeners before the update as well as after it.
+            node_key = self.parsePath(event.path)
+            if node_key is not None:
+                self.zk._cacheChanged('nodes', node_key[0])
             return
         # A lock contender is being added or removed
         node_id, contender = key
+        self.zk._cacheChanged('nodes', node_id)
         # Construct a key for the node object
         obj_key = (node_id,)
         node = self._cached_objects.get(obj_key)
@@ -1136,12 +1254,21 @@ class NodeCache(NodepoolTreeCache):
             node.lock_contenders.add(contender)
         else:
             node.lock_contenders.discard(contender)
+            # Updates to a node are not cached while we hold its lock,
+            # since the lock holder updates the cached object itself.
+            if self._updateSummary(node_id):
+                self._nodeStatsChanged()
         return
 
     def postCacheHook(self, event, data, stat):
-        # set the stats event so the stats reporting thread can act upon it
-        if self.zk.node_stats_event is not None:
-            self.zk.node_stats_event.set()
+        key = self.parsePath(event.path)
+        if self._updateSummary(key[0]):
+            self._nodeStatsChanged()
+        self.zk._cacheChanged('nodes', key[0])
+
+    def getSummaryCounts(self):
+        with self._summary_lock:
+            return dict(self._summary_counts)
 
     def objectFromDict(self, d, key):
         node_id = key[0]
@@ -1159,6 +1286,21 @@ class NodeCache(NodepoolTreeCache):
 
 
 class RequestCache(NodepoolTreeCache):
+    # How many deleted request IDs to remember
+    deleted_markers = 10000
+
+    def __init__(self, zk, root):
+        # Request IDs are never reused, so once a request is known to
+        # be deleted it stays deleted.
+        self._deleted = collections.OrderedDict()
+        self._deleted_lock = threading.Lock()
+        # The labels of each request, and the number of requests for
+        # each set of labels, for statistics.
+        self._node_types = {}
+        self._node_type_counts = collections.Counter()
+        self._node_types_lock = threading.Lock()
+        super().__init__(zk, root)
+
     def parsePath(self, path):
         return self.zk._parseRequestPath(path)
 
@@ -1166,10 +1308,74 @@ class RequestCache(NodepoolTreeCache):
         request_id = key[0]
         return NodeRequest.fromDict(d, request_id)
 
+    def preCacheHook(self, event, exists):
+        key = self.parsePath(event.path)
+        if key is not None:
+            self.zk._cacheChanged('requests', key[0])
+
+    def postCacheHook(self, event, data, stat):
+        # Let listeners act upon requests as they arrive or change
+        key = self.parsePath(event.path)
+        self.zk._cacheChanged('requests', key[0])
+        request = self._cached_objects.get(key)
+        if request is None:
+            self.markDeleted(key[0])
+        if (self._updateNodeTypes(key[0], request) and
+                self.zk.node_stats_event is not None):
+            self.zk.node_stats_event.set()
+        for listener in self.zk.request_listeners:
+            try:
+                listener(key[0], request)
+            except Exception:
+                self.zk.log.exception("Error in request listener:")
+
     def getNodeRequest(self, request_id):
         self.ensureReady()
         return self._cached_objects.get((request_id,))
 
+    def _updateNodeTypes(self, request_id, request):
+        # The labels of a request don't change once it is created.
+        # Returns whether the counts changed.
+        with self._node_types_lock:
+            old = self._node_types.get(request_id)
+            if request is None:
+                if old is None:
+                    return False
+                del self._node_types[request_id]
+                self._node_type_counts[old] -= 1
+                if not self._node_type_counts[old]:
+                    del self._node_type_counts[old]
+            elif old is None:
+                new = tuple(sorted(set(request.node_types)))
+                self._node_types[request_id] = new
+                self._node_type_counts[new] += 1
+            else:
+                return False
+        return True
+
+    def getNodeTypeCounts(self):
+        with self._node_types_lock:
+            return dict(self._node_type_counts)
+
+    def markDeleted(self, request_id):
+        with self._deleted_lock:
+            self._deleted[request_id] = True
+            self._deleted.move_to_end(request_id)
+            while len(self._deleted) > self.deleted_markers:
+                self._deleted.popitem(last=False)
+
+    def requestExists(self, request_id):
+        '''
+        Return whether a request exists, or None if the cache can't tell.
+        '''
+        if request_id in self._deleted:
+            return False
+        if not self._ready.is_set():
+            return None
+        if (request_id,) in self._cached_objects:
+            return True
+        return None
+
     def getNodeRequestIds(self):
         # get a copy of the values view to avoid runtime errors in the event
         # the _cached_nodes dict gets updated while iterating
@@ -1217,6 +1423,10 @@ class ZooKeeper(ZooKeeperBase):
         self._image_cache = None
         self.enable_cache = enable_cache
         self.node_stats_event = None
+        self.request_listeners = []
+        self.cache_listeners = []
+        self._reported_operations = {}
+        self._reported_operation_times = {}
 
         if self.client.connected:
             self._onConnect()
@@ -1537,6 +1747,26 @@ class ZooKeeper(ZooKeeperBase):
         key = f'{root_key}.zk.image_cache.playback_queue'
         pipeline.gauge(key, self._image_cache._playback_queue.qsize())
 
+        # The number of each operation since the last report, and
+        # their mean time from the sample which was timed
+        counts = stats.ZK_OPERATIONS.values()
+        times = stats.ZK_OPERATION_SECONDS.totals()
+        for (operation, subsystem), count in counts.items():
+            last_count = self._reported_operations.get(
+                (operation, subsystem), 0)
+            if count == last_count:
+                continue
+            key = f'{root_key}.zk.operation.{operation}.{subsystem}'
+            pipeline.incr(key, count - last_count)
+            timed, total = times.get((operation, subsystem), (0, 0))
+            last_timed, last_total = self._reported_operation_times.get(
+                (operation, subsystem), (0, 0))
+            if timed > last_timed:
+                pipeline.timing(key, int(
+                    (total - last_total) / (timed - last_timed) * 1000))
+        self._reported_operations = counts
+        self._reported_operation_times = times
+
         pipeline.send()
 
     @contextmanager
@@ -1765,6 +1995,7 @@ class ZooKeeper(ZooKeeperBase):
         uploads = [x for x in uploads if x != 'lock']
         return uploads
 
+    @instrumented
     def getBuild(self, image, build_id):
         '''
         Retrieve the image build data.
@@ -1791,6 +2022,7 @@ class ZooKeeper(ZooKeeperBase):
         d.stat = stat
         return d
 
+    @instrumented
     def getBuilds(self, image, states=None):
         '''
         Retrieve all image build data matching any given states.
@@ -1857,6 +2089,7 @@ class ZooKeeper(ZooKeeperBase):
         builds.sort(key=lambda x: x.state_time, reverse=True)
         return builds[:count]
 
+    @instrumented
     def storeBuild(self, image, build_data, build_id=None):
         '''
         Store the image build data.
@@ -1894,6 +2127,7 @@ class ZooKeeper(ZooKeeperBase):
 
         return build_id
 
+    @instrumented
     def getImageUpload(self, image, build_id, provider, upload_number):
         '''
         Retrieve the image upload data.
@@ -1928,6 +2162,7 @@ class ZooKeeper(ZooKeeperBase):
         d.stat = stat
         return d
 
+    @instrumented
     def getUploads(self, image, build_id, provider, states=None):
         '''
         Retrieve all image upload data matching any given states.
@@ -2048,6 +2283,7 @@ class ZooKeeper(ZooKeeperBase):
             raise RuntimeError("Caching not enabled")
         return self._image_cache.getUploads()
 
+    @instrumented
     def storeImageUpload(self, image, build_id, provider, image_data,
                          upload_number=None):
         '''
@@ -2168,6 +2404,7 @@ class ZooKeeper(ZooKeeperBase):
         except kze.NoNodeError:
             pass
 
+    @instrumented
     def deleteBuild(self, image, build_id):
         '''
         Delete an image build from ZooKeeper.
@@ -2197,6 +2434,7 @@ class ZooKeeper(ZooKeeperBase):
 
         return True
 
+    @instrumented
     def deleteUpload(self, image, build_id, provider, upload_number):
         '''
         Delete an image upload from ZooKeeper.
@@ -2214,6 +2452,7 @@ class ZooKeeper(ZooKeeperBase):
         except kze.NoNodeError:
             pass
 
+    @instrumented
     def getRegisteredPools(self):
         '''
         Get a list of all launcher pools that have registered with ZooKeeper.
@@ -2223,6 +2462,16 @@ class ZooKeeper(ZooKeeperBase):
         '''
         return list(COMPONENT_REGISTRY.registry.all(kind='pool'))
 
+    def getRegisteredBuilders(self):
+        '''
+        Get a list of all builders that have registered with ZooKeeper.
+
+        :returns: A list of BuilderComponent objects, or empty list if none
+        are found.
+        '''
+        return list(COMPONENT_REGISTRY.registry.all(kind='builder'))
+
+    @instrumented
     def getNodeRequests(self):
         '''
         Get the current list of all node requests in priority sorted order.
@@ -2279,12 +2528,15 @@ class ZooKeeper(ZooKeeperBase):
         except kze.NoNodeError:
             pass
 
-    def getNodeRequest(self, request, cached=False):
+    @instrumented
+    def getNodeRequest(self, request, cached=False, only_cached=False):
         '''
         Get the data for a specific node request.
 
         :param str request: The request ID.
         :param cached: True if cached node requests should be returned.
+        :param bool only_cached: True if we should ignore requests not
+                                 in the cache.
 
         :returns: The request data, or None if the request was not found.
         '''
@@ -2292,6 +2544,8 @@ class ZooKeeper(ZooKeeperBase):
             d = self._request_cache.getNodeRequest(request)
             if d:
                 return d
+            if only_cached:
+                return None
 
         # If we got here we either didn't use the cache or the cache didn't
         # have the request (yet). Note that even if we use caching we need to
@@ -2308,6 +2562,28 @@ class ZooKeeper(ZooKeeperBase):
         d.stat = stat
         return d
 
+    @instrumented
+    def nodeRequestExists(self, request_id):
+        '''
+        Check whether a node request exists.
+
+        The request cache remembers the requests it has seen deleted,
+        so ZooKeeper is only queried for requests the cache doesn't
+        know about yet.
+
+        :param str request_id: The request ID.
+        '''
+        if self._request_cache:
+            exists = self._request_cache.requestExists(request_id)
+            if exists is not None:
+                return exists
+        path = self._requestPath(request_id)
+        exists = self.kazoo_client.exists(path) is not None
+        if not exists and self._request_cache:
+            self._request_cache.markDeleted(request_id)
+        return exists
+
+    @instrumented
     def updateNodeRequest(self, request):
         '''
         Update the data of a node request object in-place
@@ -2326,6 +2602,7 @@ class ZooKeeper(ZooKeeperBase):
         request.updateFromDict(d)
         request.stat = stat
 
+    @instrumented
     def storeNodeRequest(self, request, priority="100"):
         '''
         Store a new or existing node request.
@@ -2354,6 +2631,34 @@ class ZooKeeper(ZooKeeperBase):
             path = self._requestPath(request.id)
             self.kazoo_client.set(path, request.serialize())
 
+    def storeNodeRequestAsync(self, request, priority="100"):
+        '''
+        Store a new node request without waiting for ZooKeeper.
+
+        The request ID is set once the request has been created.
+
+        :param NodeRequest request: The new node request.
+        :param str priority: Priority of the request.
+
+        :returns: A kazoo IAsyncResult for the creation.
+        '''
+        if not request.event_id:
+            request.event_id = uuid.uuid4().hex
+        path = "%s/%s-" % (self.REQUEST_ROOT, priority)
+        result = self.kazoo_client.create_async(
+            path,
+            value=request.serialize(),
+            ephemeral=True,
+            sequence=True,
+            makepath=True)
+
+        def _setId(result):
+            if result.successful():
+                request.id = result.value.split("/")[-1]
+        result.rawlink(_setId)
+        return result
+
+    @instrumented
     def deleteNodeRequest(self, request):
         '''
         Delete a node request.
@@ -2369,6 +2674,17 @@ class ZooKeeper(ZooKeeperBase):
         except kze.NoNodeError:
             pass
 
+    def deleteNodeRequestAsync(self, request):
+        '''
+        Delete a node request without waiting for ZooKeeper.
+
+        :param NodeRequest request: The request to delete.
+
+        :returns: A kazoo IAsyncResult for the deletion.
+        '''
+        return self.kazoo_client.delete_async(self._requestPath(request.id))
+
+    @instrumented
     def lockNodeRequest(self, request, blocking=True, timeout=None):
         '''
         Lock a node request.
@@ -2427,6 +2743,7 @@ class ZooKeeper(ZooKeeperBase):
         # Do an in-place update of the node request so we have the latest data
         self.updateNodeRequest(request)
 
+    @instrumented
     def unlockNodeRequest(self, request):
         '''
         Unlock a node request.
@@ -2444,6 +2761,7 @@ class ZooKeeper(ZooKeeperBase):
         request.lock = None
         request._thread_lock.release()
 
+    @instrumented
     def lockNode(self, node, blocking=True, timeout=None,
                  ephemeral=True, identifier=None):
         '''
@@ -2513,6 +2831,7 @@ class ZooKeeper(ZooKeeperBase):
         # Do an in-place update of the node so we have the latest data.
         self.updateNode(node)
 
+    @instrumented
     def unlockNode(self, node):
         '''
         Unlock a node.
@@ -2531,6 +2850,7 @@ class ZooKeeper(ZooKeeperBase):
 
     contenders_re = re.compile(r'^.*?(\d{10})$')
 
+    @instrumented
     def forceUnlockNode(self, node):
         '''Forcibly unlock a node.
 
@@ -2576,6 +2896,7 @@ class ZooKeeper(ZooKeeperBase):
         lock = Lock(self.kazoo_client, path)
         return lock.contenders()
 
+    @instrumented
     def getNodes(self):
         '''
         Get the current list of all nodes.
@@ -2587,6 +2908,7 @@ class ZooKeeper(ZooKeeperBase):
         except kze.NoNodeError:
             return []
 
+    @instrumented
     def getNode(self, node, cached=False, only_cached=False):
         '''
         Get the data for a specific node.
@@ -2624,6 +2946,7 @@ class ZooKeeper(ZooKeeperBase):
         d.stat = stat
         return d
 
+    @instrumented
     def updateNode(self, node):
         '''
         Update the data of a node object in-place
@@ -2643,6 +2966,7 @@ class ZooKeeper(ZooKeeperBase):
         node.updateFromDict(d)
         node.stat = stat
 
+    @instrumented
     def storeNode(self, node):
         '''
         Store an new or existing node.
@@ -2674,6 +2998,17 @@ class ZooKeeper(ZooKeeperBase):
             path = self._nodePath(node.id)
             self.kazoo_client.set(path, node.serialize())
 
+    def storeNodeAsync(self, node):
+        '''
+        Store an existing node without waiting for ZooKeeper.
+
+        :param Node node: The Node object to store.
+
+        :returns: A kazoo IAsyncResult for the update.
+        '''
+        path = self._nodePath(node.id)
+        return self.kazoo_client.set_async(path, node.serialize())
+
     def watchNode(self, node, callback):
         '''Watch an existing node for changes.
 
@@ -2695,6 +3030,7 @@ class ZooKeeper(ZooKeeperBase):
         path = self._nodePath(node.id)
         self.kazoo_client.DataWatch(path, _callback_wrapper)
 
+    @instrumented
     def deleteRawNode(self, node_id):
         '''
         Delete a znode for a Node.
@@ -2709,6 +3045,7 @@ class ZooKeeper(ZooKeeperBase):
         except kze.NoNodeError:
             pass
 
+    @instrumented
     def deleteNode(self, node):
         '''
         Delete a node.
@@ -2729,6 +3066,7 @@ class ZooKeeper(ZooKeeperBase):
         if node._thread_lock.locked():
             node._thread_lock.release()
 
+    @instrumented
     def getReadyNodesOfTypes(self, labels):
         '''
         Query ZooKeeper for unused/ready nodes.
@@ -2751,6 +3089,7 @@ class ZooKeeper(ZooKeeperBase):
                     ret[label].append(node)
         return ret
 
+    @instrumented
     def deleteOldestUnusedNode(self, provider_name, pool_name):
         '''
         Deletes the oldest unused (READY+unlocked) node for a provider's pool.
@@ -2863,6 +3202,175 @@ class ZooKeeper(ZooKeeperBase):
             if req:
                 yield req
 
+    def _pipeline(self, items, submit, window=FETCH_WINDOW):
+        '''
+        Send asynchronous requests for a sequence of items.
+
+        Up to ``window`` items have requests in flight at a time, so
+        the round trips to ZooKeeper overlap rather than follow one
+        another.  Items are consumed lazily, so a pipeline can read
+        from another.
+
+        :param items: An iterable of items.
+        :param submit: A function which sends the requests for an item
+            and returns a list of their asynchronous results.
+        :returns: A generator of (item, results) tuples in the order of
+            the items, where results has the result of each request,
+            or None if the ZooKeeper node does not exist.
+        '''
+        pending = collections.deque()
+
+        def result(item, futures):
+            results = []
+            for future in futures:
+                try:
+                    results.append(future.get())
+                except kze.NoNodeError:
+                    results.append(None)
+            return item, results
+
+        for item in items:
+            pending.append((item, submit(item)))
+            if len(pending) >= window:
+                yield result(*pending.popleft())
+        while pending:
+            yield result(*pending.popleft())
+
+    def fetchNodes(self, node_ids=None, window=FETCH_WINDOW):
+        '''
+        Read nodes from ZooKeeper with pipelined requests.
+
+        :param list node_ids: The node IDs; defaults to all nodes.
+        :param int window: The most reads to keep in flight.
+        :returns: A generator of Node objects.
+        '''
+        if node_ids is None:
+            node_ids = self.getNodes()
+        client = self.kazoo_client
+        for node_id, (result,) in self._pipeline(
+                node_ids, lambda i: [client.get_async(self._nodePath(i))],
+                window):
+            if not result or not result[0]:
+                continue
+            data, stat = result
+            node = Node.fromDict(self._bytesToDict(data), node_id)
+            node.stat = stat
+            yield node
+
+    def fetchNodeLocks(self, nodes, window=FETCH_WINDOW):
+        '''
+        Find whether nodes are locked with pipelined requests.
+
+        :param nodes: An iterable of Node objects.
+        :param int window: The most reads to keep in flight.
+        :returns: A generator of (node, locked) tuples.
+        '''
+        client = self.kazoo_client
+        for node, (children,) in self._pipeline(
+                nodes,
+                lambda n: [client.get_children_async(
+                    self._nodeLockPath(n.id))],
+                window):
+            # The same test as the contenders of a kazoo lock
+            locked = any('__lock__' in c for c in children or [])
+            yield node, locked
+
+    def fetchNodeRequests(self, request_ids=None, window=FETCH_WINDOW):
+        '''
+        Read node requests from ZooKeeper with pipelined requests.
+
+        :param list request_ids: The request IDs; defaults to all
+            requests.
+        :param int window: The most reads to keep in flight.
+        :returns: A generator of NodeRequest objects.
+        '''
+        if request_ids is None:
+            request_ids = self.getNodeRequests()
+        client = self.kazoo_client
+        for request_id, (result,) in self._pipeline(
+                request_ids,
+                lambda i: [client.get_async(self._requestPath(i))],
+                window):
+            if not result or not result[0]:
+                continue
+            data, stat = result
+            request = NodeRequest.fromDict(self._bytesToDict(data),
+                                           request_id)
+            request.stat = stat
+            yield request
+
+    def fetchBuilds(self, images=None, window=FETCH_WINDOW):
+        '''
+        Read the image builds from ZooKeeper with pipelined requests.
+
+        :param list images: The image names; defaults to all images.
+        :param int window: The most reads to keep in flight.
+        :returns: A generator of (ImageBuild, paused) tuples, where
+            paused is whether the image is paused.
+        '''
+        if images is None:
+            images = self.getImageNames()
+        client = self.kazoo_client
+
+        def build_ids():
+            for image, (build_ids, paused) in self._pipeline(
+                    images,
+                    lambda i: [
+                        client.get_children_async(self._imageBuildsPath(i)),
+                        client.exists_async(self._imagePausePath(i))],
+                    window):
+                for build_id in build_ids or []:
+                    if build_id != 'lock':
+                        yield image, build_id, paused is not None
+
+        for (image, build_id, paused), (result,) in self._pipeline(
+                build_ids(),
+                lambda b: [client.get_async(
+                    self._imageBuildIdPath(b[0], b[1]))],
+                window):
+            if not result:
+                continue
+            data, stat = result
+            try:
+                build = ImageBuild.fromDict(self._bytesToDict(data),
+                                            image, build_id)
+            except json.decoder.JSONDecodeError:
+                self.log.exception('Error loading json data from image '
+                                   'build %s', build_id)
+                continue
+            build.stat = stat
+            yield build, paused
+
+    def getNodeSummaryCounts(self):
+        '''
+        Count the nodes by state, provider and labels.
+
+        :returns: A dictionary mapping (state, provider, labels) tuples,
+            where labels is a tuple of the node's labels, to the number
+            of nodes.
+        '''
+        if self._node_cache:
+            return self._node_cache.getSummaryCounts()
+        counts = collections.Counter()
+        for node in self.nodeIterator(cached=False):
+            counts[(node.state, node.provider, tuple(node.type))] += 1
+        return dict(counts)
+
+    def getNodeRequestTypeCounts(self):
+        '''
+        Count the node requests by the labels they request.
+
+        :returns: A dictionary mapping sorted tuples of labels to the
+            number of requests.
+        '''
+        if self._request_cache:
+            return self._request_cache.getNodeTypeCounts()
+        counts = collections.Counter()
+        for req in self.nodeRequestIterator(cached=False):
+            counts[tuple(sorted(set(req.node_types)))] += 1
+        return dict(counts)
+
+    @instrumented
     def countPoolNodes(self, provider_name, pool_name):
         '''
         Count the number of nodes that exist for the given provider pool.
@@ -2966,6 +3474,34 @@ class ZooKeeper(ZooKeeperBase):
     def setNodeStatsEvent(self, event):
         self.node_stats_event = event
 
+    def addRequestListener(self, listener):
+        '''
+        Add a function to call when a cached node request changes.
+
+        The listener is called from the cache thread with the request
+        ID and the cached request, or None if it was deleted.
+        '''
+        self.request_listeners.append(listener)
+
+    def addCacheListener(self, listener):
+        '''
+        Add a function to call when a cached node or node request may
+        have changed.
+
+        The listener is called from the cache thread with the name of
+        the cache (``nodes`` or ``requests``) and the object ID, both
+        before and after the cached object is updated.  It must be
+        quick; it should only note the change.
+        '''
+        self.cache_listeners.append(listener)
+
+    def _cacheChanged(self, cache, object_id):
+        for listener in self.cache_listeners:
+            try:
+                listener(cache, object_id)
+            except Exception:
+                self.log.exception("Error in cache listener:")
+
     def getStatsElection(self, identifier):
         path = self._electionPath('stats')
         return Election(self.kazoo_client, path, identifier)